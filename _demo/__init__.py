@@ -1,4 +1,5 @@
 import os
+import logging
 try:
     from ..managers.llm_manager import LLM
     from ..managers.tool_manager import ToolManager
@@ -17,6 +18,9 @@ except ImportError:
     # from tools.mcp_warpper_tool import get_weather_agent_tool as get_weather_tool
 
 
+logger = logging.getLogger(__name__)
+
+
 def prepare():
     openai_api_key = os.getenv("OPENAI_API_KEY", None)
     gemini_api_key = os.getenv("GEMINI_API_KEY", None)
@@ -25,20 +29,24 @@ def prepare():
         api_key = openai_api_key
         base_url = None
         max_tokens = 1024
-        print(f'OpenAI: {model}')
+        logger.info('OpenAI: %s', model)
     elif gemini_api_key is not None:
         model = os.getenv("GEMINI_MODEL", None)
         api_key = gemini_api_key
         base_url = None
         max_tokens = 1024
-        print(f'Gemini: {model}')
+        logger.info('Gemini: %s', model)
     else:
         model = ''
         api_key = 'empty'
         base_url = 'http://34.64.195.131:80/v1'
         max_tokens = 1024
-        print(f'LLM: {base_url}')
-    LLM.set(model=model, api_key=api_key, base_url=base_url, max_tokens=max_tokens)
+        logger.info('LLM: %s', base_url)
+    # The model's own sampling unless LLM_TEMPERATURE is set; LLM_TEMPERATURE=0 also turns on the response cache
+    options = {}
+    if os.getenv("LLM_TEMPERATURE") is not None:
+        options["temperature"] = float(os.getenv("LLM_TEMPERATURE"))
+    LLM.set(model=model, api_key=api_key, base_url=base_url, max_tokens=max_tokens, **options)
 
     ToolManager.set(get_math_tool(LLM.get()))
     # ToolManager.set(get_search_tool())
@@ -0,0 +1,132 @@
+# stand_in.py
+#
+# Stand-in MCP servers for load tests: the weather_dummy tools (and a few mail
+# tools) served over streamable HTTP, with injected latency, jitter and errors.
+#
+#   python _demo/mcp_servers/stand_in.py --server weather:8001 --server mail:8002 \
+#       --latency 0.2 --jitter 0.1 --tail-rate 0.01 --tail-latency 2 --error-rate 0.02
+#
+# These are the ports main.py's weather_agent and knoxMail_agent connect to.
+import time
+import random
+import asyncio
+import argparse
+import functools
+from collections import Counter
+import uvicorn
+from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp.exceptions import ToolError
+from weather_dummy import get_fine_dust_level, get_precipitation_chance, get_temperature, get_weather
+
+
+async def list_unread_mails(limit: int = 5) -> str:
+    """읽지 않은 메일 목록을 조회합니다."""
+    return '\n'.join(f"[{i}] From: user{i}@example.com, Subject: Weekly report #{i}" for i in range(1, limit + 1))
+
+
+async def read_mail(mail_id: int) -> str:
+    """메일 내용을 조회합니다."""
+    return (f"From: user{mail_id}@example.com\nSubject: Weekly report #{mail_id}\n\n"
+            + "This is the body of the mail. " * 20)
+
+
+async def send_mail(to: str, subject: str, body: str) -> str:
+    """메일을 보냅니다."""
+    return f"Sent '{subject}' to {to}."
+
+
+TOOLS = {
+    "weather": [get_weather, get_temperature, get_fine_dust_level, get_precipitation_chance],
+    "mail": [list_unread_mails, read_mail, send_mail],
+}
+
+
+class Faults:
+    """Latency, jitter, slow tail and errors to put in front of every tool call."""
+
+    def __init__(self, latency=0.0, jitter=0.0, tail_rate=0.0, tail_latency=0.0, error_rate=0.0,
+                 hang_rate=0.0, hang=30.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang = hang
+        self.random = random.Random(seed)
+        self.counts = Counter()
+
+    def delay(self) -> float:
+        if self.random.random() < self.tail_rate:
+            self.counts["tail"] += 1
+            return self.tail_latency
+        return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def wrap(self, server: str, fn):
+        @functools.wraps(fn)
+        async def tool(*args, **kwargs):
+            self.counts[f'{server}.calls'] += 1
+            roll = self.random.random()
+            if roll < self.hang_rate:
+                # Longer than any sane client timeout
+                self.counts["hangs"] += 1
+                await asyncio.sleep(self.hang)
+            await asyncio.sleep(self.delay())
+            if roll >= 1.0 - self.error_rate:
+                self.counts["errors"] += 1
+                raise ToolError(f"Injected error in {fn.__name__}")
+            return await fn(*args, **kwargs)
+        return tool
+
+
+def build_server(name: str, port: int, host: str, faults: Faults) -> FastMCP:
+    # Per-request INFO logs would be most of the work under load
+    mcp = FastMCP(name, host=host, port=port, log_level="WARNING")
+    for fn in TOOLS[name]:
+        mcp.add_tool(faults.wrap(name, fn))
+    return mcp
+
+
+async def report(faults: Faults, interval: float):
+    start = time.time()
+    while True:
+        await asyncio.sleep(interval)
+        print(f'# [{time.time() - start:.0f}s] {dict(faults.counts)}', flush=True)
+
+
+async def serve(servers, host: str, faults: Faults, report_interval: float):
+    tasks = []
+    for name, port in servers:
+        app = build_server(name, port, host, faults).streamable_http_app()
+        config = uvicorn.Config(app, host=host, port=port, log_level="warning")
+        tasks.append(uvicorn.Server(config).serve())
+        print(f'{name} stand-in on http://{host}:{port}/mcp')
+    if report_interval:
+        tasks.append(report(faults, report_interval))
+    await asyncio.gather(*tasks)
+
+
+def parse_server(value: str):
+    name, _, port = value.partition(':')
+    if name not in TOOLS or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"expected <{'|'.join(TOOLS)}>:<port>, got {value!r}")
+    return name, int(port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', type=parse_server, action='append', help='name:port, repeatable')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='uniform +/- seconds around --latency')
+    parser.add_argument('--tail-rate', type=float, default=0.0, help='fraction of calls that take --tail-latency')
+    parser.add_argument('--tail-latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls that fail')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='fraction of calls that stall for --hang')
+    parser.add_argument('--hang', type=float, default=30.0)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--report', type=float, default=10.0, help='seconds between call counts, 0 for none')
+    args = parser.parse_args()
+    faults = Faults(args.latency, args.jitter, args.tail_rate, args.tail_latency, args.error_rate,
+                    args.hang_rate, args.hang, args.seed)
+    asyncio.run(serve(args.server or [("weather", 8001), ("mail", 8002)], args.host, faults, args.report))
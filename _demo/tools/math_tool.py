@@ -1,7 +1,9 @@
 import math
 import re
+import threading
 from typing import List, Optional
 import numexpr
+import numpy as np
 from langchain.chains.openai_functions import create_structured_output_runnable
 from langchain_core.messages import SystemMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
@@ -9,9 +11,10 @@ from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import StructuredTool
 from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
+from managers.metric_manager import MetricManager
 
 _MATH_DESCRIPTION = (
-    "math(problem: str, context: Optional[list[str]]) -> float:\n"
+    "math(problem: str, context: Optional[list[str]], values: Optional[list[float]]) -> float | list[float]:\n"
     " - Solves the provided math problem.\n"
     " - `problem` can be either a simple math problem (e.g. \"1 + 3\") or a word problem (e.g. \"how many apples are there if there are 3 apples and 2 apples\").\n"
     " - You cannot calculate multiple expressions in one call. For instance, `math('1 + 3, 2 + 4')` does not work. "
@@ -30,6 +33,9 @@ _MATH_DESCRIPTION = (
     "Use 2. math(\"age of Barack Obama\", context=[\"$1\"]) instead.\n"
     " - When you ask a question about `context`, specify the units. "
     "For instance, \"what is xx in height?\" or \"what is xx in millions?\" instead of \"what is xx?\"\n"
+    " - To apply the same computation to many numbers, call `math` once with the numbers as `values` "
+    "and write the problem in terms of `x`, e.g. `math(\"x * 9 / 5 + 32\", values=[21.5, 18, 30.2])`. "
+    "It returns the list of results, in order. Do NOT emit one `math` action per value.\n"
 )
 
 _SYSTEM_PROMPT = """Translate a math problem into a expression that can be executed using Python's numexpr library. Use the output of running this code to answer the question.
@@ -57,6 +63,67 @@ ${context}
 
 Note that context variables are not defined in code yet. You must extract the relevant numbers and directly put them in code."""
 
+_ARRAY_PROMPT = """The expression is evaluated element-wise over an array of {size} values. Refer to the current value as `x` and do not put the values themselves in code."""
+
+
+# Names numexpr understands on its own; anything else needs the LLM to interpret
+_FUNCTIONS = {
+    "pi", "e", "sqrt", "exp", "log", "log10", "log1p", "expm1", "abs",
+    "sin", "cos", "tan", "arcsin", "arccos", "arctan", "arctan2", "sinh", "cosh", "tanh",
+}
+_EXPRESSION_PATTERN = re.compile(r"^[\d\s.+\-*/%()^,A-Za-z_]+$")
+_NAME_PATTERN = re.compile(r"[A-Za-z_]\w*")
+_NUMBER_PATTERN = re.compile(r"[-+]?\d+(?:\.\d+)?")
+_MAX_ARRAY_SIZE = 10_000
+_STATS = {"fast_path": 0, "llm_path": 0, "array_calls": 0, "array_values": 0}
+_LOCK = threading.Lock()
+
+
+def _as_expression(problem: str, context: Optional[List[str]] = None) -> Optional[str]:
+    """Return a numexpr expression if the problem can be evaluated without the LLM."""
+    expression = problem.strip().rstrip("=?").strip()
+    expression = expression.replace("^", "**").replace("×", "*").replace("÷", "/")
+    if not expression or not _EXPRESSION_PATTERN.match(expression) or not re.search(r"\d", expression):
+        return None
+    names = set(_NAME_PATTERN.findall(expression)) - _FUNCTIONS
+    if not names:
+        return expression
+    # A single variable (e.g. "x + 3") with a single number given as context
+    if len(names) == 1 and context and len(context) == 1 and _NUMBER_PATTERN.fullmatch(context[0].strip()):
+        name = names.pop()
+        return re.sub(rf"\b{name}\b", f"({context[0].strip()})", expression)
+    return None
+
+
+def _as_array_expression(problem: str) -> Optional[str]:
+    """Return a numexpr expression over `x` if the problem is already one."""
+    expression = problem.strip().rstrip("=?").strip()
+    expression = expression.replace("^", "**").replace("×", "*").replace("÷", "/")
+    if not expression or not _EXPRESSION_PATTERN.match(expression):
+        return None
+    names = set(_NAME_PATTERN.findall(expression)) - _FUNCTIONS
+    return expression if names == {"x"} else None
+
+
+def get_math_tool_stats() -> dict:
+    """How many calls were answered without the LLM (fast_path) and with it (llm_path)."""
+    with _LOCK:
+        return dict(_STATS)
+
+
+def _collect():
+    stats = get_math_tool_stats()
+    for path in ("fast_path", "llm_path"):
+        yield ("conductor_math_calls_total", "counter", "math tool calls, answered with or without the LLM",
+               {"path": path.removesuffix("_path")}, stats[path])
+    yield ("conductor_math_array_calls_total", "counter", "math tool calls over an array of values", {},
+           stats["array_calls"])
+    yield ("conductor_math_array_values_total", "counter", "Values evaluated by array calls of the math tool", {},
+           stats["array_values"])
+
+
+MetricManager.collector(_collect)
+
 
 class ExecuteCode(BaseModel):
     """The input to the numexpr.evaluate() function."""
@@ -80,6 +147,18 @@ def _evaluate_expression(expression: str) -> str:
     return re.sub(r"^\[|\]$", "", output)
 
 
+def _evaluate_array(expression: str, values: List[float]) -> str:
+    # A single numexpr call over the whole array instead of one call per value
+    try:
+        local_dict = {"pi": math.pi, "e": math.e, "x": np.asarray(values, dtype=np.float64)}
+        output = numexpr.evaluate(expression.strip(), global_dict={}, local_dict=local_dict)
+    except Exception as e:
+        raise ValueError(f'Failed to evaluate "{expression}" over {len(values)} values. Raised error: {repr(e)}. Please try again with a valid numerical expression of `x`')
+    # The fast path only takes expressions of `x`, but the LLM may write one without it
+    # (e.g. "2 * 3"); such a scalar broadcasts to every value
+    return str(np.broadcast_to(output, (len(values),)).tolist())
+
+
 def get_math_tool(llm: ChatOpenAI) -> StructuredTool:
     prompt = ChatPromptTemplate.from_messages([
         ("system", _SYSTEM_PROMPT),
@@ -91,8 +170,24 @@ def get_math_tool(llm: ChatOpenAI) -> StructuredTool:
     def calculate_expression(
         problem: str,
         context: Optional[List[str]] = [],
+        values: Optional[List[float]] = None,
         config: Optional[RunnableConfig] = None,
     ):
+        if values is not None:
+            return calculate_array(problem, context, values, config)
+        # Literal arithmetic (e.g. "23 + 3", or "$1 + 3" once $1 resolved to a number)
+        # doesn't need an LLM round-trip
+        expression = _as_expression(problem, context)
+        if expression is not None:
+            try:
+                output = _evaluate_expression(expression)
+                with _LOCK:
+                    _STATS["fast_path"] += 1
+                return output
+            except ValueError:
+                pass
+        with _LOCK:
+            _STATS["llm_path"] += 1
         chain_input = {"problem": problem}
         if context:
             context_str = "\n".join(context)
@@ -105,6 +200,39 @@ def get_math_tool(llm: ChatOpenAI) -> StructuredTool:
         except Exception as e:
             return repr(e)
 
+    def calculate_array(
+        problem: str,
+        context: Optional[List[str]],
+        values: List[float],
+        config: Optional[RunnableConfig],
+    ):
+        if len(values) > _MAX_ARRAY_SIZE:
+            return repr(ValueError(f"Too many values ({len(values)}); at most {_MAX_ARRAY_SIZE} are supported per call"))
+        with _LOCK:
+            _STATS["array_calls"] += 1
+            _STATS["array_values"] += len(values)
+        expression = _as_array_expression(problem)
+        if expression is not None:
+            try:
+                output = _evaluate_array(expression, values)
+                with _LOCK:
+                    _STATS["fast_path"] += 1
+                return output
+            except ValueError:
+                pass
+        with _LOCK:
+            _STATS["llm_path"] += 1
+        # The LLM only writes the expression once; the values never go into the prompt
+        messages = [SystemMessage(content=_ARRAY_PROMPT.format(size=len(values)))]
+        context_str = "\n".join(context or [])
+        if context_str.strip():
+            messages.append(SystemMessage(content=_ADDITIONAL_CONTEXT_PROMPT.format(context=context_str.strip())))
+        code_model = extractor.invoke({"problem": problem, "context": messages}, config)
+        try:
+            return _evaluate_array(code_model.code, values)
+        except Exception as e:
+            return repr(e)
+
     return StructuredTool.from_function(
         name="math",
         func=calculate_expression,
@@ -124,7 +124,7 @@ def get_weather_agent_tool() -> StructuredTool:
     tools = asyncio.run(client.get_tools())
     desc = generate_descriptions_for_tools(tools)
 
-    agent = create_react_agent(model=LLM.get(), tools=tools, prompt=desc)
+    agent = create_react_agent(model=LLM.get(cache=False), tools=tools, prompt=desc)
 
     # StructuredTool로 wrapping
     weather_agent_tool = create_subagent_tool(agent, tool_name="weather_agent")
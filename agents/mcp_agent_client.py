@@ -1,33 +1,335 @@
-from typing import List, get_type_hints, Optional
+from typing import Any, Callable, List, get_type_hints, Optional
 from pydantic import BaseModel, Field
+import os
+import json
 import asyncio
+import logging
 import threading
+import contextvars
+from concurrent.futures import Future
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables.config import ensure_config, merge_configs
 from langchain_core.tools import BaseTool
 from langchain_core.tools import StructuredTool
 from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import convert_mcp_tool_to_langchain_tool
+from mcp.types import Tool as MCPTool
 from langgraph.prebuilt import create_react_agent
 from managers.llm_manager import LLM
+from managers.usage_manager import BudgetExceeded
+from managers.worker_manager import WorkerManager
+
+
+logger = logging.getLogger(__name__)
+
+# Long-lived event loop shared by every MCP client in the process
+_LOOP: asyncio.AbstractEventLoop | None = None
+_LOOP_LOCK = threading.Lock()
+
+
+def background_loop() -> asyncio.AbstractEventLoop:
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, name="mcp-loop", daemon=True).start()
+        return _LOOP
+
+
+def submit_to_background(coro) -> Future:
+    """Schedule a coroutine on the background loop, keeping the caller's context."""
+    loop = background_loop()
+    future = Future()
+    ctx = contextvars.copy_context()
+
+    def done(task: asyncio.Task):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def create():
+        if future.set_running_or_notify_cancel():
+            loop.create_task(coro, context=ctx).add_done_callback(done)
+
+    loop.call_soon_threadsafe(create)
+    return future
 
 
 # This function runs an async coroutine
 def async_to_sync_safe(coro):
-    result = None
-    error = None
+    return submit_to_background(coro).result()
+
+
+async def async_on_background(coro):
+    """Await a coroutine that must run on the background loop from any loop."""
+    if asyncio.get_running_loop() is background_loop():
+        return await coro
+    return await asyncio.wrap_future(submit_to_background(coro))
+
+
+# On-disk cache of tool schemas per server, so sessions can skip tools/list
+_TOOL_CACHE_PATH = os.getenv("MCP_TOOL_CACHE", os.path.join(os.getcwd(), '.cache', 'mcp_tools.json'))
+_TOOL_CACHE_LOCK = threading.Lock()
+
+
+def _read_tool_cache() -> dict[str, list[dict]]:
+    try:
+        with open(_TOOL_CACHE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    def runner():
-        nonlocal result, error
+
+def load_tool_schemas(key: str) -> list[dict] | None:
+    with _TOOL_CACHE_LOCK:
+        return _read_tool_cache().get(key)
+
+
+def save_tool_schemas(key: str, schemas: list[dict]):
+    with _TOOL_CACHE_LOCK:
+        data = _read_tool_cache()
+        data[key] = schemas
+        os.makedirs(os.path.dirname(_TOOL_CACHE_PATH), exist_ok=True)
+        tmp_path = f'{_TOOL_CACHE_PATH}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, _TOOL_CACHE_PATH)
+
+
+class _PooledSession:
+    def __init__(self, session, tools: List[BaseTool], closing: asyncio.Event, owner: asyncio.Task):
+        self.session = session
+        self.tools = tools
+        self.agent = None
+        self.generation = 0
+        self.uses = 0
+        self._closing = closing
+        self._owner = owner
+
+    async def close(self):
+        # The transport must be torn down by the task that opened it
+        self._closing.set()
+        try:
+            await self._owner
+        except Exception:  # noqa
+            pass
+
+
+# Sessions per server when neither the config nor WorkerManager caps the tool
+DEFAULT_POOL_SIZE = 4
+
+
+class McpSessionPool:
+    """Reusable MCP sessions to one server, living on the background loop.
+
+    Without an explicit max_size the pool follows the tool's WorkerManager
+    limit, so every call granted a worker slot also gets a session.
+    """
+
+    def __init__(
+            self,
+            client: MultiServerMCPClient,
+            server_name: str,
+            max_size: int | None = None,
+            keepalive: float = 30.0,
+            cache_key: str | None = None,
+    ):
+        self.client = client
+        self.server_name = server_name
+        self._max_size = max_size
+        self.keepalive = keepalive
+        self.cache_key = cache_key or server_name
+        self.schemas: list[dict] | None = load_tool_schemas(self.cache_key)
+        self.generation = 0
+        self._idle: List[_PooledSession] = []
+        self._size = 0
+        self._cond: asyncio.Condition | None = None
+        self._keepalive_task: asyncio.Task | None = None
+
+    @property
+    def max_size(self) -> int:
+        # Read on every acquire, so a later WorkerManager.configure applies too
+        return self._max_size or WorkerManager.limit(self.server_name) or DEFAULT_POOL_SIZE
+
+    async def acquire(self) -> _PooledSession:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+            self._keepalive_task = asyncio.create_task(self._keep_alive())
+        async with self._cond:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                await self._cond.wait()
         try:
-            result = asyncio.run(coro)
+            return await self._open()
+        except Exception:
+            async with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    async def release(self, pooled: _PooledSession, broken: bool = False):
+        if broken:
+            await pooled.close()
+        async with self._cond:
+            if broken:
+                self._size -= 1
+            else:
+                pooled.uses += 1
+                self._idle.append(pooled)
+            self._cond.notify()
+
+    async def is_alive(self, pooled: _PooledSession) -> bool:
+        try:
+            await asyncio.wait_for(pooled.session.send_ping(), timeout=5)
+            return True
+        except Exception:  # noqa
+            return False
+
+    async def _open(self) -> _PooledSession:
+        ready = asyncio.get_running_loop().create_future()
+        closing = asyncio.Event()
+
+        async def owner():
+            try:
+                async with self.client.session(self.server_name) as session:
+                    if self.schemas is None:
+                        await self.refresh(session)
+                    ready.set_result((session, self.tools_for(session)))
+                    await closing.wait()
+            except Exception as e:
+                if not ready.done():
+                    ready.set_exception(e)
+                else:
+                    raise
+
+        task = asyncio.create_task(owner())
+        session, tools = await ready
+        pooled = _PooledSession(session, tools, closing, task)
+        pooled.generation = self.generation
+        return pooled
+
+    def tools_for(self, session) -> List[BaseTool]:
+        return [
+            convert_mcp_tool_to_langchain_tool(session, MCPTool.model_validate(schema), server_name=self.server_name)
+            for schema in self.schemas or []]
+
+    async def refresh(self, session) -> bool:
+        """Re-list the server's tools and persist them if they changed."""
+        tools, cursor = [], None
+        while True:
+            result = await session.list_tools(cursor=cursor)
+            tools.extend(result.tools)
+            if not result.nextCursor:
+                break
+            cursor = result.nextCursor
+        schemas = [tool.model_dump(mode="json", exclude_none=True) for tool in tools]
+        if schemas == self.schemas:
+            return False
+        self.schemas = schemas
+        self.generation += 1
+        save_tool_schemas(self.cache_key, schemas)
+        return True
+
+    async def discover(self):
+        """Connect and revalidate the cached tool schemas in the background."""
+        cached = self.schemas is not None
+        try:
+            pooled = await self.acquire()
+        except Exception as e:
+            logger.warning('# <discover> %s: not reachable yet, will connect on first use (%r)', self.server_name, e)
+            return
+        try:
+            # A cache hit skipped tools/list when opening, so check it now
+            if cached and await self.refresh(pooled.session):
+                logger.info('# <discover> %s: tool schemas changed, cache updated', self.server_name)
         except Exception as e:
-            error = e
+            logger.warning('# <discover> %s: failed to list tools (%r)', self.server_name, e)
+        await self.release(pooled)
+
+    async def _keep_alive(self):
+        async def check(pooled: _PooledSession):
+            await self.release(pooled, broken=not await self.is_alive(pooled))
+
+        while True:
+            await asyncio.sleep(self.keepalive)
+            async with self._cond:
+                idle, self._idle = self._idle, []
+            # All at once, each with its own ping timeout, so a few dead sessions
+            # don't hold the live ones back; each goes back as soon as it answers
+            await asyncio.gather(*(check(pooled) for pooled in idle))
+
+
+class _ToolCallWatcher(BaseCallbackHandler):
+    """Notes whether the agent has called any MCP tool yet."""
+
+    run_inline = True
 
-    thread = threading.Thread(target=runner)
-    thread.start()
-    thread.join()
+    def __init__(self):
+        self.called = False
 
-    if error:
-        raise error
-    return result
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self.called = True
+
+
+class McpAgentClient:
+    """ReAct sub-agent over pooled MCP sessions, with reconnect-on-failure.
+
+    A failed run is retried on a fresh session only when the session died
+    before the agent's first tool call: tools such as sending a mail must
+    not run twice.
+    """
+
+    def __init__(self, pool: McpSessionPool, make_agent: Callable[[List[BaseTool]], Any]):
+        self.pool = pool
+        self.make_agent = make_agent
+
+    async def _acquire_alive(self) -> _PooledSession:
+        while True:
+            pooled = await self.pool.acquire()
+            # Fresh sessions were just opened; reused ones may have died while idle,
+            # which is cheaper to find out now than halfway through the agent's run
+            if not pooled.uses or await self.pool.is_alive(pooled):
+                return pooled
+            await self.pool.release(pooled, broken=True)
+
+    async def ainvoke(self, agent_input: dict) -> Any:
+        for attempt in range(2):
+            pooled = await self._acquire_alive()
+            if pooled.generation != self.pool.generation:
+                # The server's tool schemas changed since this session was opened
+                pooled.tools = self.pool.tools_for(pooled.session)
+                pooled.generation = self.pool.generation
+                pooled.agent = None
+            if pooled.agent is None:
+                pooled.agent = self.make_agent(pooled.tools)
+            watcher = _ToolCallWatcher()
+            try:
+                # Next to the callbacks inherited from the caller (tracing, recording)
+                output = await pooled.agent.ainvoke(agent_input, merge_configs(ensure_config(), {"callbacks": [watcher]}))
+            except BudgetExceeded:
+                # The request ran out of budget between two steps; the session is fine
+                await self.pool.release(pooled)
+                raise
+            except Exception:
+                # Only retry on a fresh session if this one is actually gone,
+                # and no tool call may have reached the server yet
+                alive = await self.pool.is_alive(pooled)
+                await self.pool.release(pooled, broken=not alive)
+                if alive or attempt or watcher.called:
+                    raise
+                continue
+            await self.pool.release(pooled)
+            return output
+
+    def invoke(self, agent_input: dict) -> Any:
+        return async_to_sync_safe(self.ainvoke(agent_input))
 
 
 def create_subagent_tool(
@@ -49,17 +351,25 @@ def create_subagent_tool(
         output = async_to_sync_safe(mcp_agent.ainvoke(agent_input))
         return output["output"] if isinstance(output, dict) and "output" in output else str(output)
 
+    async def acall_agent(input: str, context: Optional[list[str]] = []) -> str:
+        agent_input = {"input": input}
+        if context:
+            agent_input["context"] = context  # depends on agent setup
+        output = await async_on_background(mcp_agent.ainvoke(agent_input))
+        return output["output"] if isinstance(output, dict) and "output" in output else str(output)
+
     # Return as structured tool
     return StructuredTool.from_function(
         name=tool_name,
         description=tool_desc,
         func=call_agent,
+        coroutine=acall_agent,
         args_schema=SubAgentInput,
     )
 
 
 def generate_tool_description(tool: StructuredTool) -> str:
-    print(f"Generating description for tool: {tool.name}")
+    logger.debug("Generating description for tool: %s", tool.name)
     
     sig = tool.args_schema if tool.args_schema else tool.func.__annotations__
     type_hints = get_type_hints(tool.func) if tool.func else get_type_hints(tool.coroutine)
@@ -113,8 +423,22 @@ def get_agent_client(config: dict, llm=None) -> BaseTool:
             "transport": mcp_config.get("transport", "streamable-http")
         },
     })
-    tools = asyncio.run(client.get_tools())
-    desc = generate_descriptions_for_tools(tools)
-    agent = create_react_agent(model=llm, tools=tools, prompt=desc)
+    pool = McpSessionPool(
+        client, name,
+        max_size=mcp_config.get("pool_size"),
+        keepalive=mcp_config.get("keepalive", 30.0),
+        cache_key=f'{name}@{mcp_config["url"]}')
+
+    def make_agent(tools: List[BaseTool]):
+        desc = generate_descriptions_for_tools(tools)
+        return create_react_agent(model=llm, tools=tools, prompt=desc)
+
+    agent = McpAgentClient(pool, make_agent)
+
+    # The planner only needs the configured description, so registration
+    # doesn't wait for the server. Discovery of every registered server
+    # runs concurrently on the background loop; a server that is slow or
+    # down is connected on first use instead.
+    submit_to_background(pool.discover())
     return create_subagent_tool(
         agent, tool_name=name, tool_desc=config["description"])
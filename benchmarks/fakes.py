@@ -0,0 +1,227 @@
+################################################################################
+# Benchmark fakes: scripted chat model, tools with latency, plan shapes
+################################################################################
+
+import json
+import time
+import random
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.chat_models import agenerate_from_stream, generate_from_stream
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.tools import StructuredTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+
+class Latency:
+    """A latency distribution in seconds, parsed from a spec.
+
+    const:0.05, uniform:0.01:0.1, lognormal:<median>:<sigma>, or a bare number.
+    """
+
+    def __init__(self, spec: str | float, seed: int = 0):
+        self.spec = str(spec)
+        kind, _, params = self.spec.partition(':')
+        if not params:
+            kind, params = 'const', kind
+        self.kind = kind
+        self.params = [float(p) for p in params.split(':')]
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        if kind not in ('const', 'uniform', 'lognormal'):
+            raise ValueError(f'Unknown latency distribution: {self.spec}')
+
+    def sample(self) -> float:
+        with self.lock:
+            if self.kind == 'const':
+                return self.params[0]
+            if self.kind == 'uniform':
+                return self.random.uniform(self.params[0], self.params[1])
+            median, sigma = self.params
+            return self.random.lognormvariate(0.0, sigma) * median
+
+    def __repr__(self):
+        return f'Latency({self.spec!r})'
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Streams scripted planner text and joiner decisions at a fixed token rate.
+
+    Calls with JoinOutputs bound get a JoinOutputs tool call: `replans` Replan
+    decisions first, then the final response. Everything else gets the next
+    plan of `plans` (the last one repeats).
+    """
+
+    plans: List[str]
+    final: str = 'The final answer.'
+    replans: int = 0
+    tokens_per_second: float = 0.0  # 0: as fast as possible
+    chars_per_token: int = 4
+    first_token_latency: float = 0.0
+
+    def model_post_init(self, context: Any):
+        self._lock = threading.Lock()
+        self._plan_calls = 0
+        self._join_calls = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return 'scripted'
+
+    def bind_tools(self, tools: Sequence[Any], *, tool_choice: Optional[str] = None, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], tool_choice=tool_choice, **kwargs)
+
+    def reset(self):
+        with self._lock:
+            self._plan_calls = 0
+            self._join_calls = 0
+
+    def _is_join(self, kwargs: Dict[str, Any]) -> bool:
+        return any(tool["function"]["name"] == "JoinOutputs" for tool in kwargs.get("tools") or [])
+
+    def _script(self, kwargs: Dict[str, Any]) -> tuple[str, bool]:
+        with self._lock:
+            if self._is_join(kwargs):
+                self._join_calls += 1
+                if self._join_calls <= self.replans:
+                    action = {"feedback": f"Replan #{self._join_calls}"}
+                else:
+                    action = {"response": self.final}
+                return json.dumps({"thought": "Scripted decision.", "action": action}), True
+            plan = self.plans[min(self._plan_calls, len(self.plans) - 1)]
+            self._plan_calls += 1
+            return plan, False
+
+    def _chunks(self, text: str, is_join: bool) -> Iterator[AIMessageChunk]:
+        size = max(1, self.chars_per_token)
+        for i in range(0, len(text), size):
+            piece = text[i:i + size]
+            if is_join:
+                yield AIMessageChunk(content='', tool_call_chunks=[{
+                    "name": "JoinOutputs" if i == 0 else None, "args": piece, "id": "join" if i == 0 else None,
+                    "index": 0}])
+            else:
+                yield AIMessageChunk(content=piece)
+
+    def _delay(self, i: int) -> float:
+        delay = self.first_token_latency if i == 0 else 0.0
+        if self.tokens_per_second:
+            delay += 1.0 / self.tokens_per_second
+        return delay
+
+    def _stream(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        text, is_join = self._script(kwargs)
+        for i, chunk in enumerate(self._chunks(text, is_join)):
+            if delay := self._delay(i):
+                time.sleep(delay)
+            yield ChatGenerationChunk(message=chunk)
+
+    async def _astream(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        text, is_join = self._script(kwargs)
+        for i, chunk in enumerate(self._chunks(text, is_join)):
+            if delay := self._delay(i):
+                await asyncio.sleep(delay)
+            yield ChatGenerationChunk(message=chunk)
+
+    def _generate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+
+    async def _agenerate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+
+
+class ToolRecorder:
+    """When each fake tool call started and ended, by task index."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: Dict[int, tuple[float, float]] = {}
+
+    def record(self, idx: int, start: float, end: float):
+        with self.lock:
+            self.calls[idx] = (start, end)
+
+    def clear(self):
+        with self.lock:
+            self.calls.clear()
+
+
+def fake_tool(name: str, latency: Latency, recorder: ToolRecorder, output_size: int = 64,
+              use_async: bool = True) -> StructuredTool:
+    """A tool that takes `latency` to return `output_size` characters.
+
+    With use_async=False it only has a sync implementation, like most
+    tools wrapped with StructuredTool.from_function, and runs on the thread pool.
+    """
+    payload = 'x' * output_size
+
+    def run(idx: int, inputs: str = '') -> str:
+        start = time.perf_counter()
+        time.sleep(latency.sample())
+        recorder.record(idx, start, time.perf_counter())
+        return payload
+
+    async def arun(idx: int, inputs: str = '') -> str:
+        start = time.perf_counter()
+        await asyncio.sleep(latency.sample())
+        recorder.record(idx, start, time.perf_counter())
+        return payload
+
+    return StructuredTool.from_function(
+        func=run, coroutine=arun if use_async else None, name=name,
+        description=f'{name}(idx: int, inputs: str) -> str:\n - A benchmark tool.\n')
+
+
+SHAPES = ('fanout', 'chain', 'diamond', 'layers')
+
+
+def plan_graph(shape: str, n_tasks: int, width: int = 4, seed: int = 0) -> Dict[int, List[int]]:
+    """Dependencies of tasks 1..n_tasks for a DAG shape."""
+    rng = random.Random(seed)
+    graph: Dict[int, List[int]] = {}
+    for idx in range(1, n_tasks + 1):
+        if shape == 'fanout':
+            deps = []
+        elif shape == 'chain':
+            deps = [idx - 1] if idx > 1 else []
+        elif shape == 'diamond':
+            # One root, a wide middle, and one task that needs all of it
+            deps = [] if idx == 1 else list(range(2, n_tasks)) if idx == n_tasks else [1]
+        elif shape == 'layers':
+            # Layers of `width` tasks, each task using up to two tasks of the previous layer
+            layer = (idx - 1) // width
+            previous = list(range((layer - 1) * width + 1, layer * width + 1)) if layer else []
+            deps = sorted(rng.sample(previous, min(2, len(previous))))
+        else:
+            raise ValueError(f'Unknown plan shape: {shape} (one of {SHAPES})')
+        graph[idx] = deps
+    return graph
+
+
+def make_plan(graph: Dict[int, List[int]], tool_names: Sequence[str], plan_format: str = 'text') -> str:
+    """Planner output for a task graph, in the text or JSON plan format."""
+    lines = ['Thought: Scripted plan.'] if plan_format == 'text' else []
+    for idx, deps in graph.items():
+        tool_name = tool_names[(idx - 1) % len(tool_names)]
+        inputs = ' '.join(f'${d}' for d in deps)
+        if plan_format == 'json':
+            lines.append(json.dumps({"idx": idx, "tool": tool_name, "args": {"idx": idx, "inputs": inputs}}))
+        else:
+            lines.append(f'{idx}. {tool_name}(idx={idx}, inputs="{inputs}")')
+    join_idx = len(graph) + 1
+    if plan_format == 'json':
+        lines.append(json.dumps({"idx": join_idx, "tool": "join", "args": {}}))
+    else:
+        lines.append(f'{join_idx}. join()<END_OF_PLAN>')
+    return '\n'.join(lines)
+
+
+def critical_path(graph: Dict[int, List[int]], durations: Dict[int, float]) -> float:
+    """Longest chain of tool time through the DAG."""
+    finish: Dict[int, float] = {}
+    for idx in sorted(graph):
+        finish[idx] = max((finish[d] for d in graph[idx]), default=0.0) + durations.get(idx, 0.0)
+    return max(finish.values(), default=0.0)
@@ -0,0 +1,148 @@
+################################################################################
+# Benchmark: closed-loop load against /test
+################################################################################
+#
+# python benchmarks/load.py [--url http://localhost:8000/test] [--users 1 4 16 32]
+#                           [--duration 60] [--queries queries.txt] [--json out.json]
+#
+# Each virtual user sends a query from the mix, reads the streamed response to
+# the end, waits --think-time and sends the next one. Every --users value is a
+# step of --duration seconds, so a sweep shows where latency starts to climb
+# and errors start to appear. Per step it reports throughput, p50/p95/p99 of
+# the full response, time to the first event after the start event (see
+# players/events.py), and error rates by kind.
+#
+# To load the whole path on one machine, start the stand-in MCP servers first:
+#   python _demo/mcp_servers/stand_in.py --latency 0.2 --jitter 0.1 --error-rate 0.02
+
+import json
+import time
+import random
+import asyncio
+import argparse
+import statistics
+from collections import Counter
+import httpx
+
+
+QUERIES = [
+    "What's the weather in Seoul?",
+    "What is the temperature in Paris plus 9?",
+    "Compare the fine dust level in Seoul and Busan.",
+    "What's the chance of rain in Tokyo today, and should I bring an umbrella?",
+    "What is 37593 * 67?",
+    "How many unread mails do I have?",
+    "Read my latest mail and summarize it.",
+]
+
+
+def load_queries(path: str | None) -> list[str]:
+    """One query per line; repeat a line to give it more weight."""
+    if path is None:
+        return QUERIES
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def request(client: httpx.AsyncClient, url: str, query: str, timeout: float) -> dict:
+    start = time.perf_counter()
+    first = None
+    final = False
+    tool_errors = 0
+    try:
+        async with asyncio.timeout(timeout):
+            async with client.stream('POST', url, json={"message": query}) as response:
+                if response.status_code != 200:
+                    return {"error": f'http_{response.status_code}', "latency": time.perf_counter() - start}
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    if first is None and event["type"] != "start":
+                        first = time.perf_counter() - start
+                    if event["type"] == "final":
+                        final = True
+                    elif event["type"] == "task-result" and event["error"]:
+                        # The request can still succeed, but a tool call inside it failed
+                        tool_errors += 1
+                    elif event["type"] == "error":
+                        return {"error": "server_error", "latency": time.perf_counter() - start, "ttfc": first}
+    except TimeoutError:
+        return {"error": "timeout", "latency": time.perf_counter() - start}
+    except httpx.HTTPError as e:
+        return {"error": type(e).__name__, "latency": time.perf_counter() - start}
+    latency = time.perf_counter() - start
+    if not final:
+        return {"error": "truncated", "latency": latency, "ttfc": first}
+    return {"latency": latency, "ttfc": first, "tool_errors": tool_errors}
+
+
+async def virtual_user(client, args, queries, rng, deadline, results):
+    while time.perf_counter() < deadline:
+        results.append(await request(client, args.url, rng.choice(queries), args.timeout))
+        if args.think_time:
+            await asyncio.sleep(rng.expovariate(1.0 / args.think_time))
+
+
+async def step(args, queries, users: int) -> dict:
+    results: list[dict] = []
+    limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+    async with httpx.AsyncClient(limits=limits, timeout=None) as client:
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*(
+            virtual_user(client, args, queries, random.Random(args.seed + i), deadline, results)
+            for i in range(users)))
+        elapsed = time.perf_counter() - start
+    ok = [r for r in results if "error" not in r]
+    errors = Counter(r["error"] for r in results if "error" in r)
+    latencies = [r["latency"] for r in ok]
+    ttfc = [r["ttfc"] for r in ok if r.get("ttfc") is not None]
+    return {
+        "users": users, "requests": len(results), "elapsed": elapsed,
+        "throughput": len(ok) / elapsed,
+        "p50": percentile(latencies, 0.50), "p95": percentile(latencies, 0.95), "p99": percentile(latencies, 0.99),
+        "mean": statistics.fmean(latencies) if latencies else float('nan'),
+        "ttfc_p50": percentile(ttfc, 0.50), "ttfc_p95": percentile(ttfc, 0.95),
+        "error_rate": sum(errors.values()) / len(results) if results else 0.0,
+        "errors": dict(errors),
+        "with_tool_errors": sum(1 for r in ok if r["tool_errors"]) / len(ok) if ok else 0.0,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:8000/test')
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds per step')
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean seconds between requests of a user')
+    parser.add_argument('--timeout', type=float, default=120.0, help='seconds per request')
+    parser.add_argument('--queries', help='file with one query per line (default: a built-in mix)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    queries = load_queries(args.queries)
+
+    results = []
+    print(f'{"users":>5} {"reqs":>6} {"req/s":>7} {"p50":>8} {"p95":>8} {"p99":>8} {"ttfc p50":>9} {"ttfc p95":>9} '
+          f'{"errors":>7} {"tool err":>8}  kinds')
+    for users in args.users:
+        r = await step(args, queries, users)
+        results.append(r)
+        print(f'{users:>5} {r["requests"]:>6} {r["throughput"]:>7.2f} {r["p50"]:>7.2f}s {r["p95"]:>7.2f}s '
+              f'{r["p99"]:>7.2f}s {r["ttfc_p50"]:>8.2f}s {r["ttfc_p95"]:>8.2f}s {r["error_rate"]:>7.1%} '
+              f'{r["with_tool_errors"]:>8.1%}  {r["errors"] or ""}')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,57 @@
+################################################################################
+# Benchmark: math tool, array mode vs one call per value
+################################################################################
+#
+# python benchmarks/math_vector.py [--sizes 10 100 1000 10000] [--repeat 5]
+#
+# Only the numexpr evaluation is measured. In the agent the per-value path
+# also costs one planned task (and possibly one LLM call) per value.
+
+import os
+import sys
+import time
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)  # the math tool registers its metrics with managers.metric_manager
+sys.path.insert(0, os.path.join(ROOT, '_demo'))
+from tools.math_tool import _evaluate_array, _evaluate_expression  # noqa: E402
+
+
+EXPRESSION = "x * 9 / 5 + 32"
+
+
+def per_value(values):
+    return [_evaluate_expression(EXPRESSION.replace("x", f"({v})")) for v in values]
+
+
+def vectorized(values):
+    return _evaluate_array(EXPRESSION, values)
+
+
+def measure(fn, values, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(values)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f'{"size":>8} {"per-value (s)":>14} {"array (s)":>12} {"values/s (array)":>18} {"speedup":>9}')
+    for size in args.sizes:
+        values = [random.uniform(-40, 40) for _ in range(size)]
+        t_scalar = measure(per_value, values, args.repeat)
+        t_array = measure(vectorized, values, args.repeat)
+        print(f'{size:>8} {t_scalar:>14.6f} {t_array:>12.6f} {size / t_array:>18,.0f} {t_scalar / t_array:>8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+################################################################################
+# Benchmark: conductor pipeline, fully offline
+################################################################################
+#
+# python benchmarks/pipeline.py [--shape fanout chain diamond layers] [--tasks 8 32]
+#                               [--latency lognormal:0.05:0.5] [--token-rate 200]
+#                               [--mode sync async] [--runs 5] [--json out.json]
+#
+# Builds the real conductor (planner, plan parser, validator, scheduler and
+# joiner) around a scripted chat model that streams the plan at a fixed token
+# rate, and fake tools that sleep for a sampled latency. Per run it reports:
+#  - e2e: wall time of conductor.invoke/ainvoke
+#  - tools: critical path of the sampled tool latencies through the plan DAG
+#  - overhead/task: how long a task waited between being ready (parsed, and its
+#    dependencies done) and its tool starting, averaged over the tasks
+#  - parser throughput of the plan on its own, without the token rate
+#  - thread counts: before the runs and the peak while they ran
+
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+import statistics
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)  # the prompt manager loads its templates relative to the working directory
+from unittest import mock  # noqa: E402
+from langchain_core.messages import AIMessage, HumanMessage  # noqa: E402
+import conductor  # noqa: E402
+from managers.prompt_manager import PromptManager  # noqa: E402
+from managers.worker_manager import WorkerManager  # noqa: E402
+from players.output_parser import LLMCompilerJsonPlanParser, LLMCompilerPlanParser  # noqa: E402
+from players.plan_validator import PlanValidator  # noqa: E402
+from fakes import SHAPES, Latency, ScriptedChatModel, ToolRecorder, critical_path, fake_tool, make_plan, plan_graph  # noqa: E402
+
+
+class ThreadSampler:
+    """Peak threading.active_count() while running, sampled in the background."""
+
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+class ReadyTimes:
+    """When the validator handed each task to the scheduler."""
+
+    def __init__(self):
+        self.times = {}
+        add = PlanValidator.add
+
+        def timed_add(validator, task):
+            ready = add(validator, task)
+            now = time.perf_counter()
+            for task in ready:
+                self.times[task["idx"]] = now
+            return ready
+
+        self.patch = mock.patch.object(PlanValidator, 'add', timed_add)
+
+    def __enter__(self):
+        self.times.clear()
+        self.patch.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.patch.stop()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def dispatch_delays(graph, calls, ready_times):
+    """Seconds between each task becoming runnable and its tool starting."""
+    delays = []
+    for idx, deps in graph.items():
+        if idx not in calls or idx not in ready_times:
+            continue
+        ready = max([ready_times[idx]] + [calls[d][1] for d in deps if d in calls])
+        delays.append(max(0.0, calls[idx][0] - ready))
+    return delays
+
+
+def parser_throughput(plan, tools, plan_format, chunk_size, repeat=5):
+    parser_class = LLMCompilerJsonPlanParser if plan_format == 'json' else LLMCompilerPlanParser
+    parser = parser_class(tools=tools)
+    chunks = [plan[i:i + chunk_size] for i in range(0, len(plan), chunk_size)]
+    best, n = float('inf'), 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        n = sum(1 for _ in parser._transform(iter(chunks)))
+        best = min(best, time.perf_counter() - start)
+    return n / best, len(plan) / best
+
+
+def quiet(verbose):
+    # The players print their prompts and a line per task; keep them out of the table (and the timings)
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+
+def run_once(graph_app, mode, verbose=False):
+    inputs = {"messages": [HumanMessage(content='Run the benchmark plan.')]}
+    with quiet(verbose):
+        start = time.perf_counter()
+        if mode == 'async':
+            state = asyncio.run(graph_app.ainvoke(inputs))
+        else:
+            state = graph_app.invoke(inputs)
+        elapsed = time.perf_counter() - start
+    assert isinstance(state["messages"][-1], AIMessage), state["messages"][-1]
+    return elapsed
+
+
+def bench(args, shape, n_tasks, mode):
+    graph = plan_graph(shape, n_tasks, width=args.width, seed=args.seed)
+    recorder = ToolRecorder()
+    latency = Latency(args.latency, seed=args.seed)
+    tools = {tool.name: tool for tool in (
+        fake_tool(f'tool_{i}', latency, recorder, output_size=args.output_size, use_async=not args.sync_tools)
+        for i in range(args.n_tools))}
+    plan = make_plan(graph, list(tools), plan_format=args.plan_format)
+    model = ScriptedChatModel(
+        plans=[plan], replans=0, tokens_per_second=args.token_rate, chars_per_token=args.chars_per_token,
+        first_token_latency=args.first_token_latency)
+    with quiet(args.verbose):
+        graph_app = conductor.build(
+            model, tools, PromptManager.get('default'), max_concurrency=args.max_concurrency,
+            use_plan_cache=False, stream_join=args.stream_join, plan_format=args.plan_format)
+
+    # Token pacing alone, to tell planner time apart from scheduling
+    stream_time = (len(plan) / max(1, args.chars_per_token)) / args.token_rate if args.token_rate else 0.0
+    e2e, tool_paths, delays = [], [], []
+    threads_before = threading.active_count()
+    with ThreadSampler() as sampler, ReadyTimes() as ready_times:
+        for run in range(args.warmup + args.runs):
+            model.reset()
+            recorder.clear()
+            elapsed = run_once(graph_app, mode, args.verbose)
+            if run >= args.warmup:
+                e2e.append(elapsed)
+                durations = {idx: end - start for idx, (start, end) in recorder.calls.items()}
+                tool_paths.append(critical_path(graph, durations))
+                delays.extend(dispatch_delays(graph, dict(recorder.calls), ready_times.times))
+    tasks_per_s, chars_per_s = parser_throughput(plan, tools, args.plan_format, args.chars_per_token)
+    return {
+        "shape": shape, "tasks": n_tasks, "mode": mode,
+        "e2e_p50": statistics.median(e2e), "e2e_max": max(e2e),
+        "tools_p50": statistics.median(tool_paths), "stream": stream_time,
+        "overhead_avg": statistics.fmean(delays) if delays else 0.0,
+        "overhead_p95": percentile(delays, 0.95) if delays else 0.0,
+        "parser_tasks_per_s": tasks_per_s, "parser_chars_per_s": chars_per_s,
+        "threads_before": threads_before, "threads_peak": sampler.peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shape', nargs='+', default=list(SHAPES), choices=SHAPES)
+    parser.add_argument('--tasks', type=int, nargs='+', default=[8, 32])
+    parser.add_argument('--width', type=int, default=4, help='tasks per layer of the "layers" shape')
+    parser.add_argument('--latency', default='lognormal:0.05:0.5',
+                        help='tool latency: const:S, uniform:LO:HI or lognormal:MEDIAN:SIGMA (seconds)')
+    parser.add_argument('--n-tools', type=int, default=3)
+    parser.add_argument('--sync-tools', action='store_true', help='tools without a coroutine (thread pool)')
+    parser.add_argument('--output-size', type=int, default=64)
+    parser.add_argument('--token-rate', type=float, default=200.0, help='planner tokens per second, 0 for unpaced')
+    parser.add_argument('--chars-per-token', type=int, default=4)
+    parser.add_argument('--first-token-latency', type=float, default=0.0)
+    parser.add_argument('--plan-format', default='text', choices=['text', 'json'])
+    parser.add_argument('--stream-join', action='store_true')
+    parser.add_argument('--max-concurrency', type=int, default=conductor.DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument('--mode', nargs='+', default=['sync', 'async'], choices=['sync', 'async'])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='keep the per-task diagnostics')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    print(f'{"shape":>8} {"tasks":>6} {"mode":>6} {"e2e p50":>9} {"e2e max":>9} {"tools":>8} {"stream":>8} '
+          f'{"ovh/task":>9} {"ovh p95":>9} {"parse t/s":>10} {"threads":>9}')
+    for shape in args.shape:
+        for n_tasks in args.tasks:
+            for mode in args.mode:
+                r = bench(args, shape, n_tasks, mode)
+                results.append(r)
+                print(f'{shape:>8} {n_tasks:>6} {mode:>6} {r["e2e_p50"] * 1e3:>7.1f}ms {r["e2e_max"] * 1e3:>7.1f}ms '
+                      f'{r["tools_p50"] * 1e3:>6.1f}ms {r["stream"] * 1e3:>6.1f}ms '
+                      f'{r["overhead_avg"] * 1e6:>7.0f}us {r["overhead_p95"] * 1e6:>7.0f}us '
+                      f'{r["parser_tasks_per_s"]:>10,.0f} {r["threads_before"]:>4}/{r["threads_peak"]:<4}')
+    print(f'# workers: {WorkerManager.stats()["max_workers"]} threads max')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    WorkerManager.shutdown()
+
+
+if __name__ == '__main__':
+    main()
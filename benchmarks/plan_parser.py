@@ -0,0 +1,85 @@
+################################################################################
+# Benchmark: streaming plan parser
+################################################################################
+#
+# python benchmarks/plan_parser.py [--tasks 10 100 500 1000] [--chunk 4 16] [--repeat 5]
+#
+# Feeds long synthetic plans to LLMCompilerPlanParser in fixed-size chunks,
+# the way the planner LLM streams them, and reports parse throughput. The
+# scan column leaves out building the tasks (argument parsing, dependencies).
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from unittest import mock  # noqa: E402
+from langchain_core.tools import StructuredTool  # noqa: E402
+from players import output_parser  # noqa: E402
+from players.output_parser import LLMCompilerPlanParser  # noqa: E402
+
+
+def search(query: str) -> str:
+    """Search the web."""
+    return query
+
+
+def math(problem: str, context: list[str] | None = None) -> str:
+    """Solve a math problem."""
+    return problem
+
+
+TOOLS = {tool.name: tool for tool in map(StructuredTool.from_function, [search, math])}
+
+
+def synthetic_plan(n_tasks: int, seed: int = 0) -> str:
+    """A plan of `n_tasks` actions, with thoughts and references to earlier tasks."""
+    rng = random.Random(seed)
+    lines = []
+    for idx in range(1, n_tasks + 1):
+        if rng.random() < 0.2:
+            lines.append(f'Thought: step {idx} needs more information (see the results so far)')
+        if idx > 1 and rng.random() < 0.5:
+            refs = sorted(rng.sample(range(1, idx), min(idx - 1, rng.randint(1, 3))))
+            context = ', '.join(f'"${r}"' for r in refs)
+            lines.append(f'{idx}. math("${refs[0]} * 1.1 + {rng.randint(1, 99)}", context=[{context}])')
+        else:
+            lines.append(f'{idx}. search("population of city #{idx}, in millions (2024)")')
+    lines.append(f'{n_tasks + 1}. join()<END_OF_PLAN>')
+    return '\n'.join(lines)
+
+
+def measure(parser: LLMCompilerPlanParser, chunks: list[str], repeat: int) -> tuple[float, int]:
+    best, n = float('inf'), 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        n = sum(1 for _ in parser._transform(iter(chunks)))
+        best = min(best, time.perf_counter() - start)
+    return best, n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, nargs='+', default=[10, 100, 500, 1000])
+    parser.add_argument('--chunk', type=int, nargs='+', default=[4, 16])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    plan_parser = LLMCompilerPlanParser(tools=TOOLS)
+    print(f'{"tasks":>6} {"chars":>8} {"chunk":>6} {"total (ms)":>11} {"scan (ms)":>10} {"scan us/char":>13} {"tasks/s":>10}')
+    for n_tasks in args.tasks:
+        plan = synthetic_plan(n_tasks)
+        for size in args.chunk:
+            chunks = [plan[i:i + size] for i in range(0, len(plan), size)]
+            elapsed, n = measure(plan_parser, chunks, args.repeat)
+            assert n == n_tasks + 1, f'parsed {n} of {n_tasks + 1} tasks'
+            with mock.patch.object(output_parser, 'instantiate_task', lambda **kwargs: dict(kwargs, tool=None)):
+                scan, _ = measure(plan_parser, chunks, args.repeat)
+            print(f'{n_tasks:>6} {len(plan):>8} {size:>6} {elapsed * 1e3:>11.2f} {scan * 1e3:>10.2f} '
+                  f'{scan * 1e6 / len(plan):>13.3f} {n / elapsed:>10,.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+################################################################################
+# Benchmark: replay recorded requests
+################################################################################
+#
+# python benchmarks/replay.py CASSETTE [CASSETTE ...] [--scale 1.0] [--mode async] [--runs 3]
+#
+# Cassettes are recorded by the /test endpoint with RECORD_DIR set (see
+# managers/record_manager.py). The current conductor is built around a chat
+# model that plays back the recorded planner and joiner responses, chunk by
+# chunk, and tools that return the recorded outputs after the recorded
+# duration. --scale multiplies every recorded delay (0 replays with no waits,
+# which leaves only this build's own overhead). Nothing touches the network.
+#
+# Playback is deterministic: planner and joiner calls are answered in recorded
+# order, and tool calls by name and arguments. A replay that asks for calls
+# the cassette doesn't have is reported as a mismatch.
+
+import os
+import sys
+import io
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+import statistics
+import threading
+from collections import defaultdict
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # the prompt manager loads its templates relative to the working directory
+from langchain_core.language_models import BaseChatModel  # noqa: E402
+from langchain_core.language_models.chat_models import agenerate_from_stream, generate_from_stream  # noqa: E402
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, messages_from_dict  # noqa: E402
+from langchain_core.outputs import ChatGenerationChunk, ChatResult  # noqa: E402
+from langchain_core.tools import StructuredTool  # noqa: E402
+from langchain_core.utils.function_calling import convert_to_openai_tool  # noqa: E402
+import conductor  # noqa: E402
+from managers.prompt_manager import PromptManager  # noqa: E402
+from managers.record_manager import JOINER_TOOL, load_cassette  # noqa: E402
+from managers.worker_manager import WorkerManager  # noqa: E402
+
+
+def _tool_call_chunk(chunk: dict) -> dict:
+    return {"name": chunk.get("name"), "args": chunk.get("args"), "id": chunk.get("id"),
+            "index": chunk.get("index"), "type": "tool_call_chunk"}
+
+
+def _playback(call: dict) -> List[tuple[float, AIMessageChunk]]:
+    """(offset from the call's start, chunk) pairs of a recorded LLM call."""
+    if call.get("chunks"):
+        return [(offset, AIMessageChunk(content=content, tool_call_chunks=[_tool_call_chunk(c) for c in rest[0]]
+                                        if rest else []))
+                for offset, content, *rest in call["chunks"]]
+    if "message" in call:
+        message = messages_from_dict([call["message"]])[0]
+        tool_call_chunks = [{"name": c["name"], "args": json.dumps(c["args"]), "id": c.get("id"), "index": i,
+                             "type": "tool_call_chunk"} for i, c in enumerate(getattr(message, "tool_calls", []))]
+        return [(call["end"] - call["start"], AIMessageChunk(content=message.content, tool_call_chunks=tool_call_chunks))]
+    return []
+
+
+class ReplayChatModel(BaseChatModel):
+    """Answers planner and joiner calls with the recorded responses, in recorded order."""
+
+    calls: Dict[str, List[dict]]
+    scale: float = 1.0
+
+    def model_post_init(self, context: Any):
+        self._lock = threading.Lock()
+        self._next = defaultdict(int)
+        self._mismatches: List[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return 'replay'
+
+    def bind_tools(self, tools: Sequence[Any], *, tool_choice: Optional[str] = None, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], tool_choice=tool_choice, **kwargs)
+
+    def reset(self):
+        with self._lock:
+            self._next.clear()
+            self._mismatches.clear()
+
+    def used(self) -> int:
+        with self._lock:
+            return sum(self._next.values())
+
+    def mismatches(self) -> List[str]:
+        with self._lock:
+            return list(self._mismatches)
+
+    def _take(self, kwargs: Dict[str, Any]) -> dict:
+        kind = "join" if any(t["function"]["name"] == JOINER_TOOL for t in kwargs.get("tools") or []) else "plan"
+        with self._lock:
+            n = self._next[kind]
+            if n >= len(self.calls.get(kind, [])):
+                self._mismatches.append(f'{kind} call #{n + 1} was not recorded')
+                raise ValueError(f'The cassette has no {kind} call #{n + 1}')
+            self._next[kind] += 1
+            return self.calls[kind][n]
+
+    def _schedule(self, call: dict) -> Iterator[tuple[float, Optional[AIMessageChunk]]]:
+        # Offsets from the start of the call rather than gaps between chunks, so sleep overshoot doesn't add up
+        for offset, chunk in _playback(call):
+            yield offset * self.scale, chunk
+        # Whatever the call took after its last chunk
+        yield (call["end"] - call["start"]) * self.scale, None
+
+    def _stream(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        call = self._take(kwargs)
+        start = time.perf_counter()
+        for offset, chunk in self._schedule(call):
+            if (wait := start + offset - time.perf_counter()) > 0:
+                time.sleep(wait)
+            if chunk is not None:
+                yield ChatGenerationChunk(message=chunk)
+        if "error" in call:
+            raise RuntimeError(f'Recorded error: {call["error"]}')
+
+    async def _astream(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        call = self._take(kwargs)
+        start = time.perf_counter()
+        for offset, chunk in self._schedule(call):
+            if (wait := start + offset - time.perf_counter()) > 0:
+                await asyncio.sleep(wait)
+            if chunk is not None:
+                yield ChatGenerationChunk(message=chunk)
+        if "error" in call:
+            raise RuntimeError(f'Recorded error: {call["error"]}')
+
+    def _generate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+
+    async def _agenerate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+
+
+def _input_key(inputs: Any) -> str:
+    return json.dumps(inputs, sort_keys=True, ensure_ascii=False, default=str)
+
+
+class ReplayTools:
+    """Tools that return the recorded outputs after the recorded durations."""
+
+    def __init__(self, header: dict, events: List[dict], scale: float = 1.0):
+        self.scale = scale
+        self.recorded = [e for e in events if e["type"] == "tool" and not e.get("nested")]
+        self.lock = threading.Lock()
+        self.used = set()
+        self.mismatches: List[str] = []
+        self.tools = {name: self._tool(name, spec) for name, spec in header["tools"].items()}
+
+    def reset(self):
+        with self.lock:
+            self.used.clear()
+            self.mismatches.clear()
+
+    def _take(self, name: str, inputs: dict) -> Optional[dict]:
+        key = _input_key(inputs)
+        with self.lock:
+            candidates = [i for i, e in enumerate(self.recorded) if e["name"] == name and i not in self.used]
+            # Same arguments first; arguments can differ when they embed volatile outputs
+            exact = [i for i in candidates if _input_key(self.recorded[i]["inputs"]) == key]
+            for i in exact or candidates:
+                self.used.add(i)
+                return self.recorded[i]
+            self.mismatches.append(f'{name}({key}) was not recorded')
+            return None
+
+    def _tool(self, name: str, spec: dict) -> StructuredTool:
+        def play(call):
+            if call is None:
+                raise ValueError(f'The cassette has no call of {name} with these arguments')
+            if "error" in call:
+                raise RuntimeError(f'Recorded error: {call["error"]}')
+            return call["output"]
+
+        def run(**kwargs):
+            call = self._take(name, kwargs)
+            if call is not None and not call.get("cached"):
+                time.sleep(max(0.0, call["end"] - call["start"]) * self.scale)
+            return play(call)
+
+        async def arun(**kwargs):
+            call = self._take(name, kwargs)
+            if call is not None and not call.get("cached"):
+                await asyncio.sleep(max(0.0, call["end"] - call["start"]) * self.scale)
+            return play(call)
+
+        # Sync-only tools stay sync-only, so they go through the thread pool like the originals
+        return StructuredTool(name=name, description=spec["description"], args_schema=spec["schema"],
+                              func=run, coroutine=arun if spec.get("async") else None)
+
+
+class Replay:
+    """The conductor of this build, wired to a cassette."""
+
+    def __init__(self, path: str, scale: float = 1.0, max_concurrency: Optional[int] = None):
+        self.path = path
+        self.header, self.events = load_cassette(path)
+        calls = defaultdict(list)
+        for event in self.events:
+            if event["type"] == "llm" and event["kind"] != "nested":
+                calls[event["kind"]].append(event)
+        self.model = ReplayChatModel(calls=dict(calls), scale=scale)
+        self.tools = ReplayTools(self.header, self.events, scale=scale)
+        options = {k: v for k, v in self.header.get("options", {}).items() if k in ("plan_format", "stream_join")}
+        if max_concurrency:
+            options["max_concurrency"] = max_concurrency
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.graph = conductor.build(
+                self.model, self.tools.tools, PromptManager.get('default'), use_plan_cache=False, **options)
+
+    def run(self, mode: str = 'async', verbose: bool = False) -> dict:
+        self.model.reset()
+        self.tools.reset()
+        inputs = {"messages": [HumanMessage(content=self.header["query"])]}
+        with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            if mode == 'async':
+                state = asyncio.run(self.graph.ainvoke(inputs))
+            else:
+                state = self.graph.invoke(inputs)
+            elapsed = time.perf_counter() - start
+        final = state["messages"][-1]
+        recorded_llm = sum(len(v) for v in self.model.calls.values())
+        return {
+            "e2e": elapsed,
+            "final": final.content if isinstance(final, AIMessage) else None,
+            "llm_calls": f'{self.model.used()}/{recorded_llm}',
+            "tool_calls": f'{len(self.tools.used)}/{len(self.tools.recorded)}',
+            "mismatches": self.model.mismatches() + self.tools.mismatches,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cassettes', nargs='+')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier of the recorded delays, 0 for none')
+    parser.add_argument('--mode', default='async', choices=['sync', 'async'])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--max-concurrency', type=int)
+    parser.add_argument('--verbose', action='store_true', help='keep the per-task diagnostics')
+    args = parser.parse_args()
+
+    print(f'{"cassette":<36} {"recorded":>9} {"replay p50":>11} {"replay max":>11} {"llm":>6} {"tools":>7}  result')
+    for path in args.cassettes:
+        replay = Replay(path, scale=args.scale, max_concurrency=args.max_concurrency)
+        results = [replay.run(args.mode, args.verbose) for _ in range(args.runs)]
+        e2e = [r["e2e"] for r in results]
+        last = results[-1]
+        mismatches = sorted({m for r in results for m in r["mismatches"]})
+        finals = {r["final"] for r in results}
+        status = 'mismatch' if mismatches else 'ok' if len(finals) == 1 else 'nondeterministic'
+        print(f'{os.path.basename(path):<36} {replay.header.get("duration", 0) * 1e3:>7.0f}ms '
+              f'{statistics.median(e2e) * 1e3:>9.1f}ms {max(e2e) * 1e3:>9.1f}ms '
+              f'{last["llm_calls"]:>6} {last["tool_calls"]:>7}  {status}')
+        for mismatch in mismatches:
+            print(f'  - {mismatch}')
+    WorkerManager.shutdown()
+
+
+if __name__ == '__main__':
+    main()
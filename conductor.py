@@ -7,27 +7,59 @@ from typing_extensions import TypedDict
 from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import AIMessage
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import Runnable
+from langchain_core.runnables import Runnable, RunnableLambda
 from langchain_core.tools import BaseTool
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
-from players.planner import build as build_planner
-from players.scheduler import build as build_scheduler
+from players.planner import build as build_planner, remember_plan
+from players.scheduler import build as build_scheduler, DEFAULT_MAX_CONCURRENCY
 from players.joiner import build as build_joiner
+from players.plan_validator import count_plan_errors, is_plan_error
+from managers.usage_manager import UsageManager
 
 
 class State(TypedDict):
     messages: Annotated[list, add_messages]
 
 
+def over_budget(state):
+    return {"messages": [AIMessage(
+        content=f"I could not finish answering within this request's budget ({UsageManager.exceeded()}). "
+                f"The results gathered so far are above.")]}
+
+
+def _remembering_plans(join: Runnable) -> Runnable:
+    # A plan becomes a template only once the joiner has accepted its results
+    def join_and_remember(state, config):
+        result = join.invoke(state, config)
+        remember_plan(state["messages"] + result["messages"])
+        return result
+
+    async def ajoin_and_remember(state, config):
+        result = await join.ainvoke(state, config)
+        remember_plan(state["messages"] + result["messages"])
+        return result
+
+    return RunnableLambda(join_and_remember, afunc=ajoin_and_remember, name="join")
+
+
 def build(
         model: BaseChatModel,
         tools: dict[str, BaseTool],
         prompts: dict[str, ChatPromptTemplate | str],
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        use_plan_cache: bool = True,
+        stream_join: bool = False,
+        plan_format: str = "text",
+        max_plan_retries: int = 2,
 ):
-    planner: Runnable = build_planner(model, tools, prompts["plan"], prompts["replan"])
-    plan_and_execute: Runnable = build_scheduler(planner)
-    join: Runnable = build_joiner(model, prompts["join"].partial(examples=''))
+    planner: Runnable = build_planner(
+        model, tools, prompts["plan"], prompts["replan"], use_plan_cache=use_plan_cache,
+        plan_format=plan_format, json_plan_description=prompts.get("json_plan", ''))
+    plan_and_execute: Runnable = build_scheduler(planner, max_concurrency=max_concurrency)
+    join: Runnable = build_joiner(model, prompts["join"].partial(examples=''), stream=stream_join)
+    if use_plan_cache:
+        join = _remembering_plans(join)
 
     graph = StateGraph(State)
 
@@ -36,18 +68,33 @@ def build(
     # Assign each node to a state variable to update.
     planner_executor_node = "plan_and_execute"
     joiner_node = "join"
+    over_budget_node = "over_budget"
     graph.add_node(planner_executor_node, plan_and_execute)
     graph.add_node(joiner_node, join)
+    graph.add_node(over_budget_node, over_budget)
 
     # Define edges
-    graph.add_edge(planner_executor_node, joiner_node)
+    # A plan that failed validation is replanned right away, without asking the joiner,
+    # unless it keeps failing; then the joiner decides with the errors in context
+    def should_join(state):
+        messages = state["messages"]
+        if (is_plan_error(messages[-1]) and count_plan_errors(messages) <= max_plan_retries
+                and not UsageManager.exceeded()):
+            return planner_executor_node
+        return joiner_node
+
+    graph.add_conditional_edges(planner_executor_node, should_join)
 
     # This condition determines looping logic
     def should_continue(state):
-        return END if isinstance(state["messages"][-1], AIMessage) else planner_executor_node
+        if isinstance(state["messages"][-1], AIMessage):
+            return END
+        # The joiner asked for a replan the request can't pay for
+        return over_budget_node if UsageManager.exceeded() else planner_executor_node
 
     # Next, we pass in the function that will determine which node is called next.
     graph.add_conditional_edges(joiner_node, should_continue)
+    graph.add_edge(over_budget_node, END)
 
     graph.add_edge(START, planner_executor_node)
     return graph.compile()
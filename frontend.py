@@ -1,3 +1,4 @@
+import json
 import gradio as gr
 import requests
 
@@ -25,14 +26,45 @@ with gr.Blocks() as demo:
     def stream_result(history):
         url = 'http://localhost:8000/test'
         data = {"message": history[-1][0]}
+        tasks = {}  # idx -> line of the progress message
+        answer = ''
+        history.append([None, ''])
         with requests.post(url, json=data, stream=True) as response:
             response.raise_for_status()
-            for chunk in response.iter_content(chunk_size=None):
-                if chunk:
-                    history[-1][1] = chunk.decode('utf-8')
-                    history.append([None, ''])
-                    yield history
-        if history[-1][0] is None:
+            # One JSON event per line (see players/events.py)
+            for line in response.iter_lines(chunk_size=None):
+                if not line:
+                    continue
+                event = json.loads(line)
+                kind = event["type"]
+                if kind == "plan" and event["tool"] != "join":
+                    tasks[event["idx"]] = f'⏳ {event["idx"]}. {event["tool"]}({event["args"]})'
+                elif kind == "task-start":
+                    tasks[event["idx"]] = f'▶️ {event["idx"]}. {event["tool"]}({event["args"]})'
+                elif kind == "task-result":
+                    mark = '❌' if event["error"] else '✅'
+                    observation = event["observation"]
+                    if len(observation) > 200:
+                        observation = observation[:200] + '…'
+                    tasks[event["idx"]] = (f'{mark} {event["idx"]}. {event["tool"]} '
+                                           f'({event["duration"]:.1f}s): {observation}')
+                elif kind == "replan":
+                    tasks[f'replan-{len(tasks)}'] = f'🔁 Replanning: {event["feedback"]}'
+                elif kind == "token":
+                    answer += event["content"]
+                elif kind == "final":
+                    answer = event["content"]
+                elif kind == "usage":
+                    total = event["total"]
+                    tasks["usage"] = f'🧮 {total["total_tokens"]} tokens in {total["calls"]} LLM calls, {event["seconds"]:.1f}s'
+                elif kind == "error":
+                    answer = f'Error: {event["message"]}'
+                else:
+                    continue
+                history[-2][1] = '\n'.join(tasks.values())
+                history[-1][1] = answer
+                yield history
+        if not history[-1][1]:
             history = history[:-1]
         yield history
 
@@ -1,121 +1,295 @@
+import os
 import asyncio
+import logging
 import time
-from typing import AsyncGenerator
-from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, Iterator
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 import uvicorn
 
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from managers.llm_manager import LLM
 from managers.tool_manager import ToolManager
 from managers.prompt_manager import PromptManager
-from conductor import build
+from managers.conductor_manager import ConductorManager
+from managers.worker_manager import WorkerManager
+from managers.cache_manager import CacheManager, SqliteBackend
+from managers.record_manager import RecordManager
+from managers.metric_manager import MetricManager
+from managers.trace_manager import TraceManager
+from managers.profile_manager import ProfileManager, SamplingProfiler
+from managers.usage_manager import UsageManager
+from players import events
+from players.plan_cache import PlanCache
+from players.plan_validator import is_plan_error
 from _demo import prepare
 import agents
 
 
-prepare()
-
-# conductor = build(LLM.get(), ToolManager.data(), PromptManager.get(LLM.name()))
-
-ToolManager.set(agents.get_agent_client("mcp", {
-    "name": "knoxMail_agent",
-    "description": (
-        "knoxMail_agent(input: str, context: Optional[list[str]]) -> str:\n"
-        "- This is a unified interface to a multi-tool agent. It takes a natural language input, interprets the request, and uses internal MCP tools to execute the appropriate actions.\n"
-        "- The agent is equipped with multiple tools (e.g., list unread mails, read mail, send mail, etc.) and can autonomously choose the most suitable tool for the user's intent.\n"
-        " - `query` can be either a simple keyword (e.g. \"latest email\") or a natural language question "
-        "(e.g. \"when did I receive the last email from John?\").\n"
-        " - You cannot handle multiple request in one call. For instance, `knoxMail_agent('get email from John, get email from Jane')` does not work. "
-        "If you need to process multiple request, you need to call them separately like `knoxMail_agent('get email from John')` and then `knoxMail_agent('get email from Jane')`.\n"
-        " - Minimize the number of `mail` actions as much as possible. For instance, instead of calling "
-        "2. knoxMail_agent(\"what is the subject of $1\") and then 3. knoxMail_agent(\"what is the sender of $1\"), "
-        "you MUST call 2. knoxMail_agent(\"what is the subject and sender of $1\") instead, which will reduce the number of mail actions.\n"
-        " - You can optionally provide a list of strings as `context` to help the agent understand the query. "
-        "If there are multiple contexts you need to answer the query, you can provide them as a list of strings.\n"
-        " - `knoxMail_agent` action will not see the output of the previous actions unless you provide it as `context`. "
-        "You MUST provide the output of the previous actions as `context` if you need to refer to them.\n"
-        " - You MUST NEVER provide `search` type action's outputs as a variable in the `query` argument. "
-        "This is because `search` returns a text blob, not a structured email object. "
-        "Therefore, when you need to provide an output of `search` action, you MUST provide it as a `context` argument to `mail` action. "
-        "For example, 1. search(\"John’s email\") and then 2. knoxMail_agent(\"get sender of $1\") is NEVER allowed. "
-        "Use 2. knoxMail_agent(\"get sender of John’s email\", context=[\"$1\"]) instead.\n"
-        " - When you ask a question about `context`, specify the email fields explicitly. "
-        "For instance, \"what is the subject of this email?\" or \"who is the sender?\" instead of vague questions like \"what is this?\"\n"
-    ),
-    "mcp": {
-        "transport": "streamable_http",
-        "url": "http://localhost:8002/mcp",
-    },
-}, LLM.get()))
-
-# ToolManager.set(agents.get_agent_client("mcp", {
-#     "name": "knox_calendar",
-#     "description": (
-#         "knox_calendar(input: str, context: Optional[list[str]]) -> str\n"
-#         "- This is a unified interface to a multi-tool agent. It takes a natural language input, interprets the request, and uses internal MCP tools to execute the appropriate actions.\n"
-#         "- The agent is equipped with multiple tools (e.g., math, weather queries, etc.) and can autonomously choose the most suitable tool for the user's intent.\n"
-#         "- The `input` should be a plain English request describing what the user wants to know or compute.\n"
-#         "- The `context` field is optional and can include supplemental information from previous steps or system memory to improve accuracy.\n"
-#         "- The output is a final answer generated after the agent completes reasoning and tool execution.\n"
-#         "- You should not assume the agent knows everything; it only knows what its tools allow it to observe or compute.\n"
-#         "- Do not include multiple unrelated questions in a single input. The agent processes one task per request.\n"
-#     ),
-#     "mcp": {
-#         "transport": "streamable_http",
-#         "url": "http://localhost:8003/mcp",
-#     },
-# }, LLM.get()))
-
-ToolManager.set(agents.get_agent_client("mcp", {
-    "name": "weather_agent",
-    "description": (
-        "weather_agent(input: str, context: Optional[list[str]]) -> str\n"
-        "- This is a unified interface to a multi-tool agent. It takes a natural language input, interprets the request, and uses internal MCP tools to execute the appropriate actions.\n"
-        "- The agent is equipped with multiple tools (e.g., math, weather queries, etc.) and can autonomously choose the most suitable tool for the user's intent.\n"
-        "- The `input` should be a plain English request describing what the user wants to know or compute.\n"
-        "- The `context` field is optional and can include supplemental information from previous steps or system memory to improve accuracy.\n"
-        "- The output is a final answer generated after the agent completes reasoning and tool execution.\n"
-        "- You should not assume the agent knows everything; it only knows what its tools allow it to observe or compute.\n"
-        "- Do not include multiple unrelated questions in a single input. The agent processes one task per request.\n"
-    ),
-    "mcp": {
-        "transport": "streamable_http",
-        "url": "http://localhost:8001/mcp",
-    },
-}, LLM.get()))
-
-
-async def generate_response(user_message: str) -> AsyncGenerator[bytes, None]:
-    start_time = time.time()
-    conductor = build(LLM.get(), ToolManager.data(), PromptManager.get(LLM.name()))
-    print(f'# Built conductor ({time.time() - start_time:.3f} seconds)')
+logger = logging.getLogger(__name__)
+
+MetricManager.gauge("conductor_requests_in_flight", "Requests being answered")
+MetricManager.histogram("conductor_request_seconds", "Time to answer a request, to the end of the stream")
+MetricManager.histogram("conductor_first_chunk_seconds", "Time to the first event after the start event")
+
+# task-result observations of at least this many bytes are gzipped when the request asks for it
+COMPRESS_MIN_BYTES = int(os.getenv("OBSERVATION_COMPRESS_MIN", 4096))
+
+
+def collect_caches():
+    caches = {"tool": CacheManager.stats(), "llm": LLM.cache_stats(), "conductor": ConductorManager.stats(),
+              "plan": PlanCache.stats()}
+    for cache, stats in caches.items():
+        for event in ("hits", "misses"):
+            if stats is not None:
+                yield (f"conductor_cache_{event}_total", "counter", f"Cache {event} since start", {"cache": cache},
+                       stats[event])
+
+
+MetricManager.collector(collect_caches)
+
+
+def setup():
+    """Register the LLM and the tools. Only the server runs this, tool worker processes don't."""
+    # Per-task diagnostics are DEBUG; below the level they aren't even formatted
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    prepare()
+
+    # Sub-agents are shared downstream services, don't let one request flood them.
+    # Their MCP session pools are sized from these limits too.
+    WorkerManager.configure(limits={"knoxMail_agent": 8, "weather_agent": 8})
+
+    # Repeated calls of read-only tools are served from the result cache (TTL in seconds).
+    # Mail is stateful, so knoxMail_agent is never cached.
+    CacheManager.configure(
+        ttls={"weather_agent": 300, "math": 3600},
+        backend=SqliteBackend(os.path.join(os.getcwd(), '.cache', 'tool_results.sqlite')))
+
+    # No tool registered here is marked cpu_bound (metadata={"cpu_bound": True}, see players/scheduler.py):
+    # the sub-agents wait on I/O, and math waits on the LLM or runs numexpr, which releases the GIL.
+    # Its function is also a closure over the LLM, which can't be sent to a worker process.
+
+    # The sub-agents answer from live mail and weather, so their LLM calls never go through the response cache.
+
+    # conductor = build(LLM.get(), ToolManager.data(), PromptManager.get(LLM.name()))
+
+    ToolManager.set(agents.get_agent_client("mcp", {
+        "name": "knoxMail_agent",
+        "description": (
+            "knoxMail_agent(input: str, context: Optional[list[str]]) -> str:\n"
+            "- This is a unified interface to a multi-tool agent. It takes a natural language input, interprets the request, and uses internal MCP tools to execute the appropriate actions.\n"
+            "- The agent is equipped with multiple tools (e.g., list unread mails, read mail, send mail, etc.) and can autonomously choose the most suitable tool for the user's intent.\n"
+            " - `query` can be either a simple keyword (e.g. \"latest email\") or a natural language question "
+            "(e.g. \"when did I receive the last email from John?\").\n"
+            " - You cannot handle multiple request in one call. For instance, `knoxMail_agent('get email from John, get email from Jane')` does not work. "
+            "If you need to process multiple request, you need to call them separately like `knoxMail_agent('get email from John')` and then `knoxMail_agent('get email from Jane')`.\n"
+            " - Minimize the number of `mail` actions as much as possible. For instance, instead of calling "
+            "2. knoxMail_agent(\"what is the subject of $1\") and then 3. knoxMail_agent(\"what is the sender of $1\"), "
+            "you MUST call 2. knoxMail_agent(\"what is the subject and sender of $1\") instead, which will reduce the number of mail actions.\n"
+            " - You can optionally provide a list of strings as `context` to help the agent understand the query. "
+            "If there are multiple contexts you need to answer the query, you can provide them as a list of strings.\n"
+            " - `knoxMail_agent` action will not see the output of the previous actions unless you provide it as `context`. "
+            "You MUST provide the output of the previous actions as `context` if you need to refer to them.\n"
+            " - You MUST NEVER provide `search` type action's outputs as a variable in the `query` argument. "
+            "This is because `search` returns a text blob, not a structured email object. "
+            "Therefore, when you need to provide an output of `search` action, you MUST provide it as a `context` argument to `mail` action. "
+            "For example, 1. search(\"John’s email\") and then 2. knoxMail_agent(\"get sender of $1\") is NEVER allowed. "
+            "Use 2. knoxMail_agent(\"get sender of John’s email\", context=[\"$1\"]) instead.\n"
+            " - When you ask a question about `context`, specify the email fields explicitly. "
+            "For instance, \"what is the subject of this email?\" or \"who is the sender?\" instead of vague questions like \"what is this?\"\n"
+        ),
+        "mcp": {
+            "transport": "streamable_http",
+            "url": "http://localhost:8002/mcp",
+        },
+    }, LLM.get(cache=False)))
+
+    # ToolManager.set(agents.get_agent_client("mcp", {
+    #     "name": "knox_calendar",
+    #     "description": (
+    #         "knox_calendar(input: str, context: Optional[list[str]]) -> str\n"
+    #         "- This is a unified interface to a multi-tool agent. It takes a natural language input, interprets the request, and uses internal MCP tools to execute the appropriate actions.\n"
+    #         "- The agent is equipped with multiple tools (e.g., math, weather queries, etc.) and can autonomously choose the most suitable tool for the user's intent.\n"
+    #         "- The `input` should be a plain English request describing what the user wants to know or compute.\n"
+    #         "- The `context` field is optional and can include supplemental information from previous steps or system memory to improve accuracy.\n"
+    #         "- The output is a final answer generated after the agent completes reasoning and tool execution.\n"
+    #         "- You should not assume the agent knows everything; it only knows what its tools allow it to observe or compute.\n"
+    #         "- Do not include multiple unrelated questions in a single input. The agent processes one task per request.\n"
+    #     ),
+    #     "mcp": {
+    #         "transport": "streamable_http",
+    #         "url": "http://localhost:8003/mcp",
+    #     },
+    # }, LLM.get(cache=False)))
+
+    ToolManager.set(agents.get_agent_client("mcp", {
+        "name": "weather_agent",
+        "description": (
+            "weather_agent(input: str, context: Optional[list[str]]) -> str\n"
+            "- This is a unified interface to a multi-tool agent. It takes a natural language input, interprets the request, and uses internal MCP tools to execute the appropriate actions.\n"
+            "- The agent is equipped with multiple tools (e.g., math, weather queries, etc.) and can autonomously choose the most suitable tool for the user's intent.\n"
+            "- The `input` should be a plain English request describing what the user wants to know or compute.\n"
+            "- The `context` field is optional and can include supplemental information from previous steps or system memory to improve accuracy.\n"
+            "- The output is a final answer generated after the agent completes reasoning and tool execution.\n"
+            "- You should not assume the agent knows everything; it only knows what its tools allow it to observe or compute.\n"
+            "- Do not include multiple unrelated questions in a single input. The agent processes one task per request.\n"
+        ),
+        "mcp": {
+            "transport": "streamable_http",
+            "url": "http://localhost:8001/mcp",
+        },
+    }, LLM.get(cache=False)))
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    setup()
+    if any((tool.metadata or {}).get("cpu_bound") for tool in ToolManager.data().values()):
+        # Pay for starting the worker processes before the first request
+        await asyncio.to_thread(WorkerManager.warm_up)
+    yield
+    WorkerManager.shutdown()
+    TraceManager.shutdown()
+
+
+# How the joiner and the plan validator hand feedback to the replanner
+CONTEXT_PREFIX = 'Context from last attempt: '
+
+
+def step_events_of(step_name: str, messages: list) -> Iterator[dict]:
+    """replan and final events of a node's update; the tasks were streamed while they ran."""
+    if step_name == "plan_and_execute":
+        errors = [message.content.removeprefix(CONTEXT_PREFIX) for message in messages if is_plan_error(message)]
+        if errors:
+            yield {"type": events.REPLAN, "reason": "invalid_plan", "feedback": '\n'.join(errors)}
+        return
+    thoughts = [message.content.removeprefix('Thought: ') for message in messages
+                if isinstance(message, AIMessage) and message.content.startswith('Thought: ')]
+    thought = {"thought": thoughts[0]} if thoughts else {}
+    last = messages[-1] if messages else None
+    if isinstance(last, SystemMessage):
+        yield {"type": events.REPLAN, "reason": "joiner", "feedback": last.content.removeprefix(CONTEXT_PREFIX), **thought}
+    elif isinstance(last, AIMessage) and not last.content.startswith('Thought: '):
+        yield {"type": events.FINAL, "content": last.content, **thought}
+
+
+async def generate_response(user_message: str) -> AsyncGenerator[dict, None]:
+    MetricManager.add("conductor_requests_in_flight", 1)
+    try:
+        # Every LLM call of the request, sub-agents included, is counted against its budget
+        with TraceManager.span("request") as span, UsageManager.use(UsageManager.start()):
+            async for event in _generate_response(user_message):
+                yield event
+        MetricManager.observe("conductor_request_seconds", span.duration)
+    finally:
+        MetricManager.add("conductor_requests_in_flight", -1)
+
+
+async def _generate_response(user_message: str) -> AsyncGenerator[dict, None]:
     start_time = time.time()
-    print('\n########## START ##########\n')
+    # Sent before the conductor is looked up, so the client has the headers and a first event right away
+    yield {"type": events.START}
+    options = {"stream_join": True, "plan_format": os.getenv("PLAN_FORMAT", "text")}
+    if RecordManager.enabled():
+        # A cached plan would leave the planner call out of the recording
+        options["use_plan_cache"] = False
     n_steps = 0
-    yield '<< Processing >>'
-    await asyncio.sleep(0.5)
-    for step in conductor.stream({"messages": [HumanMessage(content=user_message)]}):
-        n_steps += 1
-        step_name = list(step)[0]
-        messages = step[step_name]["messages"]
-        print(f'\n#### [STEP-{n_steps}-{step_name}] ####')
-        for i, msg in enumerate(messages):
-            print(f'# [message-{i}] {msg}')
-        yield str(messages).encode('utf-8')
-        await asyncio.sleep(0.5)
-    yield '<< Done >>'
-    print(f'\n########## DONE ({time.time() - start_time:.3f} seconds) ##########\n')
+    first_event = True
+    recorder = None
+    # Everything after the start event fails into an error event, so the client never waits on a dead stream
+    try:
+        conductor = ConductorManager.get(
+            LLM.get(), ToolManager.data(), PromptManager.get(LLM.name()), LLM.name(), **options)
+        logger.info('# Got conductor (%.3f seconds, %s)', time.time() - start_time, ConductorManager.stats())
 
+        start_time = time.time()
+        logger.info('########## START ##########')
+        # With RECORD_DIR set, the LLM calls and tool invocations of the request are saved as a cassette
+        # that benchmarks/replay.py can run again offline
+        recorder = RecordManager.start(user_message, options, ToolManager.data())
+        async for mode, step in conductor.astream(
+                {"messages": [HumanMessage(content=user_message)]}, stream_mode=["updates", "custom"],
+                config={"callbacks": [recorder]} if recorder is not None else None):
+            if mode == "custom":
+                # Tasks from the scheduler, tokens of the final response from the joiner
+                new_events = [step] if step.get("type") in events.CUSTOM_EVENTS else []
+            else:
+                n_steps += 1
+                step_name = list(step)[0]
+                messages = step[step_name]["messages"]
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('#### [STEP-%d-%s] ####', n_steps, step_name)
+                    for i, msg in enumerate(messages):
+                        logger.debug('# [message-%d] %s', i, msg)
+                new_events = list(step_events_of(step_name, messages))
+            if first_event and new_events:
+                first_event = False
+                MetricManager.observe("conductor_first_chunk_seconds", time.time() - start_time)
+            for event in new_events:
+                yield event
+    except Exception as e:
+        logger.exception('# Request failed')
+        yield {"type": events.ERROR, "message": repr(e)}
+    usage = UsageManager.current().report()
+    yield {"type": events.USAGE, **usage}
+    logger.info('########## DONE (%.3f seconds, %d tokens%s) ##########', time.time() - start_time,
+                usage["total"]["total_tokens"], f', budget exceeded: {usage["exceeded"]}' if "exceeded" in usage else '')
+    if recorder is not None:
+        path = await asyncio.to_thread(RecordManager.save, recorder)
+        logger.info('# Recorded %s (%s)', path, RecordManager.stats())
 
-app = FastAPI()
+
+async def encode_events(
+        stream: AsyncGenerator[dict, None], sse: bool, compress_min: int | None) -> AsyncGenerator[bytes, None]:
+    # The server pulls the next event once the previous one was handed to the socket,
+    # so a slow client slows down reading the graph instead of growing a buffer here
+    async for event in stream:
+        yield events.encode(event, sse, compress_min)
+
+
+async def profile_response(chunks: AsyncGenerator[bytes, None], profiler: SamplingProfiler) -> AsyncGenerator[bytes, None]:
+    profiler.start()
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        profiler.stop()
+        paths = await asyncio.to_thread(ProfileManager.save, profiler)
+        logger.info('# Profiled %s (%.3f seconds, %d samples)', ' '.join(paths), profiler.duration, profiler.count)
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.post('/test')
 async def test(request: Request):
+    """Answer {"message": ...} with a stream of events (see players/events.py).
+
+    NDJSON by default; Server-Sent Events with "format": "sse" or Accept: text/event-stream.
+    With "compress": true, large task-result observations are sent gzipped and base64 encoded.
+    """
     data = await request.json()
-    return StreamingResponse(generate_response(data.get("message", '')), media_type='text/plain')
+    sse = data.get("format") == "sse" or 'text/event-stream' in request.headers.get("accept", '')
+    response = encode_events(
+        generate_response(data.get("message", '')), sse, COMPRESS_MIN_BYTES if data.get("compress") else None)
+    # Proxies (nginx) would otherwise buffer the stream
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    # Opt in per request with the PROFILE_TOKEN value (see managers/profile_manager.py)
+    token = request.headers.get("X-Profile") or request.query_params.get("profile")
+    if token is not None:
+        if not ProfileManager.authorized(token):
+            raise HTTPException(status_code=403, detail="Profiling is not allowed")
+        profiler = ProfileManager.profiler()
+        response = profile_response(response, profiler)
+        headers["X-Profile-Id"] = profiler.name
+    return StreamingResponse(
+        response, media_type='text/event-stream' if sse else 'application/x-ndjson', headers=headers)
+
+
+@app.get('/metrics')
+async def metrics():
+    return PlainTextResponse(MetricManager.render(), media_type='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,197 @@
+################################################################################
+# Caches: tool results
+################################################################################
+
+import os
+import re
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+
+class MemoryBackend:
+    """Bounded in-memory store with LRU eviction."""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._data: OrderedDict[str, Tuple[Any, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                self._data.move_to_end(key)
+            return item
+
+    def set(self, key: str, value: Any, expires_at: float):
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SqliteBackend:
+    """Bounded local on-disk store with LRU eviction, shared across restarts."""
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            ' key TEXT PRIMARY KEY, value BLOB, expires_at REAL, accessed_at REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)')
+        self._size = self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        with self._lock:
+            row = self._conn.execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        return pickle.loads(row[0]), row[1]
+
+    def set(self, key: str, value: Any, expires_at: float):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            exists = self._conn.execute('SELECT 1 FROM cache WHERE key = ?', (key,)).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, blob, expires_at, time.time()))
+            if not exists:
+                self._size += 1
+            if self._size > self.max_entries:
+                excess = self._size - self.max_entries
+                self._conn.execute(
+                    'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)',
+                    (excess,))
+                self._size -= excess
+                self.evictions += excess
+
+    def delete(self, key: str):
+        with self._lock:
+            if self._conn.execute('DELETE FROM cache WHERE key = ?', (key,)).rowcount:
+                self._size -= 1
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM cache')
+            self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+
+def make_key(*parts: Any) -> str:
+    data = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+# Custom callback event for a tool call answered from the cache, which never reaches the tool's callbacks
+CACHE_HIT_EVENT = "tool_cache_hit"
+
+# Tools are not cached unless they opt in with a TTL (in seconds)
+_TTLS: dict[str, float] = {}
+_BACKEND: MemoryBackend | SqliteBackend = MemoryBackend()
+_STATS: dict[str, int] = {"hits": 0, "misses": 0, "expired": 0, "stores": 0, "errors": 0}
+_LOCK = threading.Lock()
+
+# Failures that tools return instead of raising: "ERROR (...)", "Error: ...", or the repr of an exception.
+# They are likely transient, so they are never replayed from the cache.
+_ERROR_PATTERN = re.compile(r'^\s*(ERROR\b|Error:|\w*(Error|Exception)\()')
+
+
+def is_error_result(result: Any) -> bool:
+    return isinstance(result, str) and _ERROR_PATTERN.match(result) is not None
+
+
+class CacheManager:
+    @staticmethod
+    def configure(
+            ttls: dict[str, float] | None = None,
+            backend: MemoryBackend | SqliteBackend | None = None,
+    ):
+        global _TTLS, _BACKEND
+        if ttls is not None:
+            _TTLS = dict(ttls)
+        if backend is not None:
+            _BACKEND = backend
+
+    @staticmethod
+    def cacheable(tool_name: str) -> bool:
+        global _TTLS
+        return tool_name in _TTLS
+
+    @staticmethod
+    def lookup(tool_name: str, args: Any) -> Tuple[bool, Any]:
+        """Return (hit, result) for a call of `tool_name` with resolved `args`."""
+        global _TTLS, _BACKEND, _STATS
+        if tool_name not in _TTLS:
+            return False, None
+        key = make_key(tool_name, args)
+        item = _BACKEND.get(key)
+        if item is None:
+            with _LOCK:
+                _STATS["misses"] += 1
+            return False, None
+        value, expires_at = item
+        # Failures stored by earlier versions are dropped like expired entries
+        if expires_at < time.time() or is_error_result(value):
+            _BACKEND.delete(key)
+            with _LOCK:
+                _STATS["expired"] += 1
+                _STATS["misses"] += 1
+            return False, None
+        with _LOCK:
+            _STATS["hits"] += 1
+        return True, value
+
+    @staticmethod
+    def store(tool_name: str, args: Any, result: Any):
+        global _TTLS, _BACKEND, _STATS
+        if tool_name not in _TTLS:
+            return
+        if is_error_result(result):
+            with _LOCK:
+                _STATS["errors"] += 1
+            return
+        _BACKEND.set(make_key(tool_name, args), result, time.time() + _TTLS[tool_name])
+        with _LOCK:
+            _STATS["stores"] += 1
+
+    @staticmethod
+    def clear():
+        global _BACKEND
+        _BACKEND.clear()
+
+    @staticmethod
+    def stats() -> dict[str, int]:
+        global _BACKEND, _STATS
+        with _LOCK:
+            stats = dict(_STATS)
+        return dict(stats, evictions=_BACKEND.evictions, size=len(_BACKEND))
@@ -0,0 +1,85 @@
+################################################################################
+# Conductors: compiled graph cache
+################################################################################
+
+import hashlib
+import threading
+from langchain_core.language_models import BaseChatModel
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable
+from langchain_core.tools import BaseTool
+from conductor import build
+from managers.tool_manager import ToolManager
+from managers.trace_manager import TraceManager
+
+
+_DATA: dict[str, Runnable] = {}
+_STATS: dict[str, int] = {"hits": 0, "misses": 0, "invalidations": 0}
+_LOCK = threading.Lock()
+
+
+def fingerprint(
+        model: BaseChatModel,
+        tools: dict[str, BaseTool],
+        prompts: dict[str, ChatPromptTemplate | str],
+        prompt_version: str = '',
+        **options,
+) -> str:
+    """Identify a conductor by its model, registered tool set, prompt version and build options.
+
+    The tools are identified by name and the registry version rather than by
+    id(), which can be reused once a replaced tool is garbage collected.
+    """
+    model_name = getattr(model, "model_name", None) or getattr(model, "model", None) or model.name
+    parts = [
+        f'{type(model).__name__}:{model_name}:{id(model)}',
+        f'tools@{ToolManager.version()}:{",".join(sorted(tools))}',
+        f'{prompt_version}:{id(prompts)}',
+        *(f'{key}={value!r}' for key, value in sorted(options.items())),
+    ]
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+class ConductorManager:
+    @staticmethod
+    def get(
+            model: BaseChatModel,
+            tools: dict[str, BaseTool],
+            prompts: dict[str, ChatPromptTemplate | str],
+            prompt_version: str = '',
+            **options,
+    ) -> Runnable:
+        global _DATA, _STATS
+        key = fingerprint(model, tools, prompts, prompt_version, **options)
+        conductor = _DATA.get(key)
+        if conductor is not None:
+            _STATS["hits"] += 1
+            return conductor
+        with _LOCK:
+            # Another request may have built it while we were waiting
+            conductor = _DATA.get(key)
+            if conductor is not None:
+                _STATS["hits"] += 1
+                return conductor
+            _STATS["misses"] += 1
+            with TraceManager.span("conductor.build"):
+                conductor = build(model, tools, prompts, **options)
+            _DATA[key] = conductor
+        return conductor
+
+    @staticmethod
+    def clear():
+        global _DATA, _STATS
+        with _LOCK:
+            if _DATA:
+                _STATS["invalidations"] += 1
+            _DATA.clear()
+
+    @staticmethod
+    def stats() -> dict[str, int]:
+        global _DATA, _STATS
+        return dict(_STATS, size=len(_DATA))
+
+
+# Any change in the tool registry makes the compiled conductors stale
+ToolManager.subscribe(ConductorManager.clear)
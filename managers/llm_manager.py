@@ -2,26 +2,164 @@
 # LLM
 ################################################################################
 
+import os
+from typing import Any, Iterator, AsyncIterator
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
 from langchain_core.language_models import BaseChatModel
+from langchain_core.load import dumps
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
 from langchain_openai import ChatOpenAI
+from pydantic import Field
+from managers.cache_manager import SqliteBackend, make_key
+from managers.trace_manager import TraceCallbackHandler
+from managers.usage_manager import BudgetCallbackHandler, UsageCallbackHandler
+
+
+class LLMCache(BaseCache):
+    """Exact-match response cache keyed by model, rendered messages and bound tools."""
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        self.backend = SqliteBackend(path, max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, prompt: str, llm_string: str) -> RETURN_VAL_TYPE | None:
+        item = self.backend.get(make_key(prompt, llm_string))
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return item[0]
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        self.backend.set(make_key(prompt, llm_string), return_val, float('inf'))
+
+    def clear(self, **kwargs: Any) -> None:
+        self.backend.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.backend.evictions, "size": len(self.backend)}
+
+
+class _CachedChatOpenAI(ChatOpenAI):
+    """ChatOpenAI whose calls, streamed or not, go through the response cache.
+
+    BaseChatModel only consults its own cache on invoke, and an invoke that
+    streams internally would then be looked up again in _stream. So the cache
+    is kept out of BaseChatModel.cache and used here only, once per call.
+    """
+
+    response_cache: LLMCache | None = Field(default=None, exclude=True)
+
+    def _cache_key(self, messages: list[BaseMessage], stop: list[str] | None, **kwargs: Any):
+        if self.response_cache is None:
+            return None
+        normalized = [m.model_copy(update={"id": None}) if getattr(m, "id", None) else m for m in messages]
+        return dumps(normalized), self._get_llm_string(stop=stop, **kwargs)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        key = self._cache_key(messages, stop, **kwargs)
+        cached = self.response_cache.lookup(*key) if key else None
+        if cached:
+            return _to_result(cached)
+        result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        if key:
+            self.response_cache.update(*key, result.generations)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        key = self._cache_key(messages, stop, **kwargs)
+        cached = self.response_cache.lookup(*key) if key else None
+        if cached:
+            return _to_result(cached)
+        result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        if key:
+            self.response_cache.update(*key, result.generations)
+        return result
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        key = self._cache_key(messages, stop, **kwargs)
+        cached = self.response_cache.lookup(*key) if key else None
+        if cached:
+            yield ChatGenerationChunk(message=_to_chunk(cached[0].message))
+            return
+        chunks = []
+        for chunk in super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+        if key and chunks:
+            self.response_cache.update(*key, [_to_generation(chunks)])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        key = self._cache_key(messages, stop, **kwargs)
+        cached = self.response_cache.lookup(*key) if key else None
+        if cached:
+            yield ChatGenerationChunk(message=_to_chunk(cached[0].message))
+            return
+        chunks = []
+        async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+        if key and chunks:
+            self.response_cache.update(*key, [_to_generation(chunks)])
+
+
+def _to_chunk(message: BaseMessage) -> AIMessageChunk:
+    # Cache hits don't spend tokens
+    return AIMessageChunk(**message.model_dump(exclude={"type", "tool_call_chunks", "usage_metadata"}))
+
+
+def _to_result(generations: list[ChatGeneration]) -> ChatResult:
+    # Cache hits don't spend tokens
+    message = generations[0].message.model_copy(update={"usage_metadata": None})
+    return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def _to_generation(chunks: list[ChatGenerationChunk]) -> ChatGeneration:
+    merged = chunks[0]
+    for chunk in chunks[1:]:
+        merged += chunk
+    return ChatGeneration(message=merged.message, generation_info=merged.generation_info)
 
 
 # TODO: simple singleton instance
 _LLM: BaseChatModel
+_LLM_NO_CACHE: BaseChatModel
+_CACHE: LLMCache | None = None
 
 
 class LLM:
     @staticmethod
     def set(*args, **kwargs):
-        global _LLM
-        _LLM = ChatOpenAI(*args, **kwargs)
+        global _LLM, _LLM_NO_CACHE, _CACHE
+        # Only deterministic calls can be answered from the cache
+        if kwargs.get("temperature") == 0 and os.getenv("LLM_CACHE", "1") != "0":
+            if _CACHE is None:
+                _CACHE = LLMCache(
+                    os.getenv("LLM_CACHE_PATH", os.path.join(os.getcwd(), '.cache', 'llm.sqlite')),
+                    int(os.getenv("LLM_CACHE_SIZE", 10000)))
+            kwargs.setdefault("response_cache", _CACHE)
+        # A span per call, under the stage or task that made it, and its tokens counted against the request
+        kwargs.setdefault("callbacks", [BudgetCallbackHandler(), TraceCallbackHandler(), UsageCallbackHandler()])
+        # Streamed calls (the planner, the joiner) only report tokens when asked to
+        kwargs.setdefault("stream_usage", os.getenv("LLM_STREAM_USAGE", "1") != "0")
+        _LLM = _CachedChatOpenAI(*args, **kwargs)
+        _LLM_NO_CACHE = _LLM.model_copy(update={"response_cache": None})
 
     @staticmethod
-    def get():
-        global _LLM
-        return _LLM
+    def get(cache: bool = True):
+        """The shared model; callers that need a fresh answer pass cache=False."""
+        global _LLM, _LLM_NO_CACHE
+        return _LLM if cache else _LLM_NO_CACHE
 
     @staticmethod
     def name():
         global _LLM
         return _LLM.name
+
+    @staticmethod
+    def cache_stats() -> dict[str, int] | None:
+        global _CACHE
+        return _CACHE.stats() if _CACHE is not None else None
@@ -0,0 +1,135 @@
+################################################################################
+# Metrics: histograms, gauges and counters in the Prometheus text format
+################################################################################
+
+import bisect
+import threading
+from typing import Callable, Dict, Iterable, Tuple
+
+
+# Seconds, from a cached tool call to a long sub-agent conversation
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+# A collector returns (name, type, help, labels, value) samples, read when /metrics is scraped
+Sample = Tuple[str, str, str, Dict[str, str], float]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        # Must be called with the lock held
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_HELP: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+_HISTOGRAMS: Dict[str, Dict[Labels, Histogram]] = {}
+_BUCKETS: Dict[str, Tuple[float, ...]] = {}
+_GAUGES: Dict[str, Dict[Labels, float]] = {}
+_COLLECTORS: list[Callable[[], Iterable[Sample]]] = []
+_LOCK = threading.Lock()
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _format_labels(labels: Labels, extra: str = '') -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class MetricManager:
+    @staticmethod
+    def histogram(name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        with _LOCK:
+            _HELP.setdefault(name, ("histogram", help))
+            _HISTOGRAMS.setdefault(name, {})
+            _BUCKETS.setdefault(name, buckets)
+
+    @staticmethod
+    def gauge(name: str, help: str):
+        with _LOCK:
+            _HELP.setdefault(name, ("gauge", help))
+            _GAUGES.setdefault(name, {})
+
+    @staticmethod
+    def counter(name: str, help: str):
+        """A gauge that only goes up, through add()."""
+        with _LOCK:
+            _HELP.setdefault(name, ("counter", help))
+            _GAUGES.setdefault(name, {})
+
+    @staticmethod
+    def observe(name: str, value: float, **labels):
+        key = _labels(labels)
+        with _LOCK:
+            series = _HISTOGRAMS[name]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(_BUCKETS[name])
+            histogram.observe(value)
+
+    @staticmethod
+    def add(name: str, amount: float, **labels):
+        key = _labels(labels)
+        with _LOCK:
+            series = _GAUGES[name]
+            series[key] = series.get(key, 0.0) + amount
+
+    @staticmethod
+    def set(name: str, value: float, **labels):
+        with _LOCK:
+            _GAUGES[name][_labels(labels)] = value
+
+    @staticmethod
+    def collector(collect: Callable[[], Iterable[Sample]]):
+        """Register a function whose samples are read at scrape time."""
+        with _LOCK:
+            _COLLECTORS.append(collect)
+
+    @staticmethod
+    def render() -> str:
+        """Everything, in the Prometheus text exposition format."""
+        lines = []
+        with _LOCK:
+            collectors = list(_COLLECTORS)
+            for name, series in _HISTOGRAMS.items():
+                lines += [f'# HELP {name} {_HELP[name][1]}', f'# TYPE {name} histogram']
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                        cumulative += count
+                        le = 'le="' + ('+Inf' if bound == float('inf') else repr(bound)) + '"'
+                        lines.append(f'{name}_bucket{_format_labels(labels, le)} {cumulative}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum!r}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+            for name, series in _GAUGES.items():
+                lines += [f'# HELP {name} {_HELP[name][1]}', f'# TYPE {name} {_HELP[name][0]}']
+                lines += [f'{name}{_format_labels(labels)} {_format_value(value)}' for labels, value in sorted(series.items())]
+        samples: Dict[str, list] = {}
+        for collect in collectors:
+            for name, kind, help, labels, value in collect():
+                samples.setdefault(name, [(kind, help)]).append((_labels(labels), value))
+        for name, (header, *values) in samples.items():
+            lines += [f'# HELP {name} {header[1]}', f'# TYPE {name} {header[0]}']
+            lines += [f'{name}{_format_labels(labels)} {_format_value(value)}' for labels, value in values]
+        return '\n'.join(lines) + '\n'
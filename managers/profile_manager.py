@@ -0,0 +1,181 @@
+################################################################################
+# Profiles: on-demand sampling of a request
+################################################################################
+#
+# A request opts in with the PROFILE_TOKEN value in the X-Profile header (or
+# the profile query parameter); without PROFILE_TOKEN profiling is off. While
+# the request runs, a sampler thread reads the Python stack of every thread
+# of the process (the event loop, the tool pool, the sub-agents' loop) every
+# PROFILE_INTERVAL seconds. Threads parked in an idle pool or an empty event
+# loop are left out. Other requests running at the same time show up too, so
+# profile on a quiet instance when the numbers matter.
+#
+# Each profile is written to PROFILE_DIR as <id>.speedscope.json (open it in
+# https://www.speedscope.app, one flamegraph per thread) and <id>.txt with the
+# top functions by self and total time. Requests that don't opt in only pay
+# for the header lookup.
+
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# (qualified name, file, first line) of a function
+Frame = Tuple[str, str, int]
+Stack = Tuple[Frame, ...]
+
+# Leaf frames of threads that are waiting for work, not for anyone's request
+_IDLE_LEAVES = {
+    ("_worker", "thread.py"),  # concurrent.futures pool thread blocked on its queue
+    ("EpollSelector.select", "selectors.py"),  # event loop with nothing ready
+    ("KqueueSelector.select", "selectors.py"),
+    ("SelectSelector.select", "selectors.py"),
+}
+
+
+def _stack(frame) -> Stack:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_qualname, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def _is_idle(stack: Stack) -> bool:
+    name, filename, _ = stack[-1]
+    return (name, os.path.basename(filename)) in _IDLE_LEAVES
+
+
+class SamplingProfiler:
+    """Wall-clock stacks of every thread, sampled from a daemon thread."""
+
+    def __init__(self, name: str, interval: float = 0.005):
+        self.name = name
+        self.interval = interval
+        self.samples: Dict[str, Counter] = defaultdict(Counter)  # thread name -> stack -> seconds
+        self.start_time: Optional[float] = None
+        self.duration = 0.0
+        self.count = 0
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration = time.perf_counter() - self.start_time
+
+    def _run(self):
+        own = threading.get_ident()
+        last = time.perf_counter()
+        while not self._stopped.wait(self.interval):
+            now = time.perf_counter()
+            # The time since the previous sample, which can be longer than the interval under load
+            weight, last = now - last, now
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = _stack(frame)
+                if stack and not _is_idle(stack):
+                    self.samples[names.get(ident, str(ident))][stack] += weight
+            self.count += 1
+
+    def speedscope(self) -> dict:
+        frames: List[dict] = []
+        index: Dict[Frame, int] = {}
+        profiles = []
+        for thread, stacks in sorted(self.samples.items()):
+            samples, weights = [], []
+            for stack, seconds in stacks.items():
+                for frame in stack:
+                    if frame not in index:
+                        index[frame] = len(frames)
+                        frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                samples.append([index[frame] for frame in stack])
+                weights.append(seconds)
+            profiles.append({
+                "type": "sampled", "name": thread, "unit": "seconds",
+                "startValue": 0, "endValue": sum(weights), "samples": samples, "weights": weights,
+            })
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": self.name, "exporter": "managers/profile_manager.py",
+            "shared": {"frames": frames}, "profiles": profiles,
+        }
+
+    def summary(self, top: int = 25) -> str:
+        self_time, total_time = Counter(), Counter()
+        for stacks in self.samples.values():
+            for stack, seconds in stacks.items():
+                self_time[stack[-1]] += seconds
+                # Recursion counts once per sample
+                for frame in set(stack):
+                    total_time[frame] += seconds
+        lines = [f'Profile {self.name}: {self.duration:.3f}s, {self.count} samples every {self.interval * 1e3:g}ms, '
+                 f'{len(self.samples)} busy thread(s)']
+        for title, counter in (("self", self_time), ("total", total_time)):
+            lines += ['', f'Top functions by {title} time (seconds summed over threads):']
+            for (name, filename, line), seconds in counter.most_common(top):
+                lines.append(f'{seconds:>9.3f}s  {name}  ({_short(filename)}:{line})')
+        return '\n'.join(lines) + '\n'
+
+
+def _short(filename: str) -> str:
+    for prefix in sorted({os.getcwd(), *sys.path}, key=len, reverse=True):
+        if prefix and filename.startswith(prefix + os.sep):
+            return filename[len(prefix) + 1:]
+    return filename
+
+
+_TOKEN: Optional[str] = os.getenv("PROFILE_TOKEN") or None
+_DIR: str = os.getenv("PROFILE_DIR", os.path.join(os.getcwd(), '.cache', 'profiles'))
+_INTERVAL: float = float(os.getenv("PROFILE_INTERVAL", 0.005))
+
+
+class ProfileManager:
+    @staticmethod
+    def configure(token: Optional[str] = None, directory: Optional[str] = None, interval: Optional[float] = None):
+        global _TOKEN, _DIR, _INTERVAL
+        if token is not None:
+            _TOKEN = token or None
+        if directory is not None:
+            _DIR = directory
+        if interval is not None:
+            _INTERVAL = interval
+
+    @staticmethod
+    def authorized(token: Optional[str]) -> bool:
+        """Whether `token` allows profiling; always False while no PROFILE_TOKEN is set."""
+        return _TOKEN is not None and token is not None and hmac.compare_digest(token.encode(), _TOKEN.encode())
+
+    @staticmethod
+    def profiler() -> SamplingProfiler:
+        return SamplingProfiler(time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8], _INTERVAL)
+
+    @staticmethod
+    def save(profiler: SamplingProfiler) -> Tuple[str, str]:
+        """Write the speedscope file and the summary; returns their paths."""
+        os.makedirs(_DIR, exist_ok=True)
+        base = os.path.join(_DIR, profiler.name)
+        with open(base + '.speedscope.json', 'w', encoding='utf-8') as f:
+            json.dump(profiler.speedscope(), f)
+        with open(base + '.txt', 'w', encoding='utf-8') as f:
+            f.write(profiler.summary())
+        return base + '.speedscope.json', base + '.txt'
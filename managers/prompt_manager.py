@@ -27,11 +27,19 @@ _replan: str = \
     ' - In the Current Plan, you should NEVER repeat the actions that are already executed in the Previous Plan.\n' \
     ' - You must continue the task index from the end of the previous one. Do not repeat task indices.'
 
+# Appended to the plan prompt when the planner writes JSON instead of a numbered list
+_json_plan: str = \
+    'Instead of the numbered list, write each action as one JSON object on its own line, and nothing else:\n' \
+    '{"idx": 1, "tool": "<action name>", "args": {"<arg_name>": <value>, ...}, "thought": "<optional reasoning>"}\n' \
+    ' - "args" holds the keyword arguments of the action, as JSON values.\n' \
+    ' - To use the output of a previous action, write "$id" inside a string value, e.g. {"context": ["$1"]}.\n' \
+    ' - The last action is always {"idx": <id>, "tool": "join", "args": {}}.'
+
 
 # TODO: simple memory DB
 _default_key = "default"
 _DATA: dict[str, dict[str, ChatPromptTemplate | str]] = {
-    "default": {"plan": _plan, "replan": _replan, "join": _join},
+    "default": {"plan": _plan, "replan": _replan, "json_plan": _json_plan, "join": _join},
 }
 
 
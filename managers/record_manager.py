@@ -0,0 +1,266 @@
+################################################################################
+# Records: cassettes of LLM calls and tool invocations
+################################################################################
+#
+# A cassette is a gzip'd JSON-lines file: a header line (query, conductor
+# options, tool schemas, duration) followed by one line per LLM call or tool
+# invocation, in start order. Times are seconds from the start of the request.
+#
+#   {"type": "llm", "kind": "plan" | "join" | "nested", "start": .., "end": ..,
+#    "chunks": [[offset, content, tool_call_chunks], ..], "message": {..}, ..}
+#   {"type": "tool", "name": .., "start": .., "end": .., "inputs": {..}, "output": .., ..}
+#
+# LLM calls and tools that run inside a tool (the math extractor, sub-agents)
+# are recorded with nested=True; replaying the conductor only needs the others.
+
+import os
+import gzip
+import json
+import time
+import uuid
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage, message_to_dict
+from langchain_core.tools import BaseTool
+from managers.cache_manager import CACHE_HIT_EVENT
+
+
+CASSETTE_VERSION = 1
+JOINER_TOOL = "JoinOutputs"
+
+
+def _compact(value: Any) -> Any:
+    # Leave out empty fields, cassettes are mostly message payloads
+    if isinstance(value, dict):
+        return {k: _compact(v) for k, v in value.items() if v not in (None, '', [], {})}
+    if isinstance(value, list):
+        return [_compact(v) for v in value]
+    return value
+
+
+def _message(message: BaseMessage) -> dict:
+    data = message_to_dict(message)
+    fields = data["data"]
+    data["data"] = dict(_compact({k: v for k, v in fields.items() if k not in ("id", "tool_call_chunks")}),
+                        content=fields.get("content", ''))
+    return data
+
+
+def _output(output: Any) -> Any:
+    content = getattr(output, "content", output)
+    return content if isinstance(content, (str, int, float, bool, list, dict)) or content is None else str(content)
+
+
+def _round(t: float) -> float:
+    return round(t, 4)
+
+
+class CassetteRecorder(BaseCallbackHandler):
+    """Collects the LLM calls and tool invocations of one request through LangChain callbacks."""
+
+    run_inline = True
+    raise_error = False
+
+    def __init__(self, query: str, options: dict, tools: Dict[str, BaseTool], full_prompts: bool = False):
+        self.full_prompts = full_prompts
+        self.started = time.perf_counter()
+        self.header = {
+            "version": CASSETTE_VERSION,
+            "id": uuid.uuid4().hex[:12],
+            "created": time.time(),
+            "query": query,
+            "options": options,
+            "tools": {name: _tool_schema(tool) for name, tool in tools.items()},
+        }
+        self.events: List[dict] = []
+        self._runs: Dict[UUID, dict] = {}
+        self._parents: Dict[UUID, Optional[UUID]] = {}
+        self._tool_runs: set = set()
+        self._lock = threading.Lock()
+
+    def _now(self) -> float:
+        return time.perf_counter() - self.started
+
+    def _nested(self, parent_run_id: Optional[UUID]) -> bool:
+        while parent_run_id is not None:
+            if parent_run_id in self._tool_runs:
+                return True
+            parent_run_id = self._parents.get(parent_run_id)
+        return False
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], event: dict):
+        with self._lock:
+            self._parents[run_id] = parent_run_id
+            event["nested"] = self._nested(parent_run_id)
+            if event["type"] == "llm":
+                event["kind"] = "nested" if event["nested"] else "join" if JOINER_TOOL in event["tools"] else "plan"
+            event["start"] = self._now()
+            self._runs[run_id] = event
+            self.events.append(event)
+
+    def _end(self, run_id: UUID, **fields) -> Optional[dict]:
+        with self._lock:
+            event = self._runs.pop(run_id, None)
+            if event is not None:
+                event["end"] = self._now()
+                event.update(fields)
+            return event
+
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs):
+        with self._lock:
+            self._parents[run_id] = parent_run_id
+
+    def on_chat_model_start(self, serialized, messages: List[List[BaseMessage]], *, run_id: UUID,
+                            parent_run_id: Optional[UUID] = None, invocation_params: Optional[dict] = None,
+                            metadata: Optional[dict] = None, **kwargs):
+        tools = [(tool.get("function") or tool).get("name") for tool in (invocation_params or {}).get("tools") or []]
+        prompt = messages[0] if messages else []
+        text = '\n'.join(f'{m.type}: {m.content}' for m in prompt)
+        event = {
+            "type": "llm",
+            "node": (metadata or {}).get("langgraph_node"),
+            "tools": tools,
+            "prompt": {"messages": len(prompt), "chars": len(text),
+                       "hash": hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]},
+            "chunks": [],
+        }
+        if self.full_prompts:
+            event["messages"] = [_message(m) for m in prompt]
+        self._start(run_id, parent_run_id, event)
+
+    def on_llm_new_token(self, token: str, *, chunk=None, run_id: UUID, **kwargs):
+        message = getattr(chunk, "message", None)
+        with self._lock:
+            event = self._runs.get(run_id)
+            if event is None:
+                return
+            item = [_round(self._now() - event["start"]), getattr(message, "content", token) or '']
+            tool_call_chunks = getattr(message, "tool_call_chunks", None)
+            if tool_call_chunks:
+                item.append([_compact(dict(c)) for c in tool_call_chunks])
+            event["chunks"].append(item)
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs):
+        event = self._end(run_id)
+        if event is None:
+            return
+        generation = response.generations[0][0] if response.generations and response.generations[0] else None
+        message = getattr(generation, "message", None)
+        if message is None:
+            return
+        if not event["chunks"]:
+            # Not streamed: the whole message arrived at the end
+            event["message"] = _message(message)
+        if getattr(message, "usage_metadata", None):
+            event["usage"] = dict(message.usage_metadata)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        self._end(run_id, error=repr(error))
+
+    def on_tool_start(self, serialized, input_str: str, *, run_id: UUID, parent_run_id: Optional[UUID] = None,
+                      inputs: Optional[dict] = None, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name")
+        self._start(run_id, parent_run_id, {"type": "tool", "name": name, "inputs": inputs if inputs is not None else input_str})
+        with self._lock:
+            self._tool_runs.add(run_id)
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs):
+        self._end(run_id, output=_output(output))
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        self._end(run_id, error=repr(error))
+
+    def on_custom_event(self, name: str, data: Any, *, run_id: UUID, **kwargs):
+        if name != CACHE_HIT_EVENT:
+            return
+        with self._lock:
+            now = self._now()
+            self.events.append({"type": "tool", "name": data["name"], "inputs": data["inputs"],
+                                "output": _output(data["output"]), "cached": True,
+                                "nested": self._nested(run_id), "start": now, "end": now})
+
+    def dump(self, path: str) -> int:
+        """Write the cassette; returns its size in bytes."""
+        with self._lock:
+            header = dict(self.header, duration=_round(self._now()))
+            events = sorted(self.events, key=lambda e: e["start"])
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            for item in [header] + events:
+                if "start" in item:
+                    item = dict(item, start=_round(item["start"]),
+                                **({"end": _round(item["end"])} if "end" in item else {"incomplete": True}))
+                # Only drop empty fields of the line itself: tool inputs and outputs are kept verbatim
+                item = {k: v for k, v in item.items() if k in ("inputs", "output") or v not in (None, '', [], {})}
+                f.write(json.dumps(item, ensure_ascii=False, separators=(',', ':'), default=str))
+                f.write('\n')
+        return os.path.getsize(path)
+
+
+def _tool_schema(tool: BaseTool) -> dict:
+    schema = tool.tool_call_schema
+    schema = schema if isinstance(schema, dict) else schema.model_json_schema()
+    return {"description": tool.description, "schema": schema, "async": _has_coroutine(tool)}
+
+
+def _has_coroutine(tool: BaseTool) -> bool:
+    return getattr(tool, "coroutine", None) is not None or type(tool)._arun is not BaseTool._arun
+
+
+def load_cassette(path: str) -> Tuple[dict, List[dict]]:
+    """Read a cassette: (header, events)."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    if not lines or lines[0].get("version") != CASSETTE_VERSION:
+        raise ValueError(f'{path} is not a version {CASSETTE_VERSION} cassette')
+    return lines[0], lines[1:]
+
+
+# Recording is off unless a directory is configured (RECORD_DIR)
+_DIRECTORY: Optional[str] = os.getenv("RECORD_DIR") or None
+_FULL_PROMPTS: bool = os.getenv("RECORD_PROMPTS", "0") == "1"
+_STATS: dict[str, int] = {"cassettes": 0, "llm_calls": 0, "tool_calls": 0, "bytes": 0}
+_LOCK = threading.Lock()
+
+
+class RecordManager:
+    @staticmethod
+    def configure(directory: Optional[str] = None, full_prompts: Optional[bool] = None):
+        """Record every request into `directory` (None turns recording off)."""
+        global _DIRECTORY, _FULL_PROMPTS
+        _DIRECTORY = directory
+        if full_prompts is not None:
+            _FULL_PROMPTS = full_prompts
+
+    @staticmethod
+    def enabled() -> bool:
+        return _DIRECTORY is not None
+
+    @staticmethod
+    def start(query: str, options: dict, tools: Dict[str, BaseTool]) -> Optional[CassetteRecorder]:
+        """A recorder to pass as a callback for this request, or None when recording is off."""
+        if _DIRECTORY is None:
+            return None
+        return CassetteRecorder(query, options, tools, full_prompts=_FULL_PROMPTS)
+
+    @staticmethod
+    def save(recorder: Optional[CassetteRecorder]) -> Optional[str]:
+        if recorder is None or _DIRECTORY is None:
+            return None
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(recorder.header["created"]))
+        path = os.path.join(_DIRECTORY, f'{stamp}-{recorder.header["id"]}.jsonl.gz')
+        size = recorder.dump(path)
+        with _LOCK:
+            _STATS["cassettes"] += 1
+            _STATS["llm_calls"] += sum(1 for e in recorder.events if e["type"] == "llm")
+            _STATS["tool_calls"] += sum(1 for e in recorder.events if e["type"] == "tool")
+            _STATS["bytes"] += size
+        return path
+
+    @staticmethod
+    def stats() -> dict[str, int]:
+        with _LOCK:
+            return dict(_STATS)
@@ -2,11 +2,21 @@
 # Tools
 ################################################################################
 
+from typing import Callable
 from langchain_core.tools import BaseTool
 
 
 # TODO: simple memory DB
 _DATA: dict[str, BaseTool] = {}
+_VERSION: int = 0
+_LISTENERS: list[Callable[[], None]] = []
+
+
+def _changed():
+    global _VERSION
+    _VERSION += 1
+    for listener in list(_LISTENERS):
+        listener()
 
 
 class ToolManager:
@@ -14,6 +24,7 @@ class ToolManager:
     def set(tool: BaseTool, name: str = None):
         global _DATA
         _DATA[name or tool.name] = tool
+        _changed()
 
     @staticmethod
     def get(tool: str | BaseTool, default=None) -> BaseTool | None:
@@ -23,9 +34,24 @@ class ToolManager:
     @staticmethod
     def pop(tool: str | BaseTool) -> BaseTool | None:
         global _DATA
-        return _DATA.pop(tool.name if isinstance(tool, BaseTool) else str(tool), None)
+        popped = _DATA.pop(tool.name if isinstance(tool, BaseTool) else str(tool), None)
+        if popped is not None:
+            _changed()
+        return popped
 
     @staticmethod
     def data() -> dict[str, BaseTool]:
         global _DATA
         return dict(_DATA)
+
+    @staticmethod
+    def version() -> int:
+        global _VERSION
+        return _VERSION
+
+    @staticmethod
+    def subscribe(listener: Callable[[], None]):
+        """Register a callback that is called whenever the registry changes."""
+        global _LISTENERS
+        if listener not in _LISTENERS:
+            _LISTENERS.append(listener)
@@ -0,0 +1,244 @@
+################################################################################
+# Traces: spans per stage, exported locally
+################################################################################
+#
+# Spans nest through a context variable, so a tool's span is the child of the
+# task that ran it even on another thread or the sub-agents' background loop
+# (both copy the context). Every finished span is observed in the
+# conductor_span_seconds histogram of /metrics; exporting the spans
+# themselves is optional (TRACE_EXPORTER):
+#   memory          keep the last spans in memory (TraceManager.spans())
+#   jsonl:<path>    append one JSON line per span
+#   log             log each span at DEBUG level
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from managers.metric_manager import MetricManager
+
+
+logger = logging.getLogger(__name__)
+
+# Attributes that become labels of the span histogram; the others would make too many series
+METRIC_LABELS = ("tool", "kind")
+SPAN_METRIC = "conductor_span_seconds"
+MetricManager.histogram(SPAN_METRIC, "Duration of conductor stages (see managers/trace_manager.py)")
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent", "start", "end", "attributes", "error")
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: Dict[str, Any], start: Optional[float] = None):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:8]
+        self.start = time.perf_counter() if start is None else start
+        self.end: Optional[float] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def ancestors(self) -> Iterator["Span"]:
+        span = self.parent
+        while span is not None:
+            yield span
+            span = span.parent
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name, "trace_id": self.trace_id, "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent is not None else None,
+            # Wall clock for readers, from the monotonic clock the durations come from
+            "start": time.time() - (time.perf_counter() - self.start), "duration": self.duration,
+            "attributes": self.attributes, **({"error": self.error} if self.error else {}),
+        }
+
+
+class MemoryExporter:
+    """Keeps the last `max_spans` finished spans."""
+
+    def __init__(self, max_spans: int = 10000):
+        self.spans = deque(maxlen=max_spans)
+
+    def export(self, span: Span):
+        self.spans.append(span.to_dict())
+
+    def shutdown(self):
+        pass
+
+
+class JsonlExporter:
+    """Appends one JSON line per finished span to a local file."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8', buffering=1 << 16)
+        self.lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+            if span.parent is None:
+                # A whole trace is done
+                self.file.flush()
+
+    def shutdown(self):
+        with self.lock:
+            self.file.close()
+
+
+class LogExporter:
+    def export(self, span: Span):
+        logger.debug('# <span> %s %.3fs %s', span.name, span.duration, span.attributes)
+
+    def shutdown(self):
+        pass
+
+
+def _exporter_from_env(spec: str):
+    if spec == "memory":
+        return MemoryExporter()
+    if spec == "log":
+        return LogExporter()
+    if spec.startswith("jsonl:"):
+        return JsonlExporter(spec[len("jsonl:"):])
+    if spec:
+        raise ValueError(f'Unknown TRACE_EXPORTER: {spec}')
+    return None
+
+
+_CURRENT: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+_EXPORTER = _exporter_from_env(os.getenv("TRACE_EXPORTER", ""))
+
+
+def _reset(token):
+    try:
+        _CURRENT.reset(token)
+    except ValueError:
+        # An abandoned async generator is closed from another context, which never saw the span
+        pass
+
+
+class TraceManager:
+    @staticmethod
+    def configure(exporter):
+        """Export finished spans to `exporter` (anything with export(span) and shutdown(); None for no export)."""
+        global _EXPORTER
+        if _EXPORTER is not None and _EXPORTER is not exporter:
+            _EXPORTER.shutdown()
+        _EXPORTER = exporter
+
+    @staticmethod
+    def current() -> Optional[Span]:
+        return _CURRENT.get()
+
+    @staticmethod
+    def start(name: str, parent: Optional[Span] = None, start: Optional[float] = None, **attributes) -> Span:
+        """A span that stays open until finish(); it doesn't become the current span."""
+        return Span(name, parent if parent is not None else _CURRENT.get(), attributes, start)
+
+    @staticmethod
+    def finish(span: Span, error: Optional[BaseException] = None, end: Optional[float] = None):
+        if span.end is not None:
+            return
+        span.end = time.perf_counter() if end is None else end
+        if error is not None:
+            span.error = repr(error)
+        MetricManager.observe(SPAN_METRIC, span.end - span.start, span=span.name,
+                              **{k: span.attributes.get(k) for k in METRIC_LABELS})
+        exporter = _EXPORTER
+        if exporter is not None:
+            exporter.export(span)
+
+    @staticmethod
+    @contextmanager
+    def use(span: Optional[Span]) -> Iterator[Optional[Span]]:
+        """Make `span` the parent of the spans started (or contexts copied) in this block."""
+        token = _CURRENT.set(span)
+        try:
+            yield span
+        finally:
+            _reset(token)
+
+    @staticmethod
+    @contextmanager
+    def span(name: str, **attributes) -> Iterator[Span]:
+        span = TraceManager.start(name, **attributes)
+        token = _CURRENT.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            TraceManager.finish(span, e)
+            raise
+        finally:
+            _reset(token)
+            TraceManager.finish(span)
+
+    @staticmethod
+    def record(name: str, start: float, end: Optional[float] = None, **attributes) -> Span:
+        """A span for something that was timed already, e.g. a wait in a queue."""
+        span = TraceManager.start(name, start=start, **attributes)
+        TraceManager.finish(span, end=end)
+        return span
+
+    @staticmethod
+    def spans() -> List[dict]:
+        """The spans kept by a MemoryExporter, oldest first."""
+        return list(_EXPORTER.spans) if isinstance(_EXPORTER, MemoryExporter) else []
+
+    @staticmethod
+    def shutdown():
+        TraceManager.configure(None)
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """A span per chat model call: planner, joiner, or inside a tool (sub-agents, the math extractor)."""
+
+    run_inline = True
+    raise_error = False
+
+    def __init__(self):
+        self.runs: Dict[UUID, Span] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, invocation_params: Optional[dict] = None,
+                            **kwargs):
+        tools = [(tool.get("function") or tool).get("name") for tool in (invocation_params or {}).get("tools") or []]
+        span = TraceManager.start("llm")
+        if any(s.name == "task" for s in span.ancestors()):
+            kind = "tool"
+        else:
+            kind = "join" if "JoinOutputs" in tools else "plan"
+        span.set(kind=kind, model=(invocation_params or {}).get("model_name") or (invocation_params or {}).get("model"))
+        self.runs[run_id] = span
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs):
+        span = self.runs.get(run_id)
+        if span is not None and "first_token" not in span.attributes:
+            span.set(first_token=time.perf_counter() - span.start)
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs):
+        span = self.runs.pop(run_id, None)
+        if span is not None:
+            TraceManager.finish(span)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        span = self.runs.pop(run_id, None)
+        if span is not None:
+            TraceManager.finish(span, error)
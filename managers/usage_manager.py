@@ -0,0 +1,256 @@
+################################################################################
+# Usage: tokens, cost and budgets per request
+################################################################################
+#
+# Every chat model call made through the shared LLM (the planner, the joiner,
+# and the ones inside tools: sub-agent steps, the math extractor) is counted
+# against the request it runs for, by stage:
+#   plan, replan    planner calls, the first one and the following ones
+#   join            joiner calls
+#   <tool name>     calls made inside a tool
+# Streamed calls only report tokens when the server sends usage
+# (stream_usage); cached answers count as calls with no tokens.
+#
+# A request's budget (REQUEST_MAX_TOKENS, REQUEST_MAX_SECONDS) is checked
+# between steps: once it is spent, the conductor stops replanning and the
+# LLM calls inside tools fail with BudgetExceeded, so sub-agents stop at
+# their next step. The call that crosses the budget still completes.
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, Tuple
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from managers.metric_manager import MetricManager
+from managers.trace_manager import TraceManager
+
+
+logger = logging.getLogger(__name__)
+
+MetricManager.counter("conductor_llm_tokens_total", "Tokens of chat model calls")
+MetricManager.counter("conductor_llm_calls_total", "Chat model calls")
+MetricManager.counter("conductor_budget_exceeded_total", "Requests that ran out of budget")
+
+
+class BudgetExceeded(RuntimeError):
+    pass
+
+
+class RequestUsage:
+    """Token counts, time and cost of one request, by stage."""
+
+    def __init__(self, max_tokens: Optional[int] = None, max_seconds: Optional[float] = None):
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stages: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {"calls": 0, "input_tokens": 0, "output_tokens": 0, "total_tokens": 0, "seconds": 0.0,
+                     "cost": 0.0})
+        self.plans = 0
+        self.exceeded_reason: Optional[str] = None
+
+    def add(self, stage: str, input_tokens: int, output_tokens: int, seconds: float, cost: float):
+        with self.lock:
+            stats = self.stages[stage]
+            stats["calls"] += 1
+            stats["input_tokens"] += input_tokens
+            stats["output_tokens"] += output_tokens
+            stats["total_tokens"] += input_tokens + output_tokens
+            stats["seconds"] += seconds
+            stats["cost"] += cost
+
+    def total_tokens(self) -> int:
+        with self.lock:
+            return sum(stats["total_tokens"] for stats in self.stages.values())
+
+    def exceeded(self) -> Optional[str]:
+        """Why the budget is spent, or None while it isn't."""
+        if self.exceeded_reason is None:
+            budget = reason = None
+            if self.max_tokens is not None and (tokens := self.total_tokens()) >= self.max_tokens:
+                budget, reason = "tokens", f'{tokens} tokens used of {self.max_tokens}'
+            elif self.max_seconds is not None and (elapsed := time.perf_counter() - self.start) >= self.max_seconds:
+                budget, reason = "seconds", f'{elapsed:.1f} seconds spent of {self.max_seconds:g}'
+            if reason is not None:
+                # Once spent, a budget stays spent
+                self.exceeded_reason = reason
+                MetricManager.add("conductor_budget_exceeded_total", 1, budget=budget)
+        return self.exceeded_reason
+
+    def report(self) -> dict:
+        with self.lock:
+            stages = {stage: dict(stats) for stage, stats in self.stages.items()}
+        total = {key: sum(stats[key] for stats in stages.values())
+                 for key in ("calls", "input_tokens", "output_tokens", "total_tokens", "cost")}
+        return {
+            "stages": stages, "total": total, "seconds": time.perf_counter() - self.start,
+            "budget": {"max_tokens": self.max_tokens, "max_seconds": self.max_seconds},
+            **({"exceeded": self.exceeded_reason} if self.exceeded_reason else {}),
+        }
+
+
+def _env_float(name: str) -> Optional[float]:
+    value = os.getenv(name)
+    return float(value) if value else None
+
+
+_CURRENT: ContextVar[Optional[RequestUsage]] = ContextVar("request_usage", default=None)
+_MAX_TOKENS: Optional[int] = int(os.getenv("REQUEST_MAX_TOKENS")) if os.getenv("REQUEST_MAX_TOKENS") else None
+_MAX_SECONDS: Optional[float] = _env_float("REQUEST_MAX_SECONDS")
+# USD per million input and output tokens, by model name: {"gpt-4.1-nano": [0.1, 0.4]}
+_PRICES: Dict[str, Tuple[float, float]] = {
+    model: tuple(price) for model, price in json.loads(os.getenv("LLM_PRICES", "{}")).items()}
+
+
+class UsageManager:
+    @staticmethod
+    def configure(
+            max_tokens: Optional[int] = None,
+            max_seconds: Optional[float] = None,
+            prices: Optional[Dict[str, Tuple[float, float]]] = None,
+    ):
+        """Set the default budget of new requests, and the prices per million tokens by model."""
+        global _MAX_TOKENS, _MAX_SECONDS, _PRICES
+        if max_tokens is not None:
+            _MAX_TOKENS = max_tokens or None
+        if max_seconds is not None:
+            _MAX_SECONDS = max_seconds or None
+        if prices is not None:
+            _PRICES = dict(prices)
+
+    @staticmethod
+    def start() -> RequestUsage:
+        return RequestUsage(_MAX_TOKENS, _MAX_SECONDS)
+
+    @staticmethod
+    @contextmanager
+    def use(usage: RequestUsage) -> Iterator[RequestUsage]:
+        """Count the LLM calls made in this block (and in contexts copied from it) against `usage`."""
+        token = _CURRENT.set(usage)
+        try:
+            yield usage
+        finally:
+            try:
+                _CURRENT.reset(token)
+            except ValueError:
+                # Closed from another context, see TraceManager.use
+                pass
+
+    @staticmethod
+    def current() -> Optional[RequestUsage]:
+        return _CURRENT.get()
+
+    @staticmethod
+    def exceeded() -> Optional[str]:
+        """Why the current request's budget is spent, or None."""
+        usage = _CURRENT.get()
+        return usage.exceeded() if usage is not None else None
+
+    @staticmethod
+    def cost(model: Optional[str], input_tokens: int, output_tokens: int) -> float:
+        price = _PRICES.get(model or '')
+        return (input_tokens * price[0] + output_tokens * price[1]) / 1e6 if price else 0.0
+
+
+def _tool_stage() -> Optional[str]:
+    # The tool whose task span the call runs under, if any
+    span = TraceManager.current()
+    while span is not None:
+        if span.name == "task":
+            return span.attributes.get("tool") or "tool"
+        span = span.parent
+    return None
+
+
+def _stage(usage: RequestUsage, tools: list) -> str:
+    if (tool := _tool_stage()) is not None:
+        return tool
+    if "JoinOutputs" in tools:
+        return "join"
+    with usage.lock:
+        usage.plans += 1
+        return "plan" if usage.plans == 1 else "replan"
+
+
+def _tokens(response) -> Tuple[int, int]:
+    input_tokens = output_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            metadata = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if metadata:
+                input_tokens += metadata.get("input_tokens", 0)
+                output_tokens += metadata.get("output_tokens", 0)
+    if not input_tokens and not output_tokens:
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        input_tokens = token_usage.get("prompt_tokens", 0)
+        output_tokens = token_usage.get("completion_tokens", 0)
+    return input_tokens, output_tokens
+
+
+class BudgetCallbackHandler(BaseCallbackHandler):
+    """Fails the chat model calls made inside tools once the current request's budget is spent.
+
+    The conductor stops replanning by itself; this stops the steps of sub-agents.
+    Register it first, so a refused call is neither traced nor counted.
+    """
+
+    run_inline = True
+    # BudgetExceeded has to reach the caller; nothing else is raised from here
+    raise_error = True
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        try:
+            usage = _CURRENT.get()
+            stage = _tool_stage() if usage is not None else None
+            reason = usage.exceeded() if stage is not None else None
+        except Exception:  # noqa
+            logger.exception('# <budget> check failed, letting the call through')
+            return
+        if reason:
+            raise BudgetExceeded(f'Request budget exceeded ({reason}), {stage} was not called')
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """Counts every chat model call against the current request."""
+
+    run_inline = True
+    # A bug in the accounting must not fail the call (see BudgetCallbackHandler for the budget)
+    raise_error = False
+
+    def __init__(self):
+        self.runs: Dict[UUID, Tuple[RequestUsage, str, Optional[str], float]] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, invocation_params: Optional[dict] = None,
+                            **kwargs):
+        usage = _CURRENT.get()
+        if usage is None:
+            return
+        params = invocation_params or {}
+        tools = [(tool.get("function") or tool).get("name") for tool in params.get("tools") or []]
+        stage = _stage(usage, tools)
+        self.runs[run_id] = (usage, stage, params.get("model_name") or params.get("model"), time.perf_counter())
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any):
+        run = self.runs.pop(run_id, None)
+        if run is None:
+            return
+        usage, stage, model, start = run
+        input_tokens, output_tokens = _tokens(response)
+        usage.add(stage, input_tokens, output_tokens, time.perf_counter() - start,
+                  UsageManager.cost(model, input_tokens, output_tokens))
+        MetricManager.add("conductor_llm_calls_total", 1, stage=stage)
+        MetricManager.add("conductor_llm_tokens_total", input_tokens, stage=stage, type="input")
+        MetricManager.add("conductor_llm_tokens_total", output_tokens, stage=stage, type="output")
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        run = self.runs.pop(run_id, None)
+        if run is not None:
+            usage, stage, _, start = run
+            usage.add(stage, 0, 0, time.perf_counter() - start, 0.0)
@@ -0,0 +1,315 @@
+################################################################################
+# Workers: process-wide tool worker pool
+################################################################################
+
+import os
+import time
+import asyncio
+import threading
+import contextvars
+import multiprocessing
+from collections import defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Awaitable, Callable
+from managers.metric_manager import MetricManager
+from managers.trace_manager import TraceManager
+
+
+_MAX_WORKERS: int = int(os.getenv("TOOL_MAX_WORKERS", 32))
+# Coroutine tools awaited on an event loop hold no thread, so they have their own, larger cap
+_MAX_ASYNC: int = int(os.getenv("TOOL_MAX_ASYNC", 256))
+_LIMITS: dict[str, int] = {}
+_EXECUTOR: ThreadPoolExecutor | None = None
+_LOCK = threading.Lock()
+
+# Slots granted and requests waiting for one, per tool; the per-tool caps count both kinds of slots
+_IN_FLIGHT: dict[str, int] = defaultdict(int)
+_POOL_IN_FLIGHT: dict[str, int] = {"thread": 0, "async": 0}
+_QUEUES: dict[str, deque] = defaultdict(deque)
+_STATS: dict[str, dict[str, float]] = defaultdict(
+    lambda: {"submitted": 0, "completed": 0, "queued": 0, "wait_total": 0.0, "wait_max": 0.0})
+
+# Separate worker processes for CPU-bound tools, so they don't hold the GIL
+# that request handling and plan parsing need. The pool is replaced after a
+# number of calls (max_tasks_per_child can hang on 3.11), and a crashed
+# worker only fails the calls it took down.
+_MAX_PROCESSES: int = int(os.getenv("TOOL_MAX_PROCESSES", os.cpu_count() or 1))
+_RECYCLE_AFTER: int = int(os.getenv("TOOL_PROCESS_RECYCLE_AFTER", 1000))
+_PROCESS_EXECUTOR: ProcessPoolExecutor | None = None
+_PROCESS_CALLS: int = 0
+_PROCESS_STATS: dict[str, int] = {"submitted": 0, "completed": 0, "failed": 0, "restarts": 0, "recycles": 0}
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = ThreadPoolExecutor(max_workers=_MAX_WORKERS, thread_name_prefix="tool")
+    return _EXECUTOR
+
+
+def _process_executor(calls: int = 0) -> ProcessPoolExecutor:
+    global _PROCESS_EXECUTOR, _PROCESS_CALLS
+    retired = None
+    with _LOCK:
+        if _PROCESS_EXECUTOR is not None and _PROCESS_CALLS + calls > _RECYCLE_AFTER:
+            # Calls already submitted still finish on the retired pool
+            retired, _PROCESS_EXECUTOR = _PROCESS_EXECUTOR, None
+            _PROCESS_STATS["recycles"] += 1
+        if _PROCESS_EXECUTOR is None:
+            # forkserver: workers don't inherit the threads and sockets of the server
+            _PROCESS_EXECUTOR = ProcessPoolExecutor(
+                max_workers=_MAX_PROCESSES, mp_context=multiprocessing.get_context("forkserver"))
+            _PROCESS_CALLS = 0
+        _PROCESS_CALLS += calls
+        executor = _PROCESS_EXECUTOR
+    if retired is not None:
+        retired.shutdown(wait=False)
+    return executor
+
+
+def _discard_process_executor(executor: ProcessPoolExecutor):
+    # The next call starts a fresh pool; only the first caller to notice restarts it
+    global _PROCESS_EXECUTOR
+    with _LOCK:
+        if _PROCESS_EXECUTOR is not executor:
+            return
+        _PROCESS_EXECUTOR = None
+        _PROCESS_STATS["restarts"] += 1
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _can_start(tool_name: str, pool: str) -> bool:
+    # Must be called with the lock held
+    limit = _LIMITS.get(tool_name)
+    return (_POOL_IN_FLIGHT[pool] < (_MAX_WORKERS if pool == "thread" else _MAX_ASYNC)
+            and (limit is None or _IN_FLIGHT[tool_name] < limit))
+
+
+def _start(tool_name: str, pool: str, start: Callable[[], None], enqueued_at: float | None = None):
+    # Must be called with the lock held
+    _IN_FLIGHT[tool_name] += 1
+    _POOL_IN_FLIGHT[pool] += 1
+    if enqueued_at is not None:
+        waited = time.perf_counter() - enqueued_at
+        stats = _STATS[tool_name]
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+    start()
+
+
+def _acquire(tool_name: str, pool: str, start: Callable[[], None]):
+    with _LOCK:
+        _STATS[tool_name]["submitted"] += 1
+        if _can_start(tool_name, pool):
+            _start(tool_name, pool, start)
+        else:
+            _STATS[tool_name]["queued"] += 1
+            _QUEUES[tool_name].append((start, time.perf_counter(), pool))
+
+
+def _release(tool_name: str, pool: str):
+    with _LOCK:
+        _IN_FLIGHT[tool_name] -= 1
+        _POOL_IN_FLIGHT[pool] -= 1
+        _STATS[tool_name]["completed"] += 1
+        # Hand the freed slots to the longest waiting requests that fit
+        while True:
+            ready = [name for name, queue in _QUEUES.items() if queue and _can_start(name, queue[0][2])]
+            if not ready:
+                break
+            name = min(ready, key=lambda n: _QUEUES[n][0][1])
+            start, enqueued_at, queued_pool = _QUEUES[name].popleft()
+            _start(name, queued_pool, start, enqueued_at)
+
+
+class WorkerManager:
+    @staticmethod
+    def configure(
+            max_workers: int | None = None,
+            limits: dict[str, int] | None = None,
+            max_processes: int | None = None,
+            recycle_after: int | None = None,
+            max_async: int | None = None,
+    ):
+        """Set the global caps (threads, coroutines) and per-tool caps on tool calls in flight, and the process pool size."""
+        global _MAX_WORKERS, _MAX_ASYNC, _LIMITS, _EXECUTOR, _MAX_PROCESSES, _RECYCLE_AFTER, _PROCESS_EXECUTOR
+        with _LOCK:
+            if limits is not None:
+                _LIMITS = dict(limits)
+            if max_async is not None:
+                _MAX_ASYNC = max_async
+            if recycle_after is not None:
+                _RECYCLE_AFTER = recycle_after
+            if max_processes is not None and max_processes != _MAX_PROCESSES:
+                _MAX_PROCESSES = max_processes
+                if _PROCESS_EXECUTOR is not None:
+                    _PROCESS_EXECUTOR.shutdown(wait=False)
+                    _PROCESS_EXECUTOR = None
+            if max_workers is not None and max_workers != _MAX_WORKERS:
+                _MAX_WORKERS = max_workers
+                if _EXECUTOR is not None:
+                    # Running calls finish on the old pool
+                    _EXECUTOR.shutdown(wait=False)
+                    _EXECUTOR = None
+
+    @staticmethod
+    def limit(tool_name: str) -> int | None:
+        """The cap on calls of `tool_name` in flight; None when only the global caps apply."""
+        return _LIMITS.get(tool_name)
+
+    @staticmethod
+    def submit(tool_name: str, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Run `fn` on the shared pool once `tool_name` has a free slot."""
+        future = Future()
+        ctx = contextvars.copy_context()
+        enqueued_at = time.perf_counter()
+
+        def call():
+            # In the caller's context, so the spans nest under its current span
+            TraceManager.record("task.queue", enqueued_at, tool=tool_name)
+            with TraceManager.span("task.execute", tool=tool_name):
+                return fn(*args, **kwargs)
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                _release(tool_name, "thread")
+                return
+            try:
+                future.set_result(ctx.run(call))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                _release(tool_name, "thread")
+
+        _acquire(tool_name, "thread", lambda: _executor().submit(run))
+        return future
+
+    @staticmethod
+    async def run(tool_name: str, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Await `fn` on the current loop once `tool_name` has a free slot.
+
+        The call holds no thread, so it counts against the coroutine cap, not the thread pool's.
+        """
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        enqueued_at = time.perf_counter()
+
+        def start():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        _acquire(tool_name, "async", start)
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if granted.done() and not granted.cancelled():
+                _release(tool_name, "async")
+            else:
+                WorkerManager._forget(tool_name, start)
+            raise
+        TraceManager.record("task.queue", enqueued_at, tool=tool_name)
+        try:
+            with TraceManager.span("task.execute", tool=tool_name):
+                return await fn(*args, **kwargs)
+        finally:
+            _release(tool_name, "async")
+
+    @staticmethod
+    def submit_process(fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Run a picklable `fn` in a worker process.
+
+        Callers hold the tool's slot (see submit/run) while they wait, so the
+        per-tool caps apply here too.
+        """
+        executor = _process_executor(1)
+        with _LOCK:
+            _PROCESS_STATS["submitted"] += 1
+        try:
+            future = executor.submit(fn, *args, **kwargs)
+        except (BrokenProcessPool, RuntimeError):
+            # Broken, or retired by another thread in the meantime
+            _discard_process_executor(executor)
+            executor = _process_executor(1)
+            future = executor.submit(fn, *args, **kwargs)
+
+        def done(f: Future):
+            with _LOCK:
+                _PROCESS_STATS["failed" if f.cancelled() or f.exception() else "completed"] += 1
+            if not f.cancelled() and isinstance(f.exception(), BrokenProcessPool):
+                _discard_process_executor(executor)
+
+        future.add_done_callback(done)
+        return future
+
+    @staticmethod
+    def warm_up():
+        """Start the worker processes now rather than on the first CPU-bound call."""
+        executor = _process_executor(_MAX_PROCESSES)
+        for future in [executor.submit(os.getpid) for _ in range(_MAX_PROCESSES)]:
+            future.result()
+
+    @staticmethod
+    def shutdown():
+        global _EXECUTOR, _PROCESS_EXECUTOR
+        with _LOCK:
+            executors = [e for e in (_EXECUTOR, _PROCESS_EXECUTOR) if e is not None]
+            _EXECUTOR = _PROCESS_EXECUTOR = None
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _forget(tool_name: str, start: Callable[[], None]):
+        with _LOCK:
+            for item in _QUEUES[tool_name]:
+                if item[0] is start:
+                    _QUEUES[tool_name].remove(item)
+                    return
+        # The slot was granted while we were being cancelled
+        _release(tool_name, "async")
+
+    @staticmethod
+    def stats() -> dict[str, Any]:
+        """Queue depth, in-flight calls, saturation and wait times, per tool and overall."""
+        with _LOCK:
+            in_flight = _POOL_IN_FLIGHT["thread"]
+            async_in_flight = _POOL_IN_FLIGHT["async"]
+            tools = {}
+            for name in set(_STATS) | set(_LIMITS):
+                stats = _STATS[name]
+                tools[name] = {
+                    "limit": _LIMITS.get(name),
+                    "in_flight": _IN_FLIGHT[name],
+                    "queue_depth": len(_QUEUES[name]),
+                    "submitted": stats["submitted"],
+                    "completed": stats["completed"],
+                    "queued": stats["queued"],
+                    "wait_avg": stats["wait_total"] / stats["queued"] if stats["queued"] else 0.0,
+                    "wait_max": stats["wait_max"],
+                }
+            return {
+                "max_workers": _MAX_WORKERS,
+                "in_flight": in_flight,
+                "queue_depth": sum(len(queue) for queue in _QUEUES.values()),
+                "saturation": in_flight / _MAX_WORKERS,
+                "max_async": _MAX_ASYNC,
+                "async_in_flight": async_in_flight,
+                "async_saturation": async_in_flight / _MAX_ASYNC,
+                "tools": tools,
+                "processes": dict(_PROCESS_STATS, max_processes=_MAX_PROCESSES),
+            }
+
+
+def _collect():
+    stats = WorkerManager.stats()
+    yield ("conductor_workers_saturation", "gauge", "Tool calls in flight over the worker cap", {},
+           stats["saturation"])
+    yield ("conductor_workers_async_saturation", "gauge", "Coroutine tool calls in flight over their cap", {},
+           stats["async_saturation"])
+    for name, tool in stats["tools"].items():
+        yield ("conductor_tool_in_flight", "gauge", "Tool calls holding a worker slot", {"tool": name},
+               tool["in_flight"])
+        yield ("conductor_tool_queue_depth", "gauge", "Tool calls waiting for a worker slot", {"tool": name},
+               tool["queue_depth"])
+
+
+MetricManager.collector(_collect)
@@ -0,0 +1,85 @@
+################################################################################
+# Events: the typed stream of a /test response
+################################################################################
+#
+# One JSON object per event, with a "type":
+#   start        the request was accepted
+#   plan         a task of the plan, as soon as the planner streams it
+#   task-start   a task's tool is called (its dependencies are resolved)
+#   task-result  a task's observation; "error" when the call failed
+#   decision     the joiner chose to answer ("final") or to replan, before it writes either
+#   replan       the plan is dropped: the joiner's feedback, or the errors of an invalid plan
+#   token        a piece of the final response, while the joiner writes it
+#   final        the final response
+#   usage        tokens and time per stage (see managers/usage_manager.py)
+#   error        the request failed
+# The players emit plan, task-start, task-result, decision and token through
+# the graph's custom stream; main.py derives the others from the graph's updates.
+# Sent as NDJSON (one object per line) or as Server-Sent Events.
+
+import json
+import gzip
+import base64
+from typing import Any, Callable, Optional
+from langgraph.config import get_stream_writer
+
+
+START = "start"
+PLAN = "plan"
+TASK_START = "task-start"
+TASK_RESULT = "task-result"
+DECISION = "decision"
+REPLAN = "replan"
+TOKEN = "token"
+FINAL = "final"
+USAGE = "usage"
+ERROR = "error"
+
+# Events the players write to the custom stream
+CUSTOM_EVENTS = (PLAN, TASK_START, TASK_RESULT, DECISION, TOKEN)
+
+Emit = Callable[[dict], None]
+
+
+def emitter() -> Emit:
+    """The custom stream writer of the running graph; a no-op when nobody streams "custom"."""
+    try:
+        return get_stream_writer()
+    except (RuntimeError, KeyError):
+        # Not inside a graph run, e.g. a player invoked on its own
+        return lambda event: None
+
+
+def is_error(observation: Any) -> bool:
+    # Failed tool calls become observations, see players/scheduler.py
+    return isinstance(observation, str) and observation.startswith('ERROR')
+
+
+def compress(event: dict, min_size: int) -> dict:
+    """Gzip and base64 the observation of a task-result when it has at least `min_size` bytes."""
+    observation = event.get("observation")
+    if event["type"] != TASK_RESULT or not isinstance(observation, str):
+        return event
+    data = observation.encode('utf-8')
+    if len(data) < min_size:
+        return event
+    return dict(event, observation=base64.b64encode(gzip.compress(data, compresslevel=6)).decode('ascii'),
+                encoding="gzip+base64")
+
+
+def decompress(event: dict) -> dict:
+    """The inverse of compress(), for clients."""
+    if event.get("encoding") != "gzip+base64":
+        return event
+    event = dict(event, observation=gzip.decompress(base64.b64decode(event["observation"])).decode('utf-8'))
+    del event["encoding"]
+    return event
+
+
+def encode(event: dict, sse: bool = False, compress_min: Optional[int] = None) -> bytes:
+    if compress_min is not None:
+        event = compress(event, compress_min)
+    data = json.dumps(event, ensure_ascii=False, default=str)
+    if sse:
+        return f'event: {event["type"]}\ndata: {data}\n\n'.encode('utf-8')
+    return (data + '\n').encode('utf-8')
@@ -2,12 +2,20 @@
 # Joiner
 ################################################################################
 
+import json
+import logging
 from typing import Union
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from langchain_core.language_models import BaseChatModel
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import Runnable
+from langchain_core.runnables import Runnable, RunnableLambda
+from langchain_core.utils.json import parse_partial_json
+from managers.trace_manager import TraceManager
+from .events import DECISION, TOKEN, emitter
+
+
+logger = logging.getLogger(__name__)
 
 
 class FinalResponse(BaseModel):
@@ -48,9 +56,89 @@ def _select_recent_messages(state) -> dict:
     return {"messages": selected[::-1]}
 
 
+class _StreamingDecision:
+    """Follow the JoinOutputs arguments as they stream and forward the final response tokens."""
+
+    def __init__(self):
+        self.args = ''
+        self.action = None
+        self.thought = ''
+        self.sent = ''
+        self.writer = emitter()
+
+    def feed(self, chunk: AIMessageChunk):
+        for tool_call_chunk in chunk.tool_call_chunks:
+            self.args += tool_call_chunk.get("args") or ''
+        try:
+            partial = parse_partial_json(self.args)
+        except ValueError:
+            return
+        action = partial.get("action") if isinstance(partial, dict) else None
+        if isinstance(partial, dict) and isinstance(partial.get("thought"), str):
+            self.thought = partial["thought"]
+        if not isinstance(action, dict):
+            return
+        if self.action is None and ("response" in action or "feedback" in action):
+            # Decided as soon as the first key of the action shows up
+            self.action = "final" if "response" in action else "replan"
+            self.writer({"type": DECISION, "action": self.action})
+        if self.action == "final" and isinstance(action.get("response"), str):
+            response = action["response"]
+            # Partial parsing can hold back a dangling escape; only send a growing prefix
+            if response.startswith(self.sent) and len(response) > len(self.sent):
+                self.writer({"type": TOKEN, "content": response[len(self.sent):]})
+                self.sent = response
+
+    def result(self) -> dict:
+        try:
+            decision = JoinOutputs.model_validate(json.loads(self.args))
+        except (ValueError, ValidationError) as e:
+            # No tool call (empty args), or a truncated or malformed one
+            logger.warning('# <joiner> no valid decision (%r), args=%r', e, self.args[:200])
+            if self.action == "final" and self.sent:
+                # The client already has this answer
+                decision = JoinOutputs(thought=self.thought, action=FinalResponse(response=self.sent))
+            else:
+                decision = JoinOutputs(thought=self.thought, action=Replan(
+                    feedback="The last attempt ended without a final response or feedback. Try again."))
+        return _parse_joiner_output(decision)
+
+
 def build(
         model: BaseChatModel,
         prompt_template: ChatPromptTemplate,
+        stream: bool = False,
 ) -> Runnable:
-    _runnable = prompt_template | model.with_structured_output(JoinOutputs, method="function_calling")
-    return _select_recent_messages | _runnable | _parse_joiner_output
+    if not stream:
+        _runnable = prompt_template | model.with_structured_output(JoinOutputs, method="function_calling")
+        _joiner = _select_recent_messages | _runnable | _parse_joiner_output
+
+        def join(state, config):
+            with TraceManager.span("joiner"):
+                return _joiner.invoke(state, config)
+
+        async def ajoin(state, config):
+            with TraceManager.span("joiner"):
+                return await _joiner.ainvoke(state, config)
+
+        return RunnableLambda(join, afunc=ajoin, name="join")
+
+    # Streaming mode: the final response is forwarded token by token through
+    # the graph's custom stream while the structured output is generated.
+    _runnable = prompt_template | model.bind_tools([JoinOutputs], tool_choice=JoinOutputs.__name__)
+
+    def join(state):
+        with TraceManager.span("joiner"):
+            decision = _StreamingDecision()
+            for chunk in _runnable.stream(_select_recent_messages(state)):
+                decision.feed(chunk)
+            return decision.result()
+
+    async def ajoin(state):
+        with TraceManager.span("joiner"):
+            decision = _StreamingDecision()
+            async for chunk in _runnable.astream(_select_recent_messages(state)):
+                decision.feed(chunk)
+            return decision.result()
+
+    return RunnableLambda(join, afunc=ajoin, name="join")
@@ -1,52 +1,88 @@
 import ast
 import re
-from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+import json
+import logging
+import threading
+from typing import Any, AsyncIterator, ClassVar, Dict, Iterator, List, Optional, Set, Tuple, Union
 from typing_extensions import TypedDict
 from langchain_core.exceptions import OutputParserException
 from langchain_core.messages import BaseMessage
 from langchain_core.output_parsers.transform import BaseTransformOutputParser
 from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import BaseTool
+from managers.metric_manager import MetricManager
 
 
+logger = logging.getLogger(__name__)
+
 THOUGHT_PATTERN = r"Thought: ([^\n]*)"
 ACTION_PATTERN = r"\n*(\d+)\. (\w+)\((.*)\)(\s*#\w+\n)?"
 # ACTION_LIKE_PATTERN = r"\n*(\d+)\. (\w+)\((.*)\)(\s*#\w+\n)?"
 ID_PATTERN = r"\$\{?(\d+)\}?"  # $1 or ${1} -> 1
 END_OF_PLAN = ""
+END_OF_PLAN_MARKER = "<END_OF_PLAN>"
 JOINER_TOOL_NAME = "join"
 
 
-def _parse_string_arguments(raw_args: str, tool: BaseTool) -> Dict[str, Any]:
-    """Parse arguments from a string."""
+_ID_REGEX = re.compile(ID_PATTERN)
+# Quoted strings, task references, and the characters that delimit arguments
+_ARGUMENT_SCAN_REGEX = re.compile(r"""\"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|\$\{?(\d+)\}?|[,()\[\]{}]""")
+# A quote only opens a string at the start of a value, not in "Obama's age"
+_QUOTE_OPENERS = frozenset('([{,=:')
+# name=value, but not "a=b" or x == 3
+_KEYWORD_REGEX = re.compile(r"(\w+)\s*=(?!=)")
 
-    if raw_args is None or raw_args == '':
-        return {}
 
+def _split_arguments(raw_args: str) -> Tuple[List[str], Set[int]]:
+    """Split call arguments at top-level commas, collecting $N/${N} references on the way."""
     tokens = []
-    _current = []
-    _bracket = 0
-    for c in raw_args:
-        if c in '{[(':
-            _bracket += 1
-        elif c in ')]}':
-            _bracket -= 1
-        if c == ',' and _bracket == 0:
-            token = ''.join(_current).strip()
+    references = set()
+    depth = 0
+    start = 0
+    pos = 0
+    while match := _ARGUMENT_SCAN_REGEX.search(raw_args, pos):
+        text = match.group()
+        pos = match.end()
+        if match.group(1):
+            references.add(int(match.group(1)))
+        elif text[0] in '"\'':
+            j = match.start() - 1
+            while j >= 0 and raw_args[j] in ' \t':
+                j -= 1
+            if j >= 0 and raw_args[j] not in _QUOTE_OPENERS:
+                # An apostrophe, not a string; keep scanning right after it
+                pos = match.start() + 1
+                continue
+            references.update(map(int, _ID_REGEX.findall(text)))
+        elif text in '([{':
+            depth += 1
+        elif text in ')]}':
+            depth -= 1
+        elif depth == 0:
+            token = raw_args[start:match.start()].strip()
             if token:
                 tokens.append(token)
-            _current = []
-        else:
-            _current.append(c)
-    if _current:
-        tokens.append(''.join(_current).strip())
+            start = pos
+    token = raw_args[start:].strip()
+    if token:
+        tokens.append(token)
+    return tokens, references
+
+
+def _parse_string_arguments(raw_args: str, tool: BaseTool) -> Tuple[Dict[str, Any], Set[int]]:
+    """Parse arguments from a string, along with the task indexes they reference."""
+
+    if raw_args is None or raw_args == '':
+        return {}, set()
+
+    tokens, references = _split_arguments(raw_args)
 
     kwargs = {}
     arg_names = list(tool.args.keys())
     for token in tokens:
-        if '=' in token and not token.startswith('{') and not token.startswith('[') and not token.startswith('('):
-            key, value = token.split('=', 1)
-            key = key.strip()
+        if keyword := _KEYWORD_REGEX.match(token):
+            key = keyword.group(1)
+            value = token[keyword.end():].strip()
             for k in [key, key.lower(), key.upper(), f'_{key}']:
                 if k in arg_names:
                     arg_names.pop(arg_names.index(k))
@@ -60,19 +96,57 @@ def _parse_string_arguments(raw_args: str, tool: BaseTool) -> Dict[str, Any]:
             kwargs[key] = ast.literal_eval(value)
         except:  # noqa
             kwargs[key] = value
-    return kwargs
+    return kwargs, references
 
 
 def default_dependency_rule(idx: int, args: str):
-    matches = re.findall(ID_PATTERN, args)
-    numbers = [int(match) for match in matches]
+    numbers = [int(match) for match in _ID_REGEX.findall(args)]
     return idx in numbers
 
 
-def _get_dependencies_from_graph(idx: int, tool_name: str, args: Dict[str, Any]) -> List[int]:
-    """Get dependencies from a graph."""
-    return list(range(1, idx)) if tool_name == JOINER_TOOL_NAME else [
-        i for i in range(1, idx) if default_dependency_rule(i, str(args))]
+def get_dependencies_from_graph(idx: int, tool_name: str, args: Dict[str, Any]) -> List[int]:
+    """The task indices `args` reference; join() depends on every earlier task."""
+    if tool_name == JOINER_TOOL_NAME:
+        return list(range(1, idx))
+    # One scan of the arguments, not one per earlier task
+    return sorted({d for d in map(int, _ID_REGEX.findall(str(args))) if d > 0})
+
+
+# Plan parse outcomes per plan format, to compare how often each one loses actions
+_STATS: Dict[str, Dict[str, int]] = {
+    plan_format: {"plans": 0, "tasks": 0, "dropped": 0, "errors": 0} for plan_format in ("text", "json")}
+_STATS_LOCK = threading.Lock()
+
+
+def _count(plan_format: str, key: str):
+    with _STATS_LOCK:
+        _STATS[plan_format][key] += 1
+
+
+def parse_stats() -> Dict[str, Dict[str, float]]:
+    """Parsed tasks, dropped lines/objects and invalid actions (e.g. unknown tools), per plan format."""
+    with _STATS_LOCK:
+        stats = {}
+        for plan_format, counts in _STATS.items():
+            failures = counts["dropped"] + counts["errors"]
+            total = counts["tasks"] + failures
+            stats[plan_format] = dict(counts, failure_rate=failures / total if total else 0.0)
+        return stats
+
+
+def _collect():
+    for plan_format, stats in parse_stats().items():
+        yield ("conductor_plans_parsed_total", "counter", "Plans parsed, per plan format", {"format": plan_format},
+               stats["plans"])
+        for outcome in ("tasks", "dropped", "errors"):
+            yield ("conductor_plan_actions_total", "counter",
+                   "Plan actions by outcome: parsed tasks, dropped lines/objects, invalid actions",
+                   {"format": plan_format, "outcome": outcome}, stats[outcome])
+        yield ("conductor_plan_parse_failure_ratio", "gauge", "Dropped and invalid actions over all actions",
+               {"format": plan_format}, stats["failure_rate"])
+
+
+MetricManager.collector(_collect)
 
 
 class Task(TypedDict):
@@ -83,6 +157,11 @@ class Task(TypedDict):
     thought: Optional[str]
 
 
+def is_unknown_tool(task: Task) -> bool:
+    """Whether the task is a placeholder for a tool the planner doesn't have."""
+    return isinstance(task["tool"], str) and task["tool"] != JOINER_TOOL_NAME
+
+
 def instantiate_task(
         idx: int,
         tool_name: str,
@@ -93,20 +172,80 @@ def instantiate_task(
     if tool_name == JOINER_TOOL_NAME:
         tool = JOINER_TOOL_NAME
         tool_args = {}
+        dependencies = list(range(1, idx))
+    elif tool_name not in tools:
+        # A placeholder, so the plan validator reports the task and the rest of the plan still runs
+        return Task(idx=idx, tool=tool_name, args={}, dependencies=[], thought=thought)
     else:
-        try:
-            tool = tools[tool_name]
-        except KeyError as e:
-            raise OutputParserException(
-                f'Tool "{tool_name}" not found. (available={list(tools.keys())}') from e
-        tool_args = _parse_string_arguments(raw_args, tool)
-    dependencies = _get_dependencies_from_graph(idx, tool_name, tool_args)
+        tool = tools[tool_name]
+        tool_args, references = _parse_string_arguments(raw_args, tool)
+        # Forward and self references are kept for the plan validator to report
+        dependencies = sorted(d for d in references if d > 0)
     return Task(idx=idx, tool=tool, args=tool_args, dependencies=dependencies, thought=thought)
 
 
+# Precompiled, the parser runs them on every line of every plan
+_THOUGHT_REGEX = re.compile(THOUGHT_PATTERN)
+_ACTION_REGEX = re.compile(ACTION_PATTERN)
+_ACTION_HEAD_REGEX = re.compile(r"(\d+)\. (\w+)\(")
+_HEAD_SCAN_REGEX = re.compile(r"[(\n]")
+_ARGS_SCAN_REGEX = re.compile(r"[()\[\]{}\"'\n]")
+_QUOTE_SCAN_REGEXES = {"'": re.compile(r"['\\\n]"), '"': re.compile(r'["\\\n]')}
+
+# What the current line is known to be, so far
+_HEAD = 0  # Not decided yet
+_THOUGHT = 1  # "Thought: ..."
+_ARGS = 2  # Inside the arguments of "N. tool(...", waiting for the closing parenthesis
+_SKIP = 3  # Task already emitted, or nothing to parse; waiting for the newline
+
+
+class _PlanStreamState:
+    """Scanner state of one plan stream. Only the current line is buffered."""
+
+    __slots__ = ('line', 'pos', 'mode', 'depth', 'quote', 'idx', 'tool_name', 'args_start', 'thought')
+
+    def __init__(self):
+        self.line = ''
+        self.pos = 0  # Everything before this position has been scanned
+        self.mode = _HEAD
+        self.depth = 0
+        self.quote = None
+        self.idx = None
+        self.tool_name = None
+        self.args_start = 0
+        self.thought = None
+
+
+def instantiate_json_task(obj: Dict[str, Any], tools: Dict[str, BaseTool]) -> Task:
+    """Build a task from a JSON plan action, e.g. {"idx": 2, "tool": "math", "args": {"problem": "$1 + 3"}}."""
+    try:
+        idx = int(obj["idx"])
+    except (TypeError, ValueError) as e:
+        raise OutputParserException(f'Invalid task index: {obj.get("idx")!r}') from e
+    tool_name = str(obj["tool"])
+    thought = obj.get("thought")
+    if tool_name == JOINER_TOOL_NAME:
+        return Task(idx=idx, tool=JOINER_TOOL_NAME, args={}, dependencies=list(range(1, idx)), thought=thought)
+    if tool_name not in tools:
+        return Task(idx=idx, tool=tool_name, args={}, dependencies=[], thought=thought)
+    tool = tools[tool_name]
+    args = obj.get("args") or {}
+    if isinstance(args, str):
+        # Python-style call arguments in a string
+        args, _ = _parse_string_arguments(args, tool)
+    elif isinstance(args, list):
+        args = dict(zip(tool.args.keys(), args))
+    references = {int(d) for d in _ID_REGEX.findall(json.dumps(args))}
+    references.update(d for d in obj.get("dependencies") or [] if isinstance(d, int))
+    dependencies = sorted(d for d in references if d > 0)
+    return Task(idx=idx, tool=tool, args=args, dependencies=dependencies, thought=thought)
+
+
 class LLMCompilerPlanParser(BaseTransformOutputParser[dict], extra="allow"):
     """Planning output parser."""
 
+    plan_format: ClassVar[str] = "text"
+
     tools: Dict[str, BaseTool]
 
     def stream(
@@ -117,64 +256,290 @@ class LLMCompilerPlanParser(BaseTransformOutputParser[dict], extra="allow"):
     ) -> Iterator[Task]:
         yield from self.transform([input_], config, **kwargs)
 
+    async def astream(
+            self,
+            input_: str | BaseMessage,
+            config: RunnableConfig | None = None,
+            **kwargs: Any | None,
+    ) -> AsyncIterator[Task]:
+        async def _input():
+            yield input_
+
+        async for task in self.atransform(_input(), config, **kwargs):
+            yield task
+
     def parse(self, text: str) -> List[Task]:
         return list(self._transform([text]))
 
     def _transform(self, input_: Iterator[Union[str, BaseMessage]]) -> Iterator[Task]:
-        texts = []
-        # TODO: Cleanup tuple state tracking here.
-        thought = None
+        state = self._new_state()
+        _count(self.plan_format, "plans")
         for chunk in input_:
             # Assume input is str. TODO: support vision/other formats
             text = chunk if isinstance(chunk, str) else str(chunk.content)
-            for task, thought in self._ingest_token(text, texts, thought):
+            yield from self._ingest_token(text, state)
+        # Final possible task
+        yield from self._flush(state)
+
+    async def _atransform(self, input_: AsyncIterator[Union[str, BaseMessage]]) -> AsyncIterator[Task]:
+        state = self._new_state()
+        _count(self.plan_format, "plans")
+        async for chunk in input_:
+            text = chunk if isinstance(chunk, str) else str(chunk.content)
+            for task in self._ingest_token(text, state):
                 yield task
         # Final possible task
-        if texts:
-            task, _ = self._parse_task(''.join(texts), thought)
+        for task in self._flush(state):
+            yield task
+
+    def _new_state(self) -> _PlanStreamState:
+        return _PlanStreamState()
+
+    def _flush(self, state: _PlanStreamState) -> Iterator[Task]:
+        yield from self._end_line(state, len(state.line))
+
+    def _instantiate(self, **kwargs) -> Task:
+        try:
+            task = instantiate_task(tools=self.tools, **kwargs)
+        except OutputParserException:
+            _count(self.plan_format, "errors")
+            raise
+        _count(self.plan_format, "errors" if is_unknown_tool(task) else "tasks")
+        return task
+
+    def _ingest_token(self, token: str, state: _PlanStreamState) -> Iterator[Task]:
+        """Scan only the new characters, emitting a task as soon as its closing parenthesis arrives."""
+        state.line += token
+        while True:
+            line = state.line
+            if state.mode == _HEAD:
+                match = _HEAD_SCAN_REGEX.search(line, state.pos)
+                if match is None:
+                    state.pos = len(line)
+                    return
+                i = match.start()
+                if line.startswith('Thought:'):
+                    state.mode = _THOUGHT
+                elif match.group() == '(' and (head := _ACTION_HEAD_REGEX.fullmatch(line, 0, i + 1)):
+                    state.mode = _ARGS
+                    state.depth = 1
+                    state.idx = int(head.group(1))
+                    state.tool_name = head.group(2)
+                    state.args_start = i + 1
+                    state.pos = i + 1
+                    continue
+                elif match.group() == '(':
+                    state.mode = _SKIP
+                if match.group() == '\n':
+                    yield from self._end_line(state, i)
+                    continue
+                state.pos = i + 1
+
+            elif state.mode == _ARGS:
+                if state.quote:
+                    match = _QUOTE_SCAN_REGEXES[state.quote].search(line, state.pos)
+                    if match is None:
+                        state.pos = len(line)
+                        return
+                    i = match.start()
+                    c = match.group()
+                    if c == '\\':
+                        if i + 1 >= len(line):
+                            # The escaped character is in the next token
+                            state.pos = i
+                            return
+                        state.pos = i + 2
+                        continue
+                    if c == state.quote:
+                        state.quote = None
+                        state.pos = i + 1
+                        continue
+                else:
+                    match = _ARGS_SCAN_REGEX.search(line, state.pos)
+                    if match is None:
+                        state.pos = len(line)
+                        return
+                    i = match.start()
+                    c = match.group()
+                    state.pos = i + 1
+                    if c in '([{':
+                        state.depth += 1
+                        continue
+                    if c in ')]}':
+                        state.depth -= 1
+                        if c == ')' and state.depth == 0:
+                            yield from self._emit(state, line[state.args_start:i])
+                        continue
+                    if c != '\n':
+                        previous = line[state.args_start:i].rstrip()[-1:] or '('
+                        if previous in _QUOTE_OPENERS:
+                            state.quote = c
+                        continue
+                # Newline before the call was closed
+                yield from self._end_line(state, i)
+
+            else:
+                i = line.find('\n', state.pos)
+                if i < 0:
+                    state.pos = len(line)
+                    return
+                yield from self._end_line(state, i)
+
+    def _emit(self, state: _PlanStreamState, raw_args: str) -> Iterator[Task]:
+        logger.debug('# <_parse_task> ACTION: idx=%s, tool_name=%s, args="%s"', state.idx, state.tool_name, raw_args)
+        task = self._instantiate(
+            idx=state.idx,
+            tool_name=state.tool_name,
+            raw_args=raw_args,
+            thought=state.thought)
+        state.thought = None
+        state.mode = _SKIP
+        yield task
+
+    def _end_line(self, state: _PlanStreamState, end: int) -> Iterator[Task]:
+        """Finish the line that ends at `end` and start scanning the next one."""
+        line = state.line
+        if state.mode != _SKIP and end > 0:
+            # Thoughts, and calls whose parentheses never balanced, are parsed from the whole line
+            task, state.thought = self._parse_task(line[:end], state.thought)
             if task:
                 yield task
-
-    def _ingest_token(
-            self,
-            token: str,
-            buffer: List[str],
-            thought: Optional[str],
-    ) -> Iterator[Tuple[Optional[Task], str]]:
-        buffer.append(token)
-        if '\n' in token:
-            buffer_ = ''.join(buffer).split("\n")
-            suffix = buffer_[-1]
-            for line in buffer_[:-1]:
-                task, thought = self._parse_task(line, thought)
-                if task:
-                    yield task, thought
-            buffer.clear()
-            buffer.append(suffix)
+        state.line = line[end + 1:]
+        state.pos = 0
+        state.mode = _HEAD
+        state.depth = 0
+        state.quote = None
 
     def _parse_task(self, line: str, thought: Optional[str] = None) -> tuple[Task, str]:
         task = None
 
         # Optionally, action can be preceded by a thought
-        if match := re.match(THOUGHT_PATTERN, line):
+        if match := _THOUGHT_REGEX.match(line):
             thought = match.group(1)
-            print(f'# <_parse_task> THOUGHT: thought={thought}')
+            logger.debug('# <_parse_task> THOUGHT: thought=%s', thought)
 
         # If action is parsed, return the task, and clear the buffer
-        elif match := re.match(ACTION_PATTERN, line):
+        elif match := _ACTION_REGEX.match(line):
             idx, tool_name, raw_args, _ = match.groups()
-            print(f'# <_parse_task> ACTION: idx={idx}, tool_name={tool_name}, args="{raw_args}"')
+            logger.debug('# <_parse_task> ACTION: idx=%s, tool_name=%s, args="%s"', idx, tool_name, raw_args)
 
-            task = instantiate_task(
+            task = self._instantiate(
                 idx=int(idx),
                 tool_name=tool_name,
-                tools=self.tools,
                 raw_args=raw_args,
                 thought=thought)
             thought = None
 
         # Else it is just dropped
         else:
-            print(f'# <_parse_task> NOTHING: line={line}')
+            if line.strip() and line.strip() != END_OF_PLAN_MARKER:
+                _count(self.plan_format, "dropped")
+            logger.debug('# <_parse_task> NOTHING: line=%s', line)
 
         return task, thought
+
+
+_JSON_SCAN_REGEX = re.compile(r'[{}"]')
+_JSON_STRING_SCAN_REGEX = re.compile(r'["\\]')
+
+
+class _JsonPlanStreamState:
+    """Scanner state of one JSON plan stream. Only the object being streamed is buffered."""
+
+    __slots__ = ('text', 'pos', 'depth', 'in_string', 'start')
+
+    def __init__(self):
+        self.text = ''
+        self.pos = 0  # Everything before this position has been scanned
+        self.depth = 0
+        self.in_string = False
+        self.start = 0
+
+
+class LLMCompilerJsonPlanParser(LLMCompilerPlanParser):
+    """Planning output parser for plans written as JSON objects, one per action.
+
+    {"idx": 1, "tool": "search", "args": {"query": "..."}, "thought": "..."}
+
+    Each action is released as soon as its object closes. Objects may come
+    one per line, in an array, or inside a {"tasks": [...]} wrapper (released
+    when the wrapper closes); text in between, such as code fences, is ignored.
+    """
+
+    plan_format: ClassVar[str] = "json"
+
+    def _new_state(self) -> _JsonPlanStreamState:
+        return _JsonPlanStreamState()
+
+    def _flush(self, state: _JsonPlanStreamState) -> Iterator[Task]:
+        if state.depth:
+            # The stream ended inside an object
+            _count(self.plan_format, "dropped")
+            logger.debug('# <_parse_task> INCOMPLETE: text=%s', state.text[state.start:])
+        return iter(())
+
+    def _ingest_token(self, token: str, state: _JsonPlanStreamState) -> Iterator[Task]:
+        state.text += token
+        while True:
+            text = state.text
+            if state.in_string:
+                match = _JSON_STRING_SCAN_REGEX.search(text, state.pos)
+                if match is None:
+                    state.pos = len(text)
+                    return
+                if match.group() == '\\':
+                    if match.end() >= len(text):
+                        # The escaped character is in the next token
+                        state.pos = match.start()
+                        return
+                    state.pos = match.end() + 1
+                    continue
+                state.in_string = False
+                state.pos = match.end()
+                continue
+
+            match = _JSON_SCAN_REGEX.search(text, state.pos)
+            if match is None:
+                if state.depth == 0:
+                    # Nothing but text between objects so far
+                    state.text = ''
+                    state.pos = 0
+                else:
+                    state.pos = len(text)
+                return
+            c = match.group()
+            state.pos = match.end()
+            if c == '"':
+                state.in_string = state.depth > 0
+            elif c == '{':
+                if state.depth == 0:
+                    state.start = match.start()
+                state.depth += 1
+            elif state.depth > 0:
+                state.depth -= 1
+                if state.depth == 0:
+                    yield from self._parse_object(text[state.start:match.end()])
+                    state.text = text[match.end():]
+                    state.pos = 0
+
+    def _parse_object(self, raw: str) -> Iterator[Task]:
+        try:
+            obj = json.loads(raw)
+        except json.JSONDecodeError:
+            obj = None
+        if isinstance(obj, dict) and isinstance(obj.get("tasks"), list):
+            for item in obj["tasks"]:
+                yield from self._parse_object(json.dumps(item))
+            return
+        if not isinstance(obj, dict) or "idx" not in obj or "tool" not in obj:
+            _count(self.plan_format, "dropped")
+            logger.debug('# <_parse_task> NOTHING: object=%s', raw)
+            return
+        logger.debug('# <_parse_task> ACTION: %s', raw)
+        try:
+            task = instantiate_json_task(obj, self.tools)
+        except OutputParserException:
+            _count(self.plan_format, "errors")
+            raise
+        _count(self.plan_format, "errors" if is_unknown_tool(task) else "tasks")
+        yield task
@@ -0,0 +1,213 @@
+################################################################################
+# Plan cache: parameterized plan templates
+################################################################################
+
+import re
+import time
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from langchain_core.tools import BaseTool
+from managers.metric_manager import MetricManager
+from .output_parser import JOINER_TOOL_NAME, Task, get_dependencies_from_graph
+
+
+# Entities are the parts of a query that can change between queries of the
+# same shape: quoted strings, numbers and runs of capitalized words (names).
+_ENTITY_PATTERN = re.compile(r'"[^"\n]+"|\'[^\'\n]+\'|-?\d+(?:\.\d+)?|[A-Z][\w-]*(?:\s+[A-Z][\w-]*)*')
+_SENTENCE_START_PATTERN = re.compile(r'(^|[.!?]\s+)$')
+_SLOT = '\x00{}\x00'
+_SLOT_PATTERN = re.compile(r'\x00(\d+)\x00')
+
+
+class _NumberSlot(NamedTuple):
+    # A numeric argument (e.g. add(1, 3)) that came from an entity of the query
+    index: int
+
+
+def extract_entities(query: str) -> Tuple[str, List[str]]:
+    """Split a query into its shape and its entities."""
+    entities = []
+    shape = []
+    last = 0
+    for match in _ENTITY_PATTERN.finditer(query):
+        prefix, value = '', match.group(0)
+        if value[0].isupper() and _SENTENCE_START_PATTERN.search(query[:match.start()]):
+            # The first word of a sentence is capitalized anyway; keep the rest of the run
+            first, _, value = value.partition(' ')
+            prefix = first + ' '
+        if not value or value == 'I':
+            continue
+        shape.append(query[last:match.start()] + prefix)
+        shape.append(_SLOT.format(len(entities)))
+        entities.append(value.strip('"\''))
+        last = match.end()
+    shape.append(query[last:])
+    return ' '.join(''.join(shape).lower().split()), entities
+
+
+def _entity_pattern(entity: str) -> re.Pattern:
+    # Whole-token match only, never inside a $1/${1} task reference or a slot
+    return re.compile(r'(?<![\w.$\{\x00])' + re.escape(entity) + r'(?![\w.\x00])')
+
+
+def _templatize(value: Any, patterns: List[re.Pattern], used: set) -> Any:
+    if isinstance(value, str):
+        for i, pattern in enumerate(patterns):
+            value, n = pattern.subn(_SLOT.format(i), value)
+            if n:
+                used.add(i)
+        return value
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        for i, pattern in enumerate(patterns):
+            if pattern.fullmatch(str(value)):
+                used.add(i)
+                return _NumberSlot(i)
+        return value
+    elif isinstance(value, list):
+        return [_templatize(v, patterns, used) for v in value]
+    elif isinstance(value, dict):
+        return {k: _templatize(v, patterns, used) for k, v in value.items()}
+    return value
+
+
+def _instantiate(value: Any, entities: List[str]) -> Any:
+    if isinstance(value, _NumberSlot):
+        entity = entities[value.index]
+        try:
+            return int(entity)
+        except ValueError:
+            return float(entity)
+    elif isinstance(value, str):
+        return _SLOT_PATTERN.sub(lambda m: entities[int(m.group(1))], value)
+    elif isinstance(value, list):
+        return [_instantiate(v, entities) for v in value]
+    elif isinstance(value, dict):
+        return {k: _instantiate(v, entities) for k, v in value.items()}
+    return value
+
+
+def _reorder(value: Any, order: List[int]) -> Any:
+    # Map slot positions in sorted order back to entity positions in the query
+    if isinstance(value, _NumberSlot):
+        return _NumberSlot(order[value.index])
+    elif isinstance(value, str):
+        return _SLOT_PATTERN.sub(lambda m: _SLOT.format(order[int(m.group(1))]), value)
+    elif isinstance(value, list):
+        return [_reorder(v, order) for v in value]
+    elif isinstance(value, dict):
+        return {k: _reorder(v, order) for k, v in value.items()}
+    return value
+
+
+def _is_valid_plan(tasks: List[Task]) -> bool:
+    if len(tasks) < 2 or tasks[-1]["tool"] != JOINER_TOOL_NAME:
+        return False
+    for i, task in enumerate(tasks, 1):
+        if task["idx"] != i or any(d >= i for d in task["dependencies"]):
+            return False
+    return True
+
+
+# Templates by query shape; past _MAX_TEMPLATES the oldest is dropped
+_DATA: Dict[str, List[Tuple[int, str, Any, Optional[str]]]] = {}
+_MAX_TEMPLATES = 1024
+_STATS: Dict[str, float] = {
+    "hits": 0, "misses": 0, "stores": 0, "discards": 0, "match_time": 0.0, "plans": 0, "plan_time": 0.0}
+_LOCK = threading.Lock()
+
+
+class PlanCache:
+    @staticmethod
+    def lookup(query: str, tools: Dict[str, BaseTool]) -> Optional[List[Task]]:
+        """Instantiate the cached plan of a query with the same shape, if any."""
+        global _DATA, _STATS
+        start_time = time.perf_counter()
+        shape, entities = extract_entities(query)
+        template = _DATA.get(shape)
+        tasks = None
+        if template is not None and all(name == JOINER_TOOL_NAME or name in tools for _, name, _, _ in template):
+            tasks = []
+            for idx, tool_name, args, thought in template:
+                args = _instantiate(args, entities)
+                tasks.append(Task(
+                    idx=idx,
+                    tool=JOINER_TOOL_NAME if tool_name == JOINER_TOOL_NAME else tools[tool_name],
+                    args=args,
+                    dependencies=get_dependencies_from_graph(idx, tool_name, args),
+                    thought=thought))
+        with _LOCK:
+            _STATS["hits" if tasks else "misses"] += 1
+            _STATS["match_time"] += time.perf_counter() - start_time
+        return tasks
+
+    @staticmethod
+    def store(query: str, tasks: List[Task]) -> bool:
+        """Keep a validated plan as a template, if every entity maps onto its arguments."""
+        global _DATA, _STATS
+        if not _is_valid_plan(tasks):
+            return False
+        shape, entities = extract_entities(query)
+        if not entities or len(set(entities)) != len(entities):
+            return False
+        # Longer entities first, so that "Seoul Tower" wins over "Seoul"
+        order = sorted(range(len(entities)), key=lambda i: -len(entities[i]))
+        patterns = [_entity_pattern(entities[i]) for i in order]
+        used = set()
+        template = []
+        for task in tasks:
+            tool_name = task["tool"] if isinstance(task["tool"], str) else task["tool"].name
+            args = _reorder(_templatize(task["args"], patterns, used), order)
+            template.append((task["idx"], tool_name, args, task["thought"]))
+        if len(used) != len(entities):
+            # Some entity doesn't show up verbatim in the plan; it can't be substituted
+            return False
+        with _LOCK:
+            if len(_DATA) >= _MAX_TEMPLATES and shape not in _DATA:
+                _DATA.pop(next(iter(_DATA)))
+            _DATA[shape] = template
+            _STATS["stores"] += 1
+        return True
+
+    @staticmethod
+    def planned(seconds: float):
+        """Count a plan the LLM had to write, to estimate what a hit saves."""
+        global _STATS
+        with _LOCK:
+            _STATS["plans"] += 1
+            _STATS["plan_time"] += seconds
+
+    @staticmethod
+    def discard(query: str):
+        global _DATA, _STATS
+        shape, _ = extract_entities(query)
+        with _LOCK:
+            if _DATA.pop(shape, None) is not None:
+                _STATS["discards"] += 1
+
+    @staticmethod
+    def stats() -> Dict[str, float]:
+        global _DATA, _STATS
+        with _LOCK:
+            stats = dict(_STATS)
+        lookups = stats["hits"] + stats["misses"]
+        plan_time_avg = stats["plan_time"] / stats["plans"] if stats["plans"] else 0.0
+        return dict(
+            stats,
+            size=len(_DATA),
+            hit_rate=stats["hits"] / lookups if lookups else 0.0,
+            match_time_avg=stats["match_time"] / lookups if lookups else 0.0,
+            # Each hit skips a planner call of the average duration, minus the matching itself
+            saved_time=max(stats["hits"] * plan_time_avg - stats["match_time"], 0.0))
+
+
+def _collect():
+    stats = PlanCache.stats()
+    yield ("conductor_plan_cache_templates", "gauge", "Plan templates in the cache", {}, stats["size"])
+    yield ("conductor_plan_cache_match_seconds_total", "counter", "Time spent matching queries against the templates",
+           {}, stats["match_time"])
+    yield ("conductor_plan_cache_saved_seconds_total", "counter", "Planner time saved by cache hits (estimated)",
+           {}, stats["saved_time"])
+
+
+MetricManager.collector(_collect)
+
@@ -0,0 +1,144 @@
+################################################################################
+# Plan validation: between the plan parser and the scheduler
+################################################################################
+
+from collections import defaultdict
+from typing import AsyncIterator, Dict, Iterable, Iterator, List
+from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from .output_parser import JOINER_TOOL_NAME, Task, is_unknown_tool
+
+
+PLAN_ERROR_KEY = "plan_error"
+
+
+def is_plan_error(message: BaseMessage) -> bool:
+    return isinstance(message, SystemMessage) and bool(message.additional_kwargs.get(PLAN_ERROR_KEY))
+
+
+def count_plan_errors(messages: List[BaseMessage]) -> int:
+    """Plans rejected in a row for the current query."""
+    count = 0
+    for message in messages[::-1]:
+        if isinstance(message, HumanMessage):
+            break
+        if is_plan_error(message):
+            count += 1
+    return count
+
+
+class PlanValidator:
+    """Check tasks as they stream from the planner, before the scheduler sees them.
+
+    Tasks are passed through as soon as every index they reference has been
+    passed through (or observed in an earlier plan). The others are held back,
+    and whatever is still held when the stream ends is reported as a cycle or
+    a reference to an index that was never produced. Duplicate indices and
+    unknown tools (placeholder tasks from the parser) are reported right away.
+    """
+
+    def __init__(self, observed: Iterable[int] = ()):
+        self.observed = set(observed)
+        self.released = set()
+        self.held: Dict[int, Task] = {}
+        self.rejected = set()
+        self.dependents: Dict[int, List[int]] = defaultdict(list)
+        self.errors: List[str] = []
+        self.n_tasks = 0
+
+    def add(self, task: Task) -> List[Task]:
+        """Return the tasks that can be scheduled now."""
+        idx = task["idx"]
+        self.n_tasks += 1
+        if idx in self.observed or idx in self.released or idx in self.held or idx in self.rejected:
+            self.errors.append(f'Task {idx} is a duplicate of an earlier task with the same index.')
+            return []
+        if is_unknown_tool(task):
+            self.errors.append(f'Task {idx} calls "{task["tool"]}", which is not an available tool.')
+            self.rejected.add(idx)
+            return []
+        if task["tool"] == JOINER_TOOL_NAME:
+            # join() waits for whatever the plan produced before it, not for gaps in the numbering
+            produced = self.observed | self.released | set(self.held)
+            task = Task(task, dependencies=[d for d in task["dependencies"] if d in produced])
+        elif idx in task["dependencies"]:
+            self.errors.append(f'Task {idx} depends on its own output.')
+            self.rejected.add(idx)
+            return []
+        unresolved = [d for d in task["dependencies"] if d not in self.observed and d not in self.released]
+        if unresolved:
+            self.held[idx] = task
+            for d in unresolved:
+                self.dependents[d].append(idx)
+            return []
+        return self._release(task)
+
+    def finish(self):
+        """Report what the stream left unresolved."""
+        if self.n_tasks == 0 and not self.errors:
+            self.errors.append('The plan has no actions in the expected format.')
+        for idx in sorted(self.held):
+            missing = sorted(d for d in self.held[idx]["dependencies"]
+                             if d not in self.observed and d not in self.released and d not in self.held
+                             and d not in self.rejected)
+            if missing:
+                self.errors.append(f'Task {idx} depends on {missing}, which no task produces.')
+            elif self._in_cycle(idx):
+                self.errors.append(f'Task {idx} is part of a dependency cycle.')
+            else:
+                self.errors.append(f'Task {idx} depends on tasks that could not run.')
+        self.held.clear()
+
+    def wrap(self, tasks: Iterator[Task]) -> Iterator[Task]:
+        try:
+            for task in tasks:
+                yield from self.add(task)
+        except OutputParserException as e:
+            # The rest of the plan stream is lost; keep what was released
+            self.errors.append(f'Invalid action: {e}')
+        self.finish()
+
+    async def awrap(self, tasks: AsyncIterator[Task]) -> AsyncIterator[Task]:
+        try:
+            async for task in tasks:
+                for ready in self.add(task):
+                    yield ready
+        except OutputParserException as e:
+            self.errors.append(f'Invalid action: {e}')
+        self.finish()
+
+    def messages(self) -> List[BaseMessage]:
+        """A replan request describing what was wrong with the plan, if anything."""
+        if not self.errors:
+            return []
+        errors = '\n'.join(f' - {error}' for error in self.errors)
+        return [SystemMessage(
+            content=f'Context from last attempt: The plan could not be executed as written.\n{errors}\n'
+                    f'Fix these problems in the next plan.',
+            additional_kwargs={PLAN_ERROR_KEY: True})]
+
+    def _release(self, task: Task) -> List[Task]:
+        ready = []
+        queue = [task]
+        while queue:
+            task = queue.pop()
+            ready.append(task)
+            self.released.add(task["idx"])
+            for idx in self.dependents.pop(task["idx"], []):
+                held = self.held.get(idx)
+                if held and all(d in self.observed or d in self.released for d in held["dependencies"]):
+                    queue.append(self.held.pop(idx))
+        return ready
+
+    def _in_cycle(self, start: int) -> bool:
+        stack = [d for d in self.held[start]["dependencies"] if d in self.held]
+        visited = set()
+        while stack:
+            idx = stack.pop()
+            if idx == start:
+                return True
+            if idx in visited:
+                continue
+            visited.add(idx)
+            stack.extend(d for d in self.held[idx]["dependencies"] if d in self.held)
+        return False
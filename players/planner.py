@@ -2,12 +2,20 @@
 # Planner
 ################################################################################
 
+import time
+import logging
+from typing import AsyncIterator, Iterator
 from langchain_core.language_models import BaseChatModel
-from langchain_core.messages import FunctionMessage, SystemMessage
+from langchain_core.messages import FunctionMessage, HumanMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import Runnable, RunnableBranch
+from langchain_core.runnables import Runnable, RunnableBranch, RunnableConfig, RunnableGenerator
 from langchain_core.tools import BaseTool
-from .output_parser import LLMCompilerPlanParser
+from .events import is_error
+from .output_parser import LLMCompilerJsonPlanParser, LLMCompilerPlanParser, Task, get_dependencies_from_graph
+from .plan_cache import PlanCache
+
+
+logger = logging.getLogger(__name__)
 
 
 def build(
@@ -15,21 +23,32 @@ def build(
         tools: dict[str, BaseTool],
         prompt_template: ChatPromptTemplate,
         replanner_description: str,
+        use_plan_cache: bool = True,
+        plan_format: str = "text",
+        json_plan_description: str = '',
 ) -> Runnable:
+    """Build the planner; plan_format="json" asks for one JSON object per action instead of a numbered list."""
+    if plan_format not in ("text", "json"):
+        raise ValueError(f'Unknown plan format: {plan_format}')
     num_tools = len(tools) + 1  # Add one because we're adding the join() tool at the end.
     tool_descriptions = '\n'.join(f'{n}. {tool.description}\n' for n, tool in enumerate(tools.values(), 1))
     planner_prompt = prompt_template.partial(
         replan='', num_tools=num_tools, tool_descriptions=tool_descriptions)
     replanner_prompt = prompt_template.partial(
         replan=replanner_description, num_tools=num_tools, tool_descriptions=tool_descriptions)
+    if plan_format == "json":
+        # Comes last, so it overrides the numbered list format of the template
+        planner_prompt = planner_prompt + SystemMessage(content=json_plan_description)
+        replanner_prompt = replanner_prompt + SystemMessage(content=json_plan_description)
+        plan_parser = LLMCompilerJsonPlanParser(tools=tools)
+    else:
+        plan_parser = LLMCompilerPlanParser(tools=tools)
 
-    print(f'@@@@ BUILDING @@@@')
-    print('@@ <planner_prompt> @@')
-    planner_prompt.pretty_print()
-    print('@@ <replanner_prompt> @@')
-    replanner_prompt.pretty_print()
-    print('@@ <tool_descriptions> @@')
-    print(tool_descriptions)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('@@@@ BUILDING @@@@')
+        logger.debug('@@ <planner_prompt> @@\n%s', planner_prompt.pretty_repr())
+        logger.debug('@@ <replanner_prompt> @@\n%s', replanner_prompt.pretty_repr())
+        logger.debug('@@ <tool_descriptions> @@\n%s', tool_descriptions)
 
     def should_replan(messages: list):
         # Context is passed as a system message
@@ -47,11 +66,76 @@ def build(
         messages[-1].content = messages[-1].content + f' - Begin counting at : {next_task}'
         return {"messages": messages}
 
-    return (
+    llm_planner = (
         RunnableBranch(
             (should_replan, wrap_and_get_last_index | replanner_prompt),
             wrap_messages | planner_prompt,
         )
         | model
-        | LLMCompilerPlanParser(tools=tools)
+        | plan_parser
     )
+    if not use_plan_cache:
+        return llm_planner
+
+    def get_query(messages: list) -> str | None:
+        for message in messages[::-1]:
+            if isinstance(message, HumanMessage):
+                return str(message.content)
+        return None
+
+    def lookup(messages: list) -> list[Task] | None:
+        query = get_query(messages)
+        if query is None:
+            return None
+        if should_replan(messages):
+            # The plan for this query shape wasn't good enough, don't reuse it
+            PlanCache.discard(query)
+            return None
+        tasks = PlanCache.lookup(query, tools)
+        logger.debug('# <plan_cache> %s %s', "HIT" if tasks else "MISS", PlanCache.stats())
+        return tasks
+
+    def plan(inputs: Iterator[list], config: RunnableConfig) -> Iterator[Task]:
+        for messages in inputs:
+            cached = lookup(messages)
+            if cached:
+                yield from cached
+                continue
+            start_time = time.perf_counter()
+            yield from llm_planner.stream(messages, config)
+            PlanCache.planned(time.perf_counter() - start_time)
+
+    async def aplan(inputs: AsyncIterator[list], config: RunnableConfig) -> AsyncIterator[Task]:
+        async for messages in inputs:
+            cached = lookup(messages)
+            if cached:
+                for task in cached:
+                    yield task
+                continue
+            start_time = time.perf_counter()
+            async for task in llm_planner.astream(messages, config):
+                yield task
+            PlanCache.planned(time.perf_counter() - start_time)
+
+    return RunnableGenerator(plan, aplan, name="planner")
+
+
+def remember_plan(messages: list) -> bool:
+    """Keep the plan that answered the last query as a template for queries of the same shape.
+
+    Called with the joiner's decision appended, so only a plan the joiner
+    accepted is stored: the first plan for the query, with no plan errors,
+    replans or failed tool calls.
+    """
+    tasks = []
+    for message in messages[::-1]:
+        if isinstance(message, HumanMessage):
+            tasks.sort(key=lambda task: task["idx"])
+            return PlanCache.store(str(message.content), tasks)
+        if isinstance(message, SystemMessage) or (isinstance(message, FunctionMessage) and is_error(message.content)):
+            return False
+        if isinstance(message, FunctionMessage):
+            idx, args = message.additional_kwargs["idx"], message.additional_kwargs["args"]
+            tasks.append(Task(idx=idx, tool=message.name, args=args,
+                              dependencies=get_dependencies_from_graph(idx, message.name, args), thought=None))
+    return False
@@ -4,19 +4,38 @@
 
 import re
 import time
+import asyncio
+import logging
 import itertools
-from typing import Any, Dict, Iterator, List, Union
+import threading
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Dict, Iterator, List, Tuple, Union
 from typing_extensions import TypedDict
-from concurrent.futures import ThreadPoolExecutor, wait
+from langchain_core.callbacks.manager import adispatch_custom_event, dispatch_custom_event
 from langchain_core.messages import BaseMessage, FunctionMessage
-from langchain_core.runnables import chain as as_runnable
+from langchain_core.runnables import RunnableLambda, chain as as_runnable
+from langchain_core.runnables.config import get_async_callback_manager_for_config, get_callback_manager_for_config
 from langchain_core.runnables.base import Runnable
+from langchain_core.tools import BaseTool, StructuredTool
+from managers.cache_manager import CACHE_HIT_EVENT, CacheManager
+from managers.trace_manager import TraceManager
+from managers.worker_manager import WorkerManager
+from .events import PLAN, TASK_RESULT, TASK_START, Emit, emitter, is_error
 from .output_parser import Task
+from .plan_validator import PlanValidator
 
 
-class SchedulerInput(TypedDict):
+logger = logging.getLogger(__name__)
+
+# Upper bound on the number of tools running at once in a single async schedule
+DEFAULT_MAX_CONCURRENCY = 32
+
+
+class SchedulerInput(TypedDict, total=False):
     messages: List[BaseMessage]
-    tasks: Iterator[Task]
+    tasks: Iterator[Task] | AsyncIterator[Task]
+    max_concurrency: int
 
 
 def _get_observations(messages: List[BaseMessage]) -> Dict[int, Any]:
@@ -44,43 +63,198 @@ def _resolve_arg(arg: Union[str, Any], observations: Dict[int, Any]):
         return None
     elif isinstance(arg, str):
         return re.sub(_ID_PATTERN, replace_match, arg)
-    elif isinstance(arg, list):
+    elif isinstance(arg, (list, tuple)):
         return [_resolve_arg(a, observations) for a in arg]
     else:
         return str(arg)
 
 
+def _resolve_task_args(args, observations: Dict[int, Any]):
+    if isinstance(args, str):
+        return _resolve_arg(args, observations)
+    elif isinstance(args, dict):
+        return {k: _resolve_arg(v, observations) for k, v in args.items()}
+    elif isinstance(args, (list, tuple)):
+        return _resolve_arg(args, observations)
+
+    else:
+        # This will likely fail
+        return args
+
+
+def _is_async_tool(tool: BaseTool) -> bool:
+    """Whether the tool can be awaited natively instead of in a thread."""
+    if isinstance(tool, StructuredTool):
+        return tool.coroutine is not None
+    return type(tool)._arun is not BaseTool._arun
+
+
+def _is_cpu_bound_tool(tool: BaseTool) -> bool:
+    """Whether the tool opted in to run in a worker process (metadata={"cpu_bound": True})."""
+    if not (tool.metadata and tool.metadata.get("cpu_bound")):
+        return False
+    # Only module-level functions can be sent to another process; they are pickled by reference
+    func = tool.func if isinstance(tool, StructuredTool) else None
+    if func is None or '<locals>' in getattr(func, '__qualname__', '<locals>'):
+        logger.warning('# <scheduler> %s is marked cpu_bound but its function can\'t be pickled, running it in-process',
+                       tool.name)
+        return False
+    return True
+
+
+def _call_tool_function(func, args, kwargs):
+    # Runs in the worker process
+    return func(*args, **kwargs)
+
+
+def _invoke_in_process(tool: StructuredTool, resolved_args) -> Future:
+    # Validate in this process so only the function reference and the
+    # parsed arguments are pickled, not the tool or the observations
+    args, kwargs = tool._to_args_and_kwargs(resolved_args, None)
+    return WorkerManager.submit_process(_call_tool_function, tool.func, args, kwargs)
+
+
+def _tool_start_args(tool: StructuredTool, resolved_args) -> tuple:
+    # What tool.invoke reports to the callbacks, which don't see the worker process
+    return ({"name": tool.name, "description": tool.description}, str(resolved_args)), dict(
+        name=tool.name, inputs=resolved_args if isinstance(resolved_args, dict) else None)
+
+
+def _run_in_process(tool: StructuredTool, resolved_args, config):
+    args, kwargs = _tool_start_args(tool, resolved_args)
+    run_manager = get_callback_manager_for_config(config).on_tool_start(*args, **kwargs)
+    try:
+        observation = _invoke_in_process(tool, resolved_args).result()
+    except Exception as e:
+        run_manager.on_tool_error(e)
+        raise
+    run_manager.on_tool_end(observation)
+    return observation
+
+
+async def _arun_in_process(tool: StructuredTool, resolved_args, config):
+    args, kwargs = _tool_start_args(tool, resolved_args)
+    run_manager = await get_async_callback_manager_for_config(config).on_tool_start(*args, **kwargs)
+    try:
+        # Awaited without tying up a thread of the shared pool
+        observation = await asyncio.wrap_future(_invoke_in_process(tool, resolved_args))
+    except Exception as e:
+        await run_manager.on_tool_error(e)
+        raise
+    await run_manager.on_tool_end(observation)
+    return observation
+
+
 def _execute_task(task: Task, observations, config):
     tool_to_use = task["tool"]
     if isinstance(tool_to_use, str):
         return tool_to_use
-    print(f'# <_execute_task> tool={tool_to_use.name}, args={task["args"]}')
+    logger.debug('# <_execute_task> tool=%s, args=%s', tool_to_use.name, task["args"])
     args = task["args"]
     try:
-        if isinstance(args, str):
-            resolved_args = _resolve_arg(args, observations)
-        elif isinstance(args, dict):
-            resolved_args = {k: _resolve_arg(v, observations) for k, v in args.items()}
+        resolved_args = _resolve_task_args(args, observations)
+    except Exception as e:
+        return (
+            f'ERROR'
+            f' (Failed to call {tool_to_use.name} with args {args}.'
+            f' Args could not be resolved. Error: {repr(e)})')
+    hit, observation = CacheManager.lookup(tool_to_use.name, resolved_args)
+    if hit:
+        dispatch_custom_event(
+            CACHE_HIT_EVENT, {"name": tool_to_use.name, "inputs": resolved_args, "output": observation}, config=config)
+        return observation
+    try:
+        if _is_cpu_bound_tool(tool_to_use):
+            observation = _run_in_process(tool_to_use, resolved_args, config)
+        else:
+            observation = tool_to_use.invoke(resolved_args, config)
+    except Exception as e:
+        return (
+            f'ERROR'
+            f' (Failed to call {tool_to_use.name} with args {args}.'
+            f' Args resolved to {resolved_args}. Error: {repr(e)})')
+    CacheManager.store(tool_to_use.name, resolved_args, observation)
+    return observation
 
-        # TODO: test
-        elif isinstance(args, (list, tuple)):
-            resolved_args = _resolve_arg(args, observations)
 
-        else:
-            # This will likely fail
-            resolved_args = args
+async def _aexecute_task(task: Task, observations, config):
+    tool_to_use = task["tool"]
+    if isinstance(tool_to_use, str):
+        return tool_to_use
+    if not _is_async_tool(tool_to_use) and not _is_cpu_bound_tool(tool_to_use):
+        # Sync-only tools fall back to the shared thread pool
+        return await asyncio.wrap_future(
+            WorkerManager.submit(tool_to_use.name, _execute_task, task, observations, config))
+    logger.debug('# <_aexecute_task> tool=%s, args=%s', tool_to_use.name, task["args"])
+    args = task["args"]
+    try:
+        resolved_args = _resolve_task_args(args, observations)
     except Exception as e:
         return (
             f'ERROR'
             f' (Failed to call {tool_to_use.name} with args {args}.'
             f' Args could not be resolved. Error: {repr(e)})')
+    hit, observation = CacheManager.lookup(tool_to_use.name, resolved_args)
+    if hit:
+        await adispatch_custom_event(
+            CACHE_HIT_EVENT, {"name": tool_to_use.name, "inputs": resolved_args, "output": observation}, config=config)
+        return observation
     try:
-        return tool_to_use.invoke(resolved_args, config)
+        if _is_cpu_bound_tool(tool_to_use):
+            observation = await WorkerManager.run(tool_to_use.name, _arun_in_process, tool_to_use, resolved_args, config)
+        else:
+            observation = await WorkerManager.run(tool_to_use.name, tool_to_use.ainvoke, resolved_args, config)
     except Exception as e:
         return (
             f'ERROR'
             f' (Failed to call {tool_to_use.name} with args {args}.'
             f' Args resolved to {resolved_args}. Error: {repr(e)})')
+    CacheManager.store(tool_to_use.name, resolved_args, observation)
+    return observation
+
+
+def _unresolved_error(task: Task, observations: Dict[int, Any]) -> str:
+    missing = [d for d in task["dependencies"] if d not in observations]
+    return (
+        f'ERROR'
+        f' (Task {task["idx"]} was not executed. Its dependencies {missing} were never produced.)')
+
+
+def _to_function_messages(
+        observations: Dict[int, Any],
+        originals: set,
+        task_names: Dict[int, str],
+        args_for_tasks: Dict[int, Any],
+) -> List[FunctionMessage]:
+    # Convert observations to new tool messages to add to the state
+    new_observations = {
+        k: (task_names[k], args_for_tasks[k], observations[k])
+        for k in sorted(observations.keys() - originals)
+    }
+    tool_messages = [
+        FunctionMessage(
+            name=name,
+            content=str(obs),
+            additional_kwargs={"idx": k, "args": task_args},
+            tool_call_id=k,
+        )
+        for k, (name, task_args, obs) in new_observations.items()
+    ]
+    return tool_messages
+
+
+def _ignore(event: dict):
+    pass
+
+
+def _task_event(type: str, task: Task, **fields) -> dict:
+    tool = task["tool"] if isinstance(task["tool"], str) else task["tool"].name
+    return {"type": type, "idx": task["idx"], "tool": tool, **fields}
+
+
+def _result_event(task: Task, observation, start: float) -> dict:
+    return _task_event(TASK_RESULT, task, observation=str(observation), error=is_error(observation),
+                       duration=time.perf_counter() - start)
 
 
 @as_runnable
@@ -92,102 +266,308 @@ def _schedule_task(task_inputs, config):
     except Exception as e:
         import traceback
         observation = traceback.format_exception(e)
-    observations[task["idx"]] = observation
+    return observation
+
+
+class _DependencyTracker:
+    """Dispatch each task as soon as its last dependency has been observed."""
+
+    def __init__(self, observations: Dict[int, Any]):
+        self.observations = observations
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.waiting: Dict[int, Task] = {}
+        self.remaining: Dict[int, int] = {}
+        self.dependents: Dict[int, List[int]] = defaultdict(list)
+        self.running = 0
+        # Tasks are submitted from the worker threads too, whose current span is another task
+        self.parent = TraceManager.current()
+        self.emit = emitter()
+
+    def add(self, task: Task):
+        with self.lock:
+            unresolved = {d for d in task["dependencies"] if d not in self.observations}
+            if not unresolved:
+                self._submit(task)
+                return
+            idx = task["idx"]
+            self.waiting[idx] = task
+            self.remaining[idx] = len(unresolved)
+            for d in unresolved:
+                self.dependents[d].append(idx)
+
+    def join(self):
+        # Wait for every dispatched task (and everything it unblocks) to finish
+        with self.lock:
+            while self.running:
+                self.idle.wait()
+            # Watchdog: the plan stream has ended and nothing is running, so
+            # whatever still waits (cycles, missing indices) never will
+            errors = {idx: _unresolved_error(task, self.observations) for idx, task in self.waiting.items()}
+            for idx, error in sorted(errors.items()):
+                logger.warning('# <_DependencyTracker> released stuck task %s', idx)
+                self.observations[idx] = error
+            self.waiting.clear()
+            self.remaining.clear()
+            self.dependents.clear()
+
+    def _submit(self, task: Task):
+        # Must be called with the lock held
+        self.running += 1
+        tool_name = task["tool"] if isinstance(task["tool"], str) else task["tool"].name
+        span = TraceManager.start("task", parent=self.parent, tool=tool_name, idx=task["idx"])
+        try:
+            with TraceManager.use(span):
+                WorkerManager.submit(tool_name, self._run, task, span)
+        except Exception:
+            # Never dispatched, so _run won't release it
+            self.running -= 1
+            TraceManager.finish(span)
+            raise
+
+    def _run(self, task: Task, span):
+        start = time.perf_counter()
+        # The join placeholder at the end of a plan isn't a tool call
+        emit = self.emit if not isinstance(task["tool"], str) else _ignore
+        observation = None
+        try:
+            emit(_task_event(TASK_START, task, args=task["args"]))
+            observation = _schedule_task.invoke({"task": task, "observations": self.observations})
+            TraceManager.finish(span)
+            emit(_result_event(task, observation, start))
+        except Exception as e:
+            # Nobody reads the worker's future: the failure becomes the
+            # observation, so the dependents are released and join() returns
+            logger.exception('# <_DependencyTracker> task %s failed', task["idx"])
+            if observation is None:
+                observation = f'ERROR (Task {task["idx"]} failed. Error: {repr(e)})'
+        finally:
+            with self.lock:
+                self.observations[task["idx"]] = observation
+                try:
+                    for idx in self.dependents.pop(task["idx"], []):
+                        self.remaining[idx] -= 1
+                        if self.remaining[idx] == 0:
+                            del self.remaining[idx]
+                            self._submit(self.waiting.pop(idx))
+                finally:
+                    self.running -= 1
+                    self.idle.notify_all()
+
+
+def _schedule_tasks_in_threads(scheduler_input: SchedulerInput) -> List[FunctionMessage]:
+    """Group the tasks into a DAG schedule, running tools on a thread pool."""
+
+    # Tasks may depend on tasks later in the stream. Cycles and missing
+    # indices are normally held back by the PlanValidator; if they get
+    # here anyway, the tracker releases them once the stream has ended.
+    messages = scheduler_input["messages"]
+    tasks = scheduler_input["tasks"]
+    args_for_tasks = {}
+
+    # If we are re-planning, we may have calls that depend on previous
+    # plans. Start with those.
+    observations = _get_observations(messages)
+    originals = set(observations)
+    task_names = {}
+
+    # Observations are only written under the tracker's lock, and a task
+    # is dispatched only after all of its dependencies have been written.
+    # Tools run on the process-wide pool, which applies the per-tool caps.
+    tracker = _DependencyTracker(observations)
+    for task in tasks:
+        task_names[task["idx"]] = task["tool"] if isinstance(task["tool"], str) else task["tool"].name
+        args_for_tasks[task["idx"]] = task["args"]
+        tracker.emit(_task_event(PLAN, task, args=task["args"], dependencies=task["dependencies"]))
+        # Ready tasks are submitted right away, the others when their
+        # last dependency completes. Either way the plan stream keeps flowing.
+        tracker.add(task)
+
+    # All tasks have been submitted or enqueued
+    # Wait for them to complete
+    tracker.join()
+
+    return _to_function_messages(observations, originals, task_names, args_for_tasks)
+
+
+class _Watchdog:
+    """Release tasks that wait on dependencies which will never be observed."""
+
+    def __init__(self, observations: Dict[int, Any]):
+        self.observations = observations
+        self.unfinished = 0
+        self.waiting: Dict[int, Tuple[Task, int]] = {}  # id(task) -> (task, the dependency it waits for)
+        self.stream_ended = False
+        self.stuck: Dict[int, str] = {}  # id(task) -> error observation
+        self.released = asyncio.Event()
+
+    def check(self):
+        # Once the plan stream has ended, if every unfinished task waits for
+        # something that hasn't been observed, none of them will ever run
+        if (self.stream_ended and self.unfinished and len(self.waiting) == self.unfinished
+                and all(d not in self.observations for _, d in self.waiting.values())):
+            logger.warning('# <_Watchdog> released %d stuck task(s)', len(self.waiting))
+            self.stuck = {key: _unresolved_error(task, self.observations) for key, (task, _) in self.waiting.items()}
+            self.released.set()
+
+    async def wait(self, task: Task, d: int, event: asyncio.Event):
+        self.waiting[id(task)] = (task, d)
+        self.check()
+        waiters = [asyncio.ensure_future(event.wait()), asyncio.ensure_future(self.released.wait())]
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+            del self.waiting[id(task)]
 
 
-def _schedule_pending_task(
+async def _aschedule_task(
         task: Task,
         observations: Dict[int, Any],
-        retry_after: float = 0.2,
+        done: Dict[int, asyncio.Event],
+        semaphore: asyncio.Semaphore,
+        watchdog: _Watchdog,
+        emit: Emit,
+        config,
 ):
-    while True:
-        dependencies = task["dependencies"]
-
-        # Dependencies not yet satisfied
-        if dependencies and (any([d not in observations for d in dependencies])):
-            time.sleep(retry_after)
-            continue
+    # Wait until every dependency has been observed
+    for d in task["dependencies"]:
+        if d not in observations and not watchdog.released.is_set():
+            await watchdog.wait(task, d, done.setdefault(d, asyncio.Event()))
+    if id(task) in watchdog.stuck:
+        # Like the thread tracker, everything that was stuck fails together
+        observation = watchdog.stuck[id(task)]
+    elif any(d not in observations for d in task["dependencies"]):
+        observation = _unresolved_error(task, observations)
+    else:
+        tool_name = task["tool"] if isinstance(task["tool"], str) else task["tool"].name
+        with TraceManager.span("task", tool=tool_name, idx=task["idx"]):
+            # Only running tools count against the concurrency bound, not waiting ones
+            async with semaphore:
+                start = time.perf_counter()
+                if isinstance(task["tool"], str):
+                    emit = _ignore
+                emit(_task_event(TASK_START, task, args=task["args"]))
+                try:
+                    observation = await _aexecute_task(task, observations, config)
+                except Exception as e:
+                    import traceback
+                    observation = traceback.format_exception(e)
+                emit(_result_event(task, observation, start))
+    observations[task["idx"]] = observation
+    done.setdefault(task["idx"], asyncio.Event()).set()
+    watchdog.unfinished -= 1
+    watchdog.check()
 
-        _schedule_task.invoke({"task": task, "observations": observations})
-        break
 
+async def _schedule_tasks_in_loop(scheduler_input: SchedulerInput, config) -> List[FunctionMessage]:
+    """Group the tasks into a DAG schedule, awaiting tools on the event loop."""
 
-@as_runnable
-def _schedule_tasks(scheduler_input: SchedulerInput) -> List[FunctionMessage]:
-    """Group the tasks into a DAG schedule."""
-
-    # For streaming, we are making a few simplifying assumption:
-    # 1. The LLM does not create cyclic dependencies
-    # 2. That the LLM will not generate tasks with future deps
-    # If this ceases to be a good assumption, you can either
-    # adjust to do a proper topological sort (not-stream)
-    # or use a more complicated data structure.
+    # Same as _schedule_tasks_in_threads, with a watchdog for stuck waits
     messages = scheduler_input["messages"]
     tasks = scheduler_input["tasks"]
+    max_concurrency = scheduler_input.get("max_concurrency") or DEFAULT_MAX_CONCURRENCY
     args_for_tasks = {}
 
-    # If we are re-planning, we may have calls that depend on previous
-    # plans. Start with those.
     observations = _get_observations(messages)
     originals = set(observations)
     task_names = {}
 
-    # ^^ We assume each task inserts a different key above to
-    # avoid race conditions...
-    futures = []
-    retry_after = 0.25  # Retry every quarter second
-    with ThreadPoolExecutor() as executor:
-        for task in tasks:
-            dependencies = task["dependencies"]
+    # One event per task index, set when its observation is available
+    done: Dict[int, asyncio.Event] = {}
+    semaphore = asyncio.Semaphore(max_concurrency)
+    watchdog = _Watchdog(observations)
+    emit = emitter()
+    async with asyncio.TaskGroup() as group:
+        async for task in tasks:
             task_names[task["idx"]] = task["tool"] if isinstance(task["tool"], str) else task["tool"].name
             args_for_tasks[task["idx"]] = task["args"]
+            emit(_task_event(PLAN, task, args=task["args"], dependencies=task["dependencies"]))
+            # Schedule right away; the task itself waits for its dependencies
+            watchdog.unfinished += 1
+            group.create_task(_aschedule_task(task, observations, done, semaphore, watchdog, emit, config))
+        watchdog.stream_ended = True
+        watchdog.check()
+        # Leaving the group waits for every scheduled task to complete
 
-            # Depends on other tasks
-            if dependencies and (any([d not in observations for d in dependencies])):
-                futures.append(executor.submit(_schedule_pending_task, task, observations, retry_after))
+    return _to_function_messages(observations, originals, task_names, args_for_tasks)
 
-            # No dependencies or all dependencies satisfied, can schedule now
-            else:
-                _schedule_task.invoke(dict(task=task, observations=observations))
-                # futures.append(executor.submit(schedule_task.invoke, dict(task=task, observations=observations)))
 
-        # All tasks have been submitted or enqueued
-        # Wait for them to complete
-        wait(futures)
+# invoke() runs the tools on a thread pool; ainvoke() awaits coroutine-capable
+# tools on the event loop and only falls back to threads for sync-only tools.
+_schedule_tasks = RunnableLambda(
+    _schedule_tasks_in_threads, afunc=_schedule_tasks_in_loop, name="_schedule_tasks")
 
-    # Convert observations to new tool messages to add to the state
-    new_observations = {
-        k: (task_names[k], args_for_tasks[k], observations[k])
-        for k in sorted(observations.keys() - originals)
-    }
-    tool_messages = [
-        FunctionMessage(
-            name=name,
-            content=str(obs),
-            additional_kwargs={"idx": k, "args": task_args},
-            tool_call_id=k,
-        )
-        for k, (name, task_args, obs) in new_observations.items()
-    ]
-    return tool_messages
+
+def _trace_plan(tasks: Iterator[Task]) -> Iterator[Task]:
+    # The planner span covers the whole stream; the planner's LLM call nests under it
+    span = TraceManager.start("planner")
+    try:
+        while True:
+            with TraceManager.use(span):
+                task = next(tasks, None)
+            if task is None:
+                return
+            if "first_task" not in span.attributes:
+                span.set(first_task=time.perf_counter() - span.start)
+                TraceManager.record("planner.first_task", span.start)
+            yield task
+    finally:
+        TraceManager.finish(span)
+
+
+async def _atrace_plan(tasks: AsyncIterator[Task]) -> AsyncIterator[Task]:
+    span = TraceManager.start("planner")
+    try:
+        while True:
+            with TraceManager.use(span):
+                task = await anext(tasks, None)
+            if task is None:
+                return
+            if "first_task" not in span.attributes:
+                span.set(first_task=time.perf_counter() - span.start)
+                TraceManager.record("planner.first_task", span.start)
+            yield task
+    finally:
+        TraceManager.finish(span)
+
+
+def _log_messages(name: str, messages: List[BaseMessage]):
+    if logger.isEnabledFor(logging.DEBUG):
+        for msg in messages:
+            logger.debug('# <%s> %s %s', name, msg.__class__, msg)
 
 
-def build(planner: Runnable) -> Runnable:
+def build(planner: Runnable, max_concurrency: int = DEFAULT_MAX_CONCURRENCY) -> Runnable:
 
-    @as_runnable
     def plan_and_execute(state):
         messages = state["messages"]
-        for msg in messages:
-            print(f'# <plan_and_execute> {msg.__class__} {msg}')
+        _log_messages("plan_and_execute", messages)
+
+        with TraceManager.span("plan_and_execute"):
+            # Tasks with duplicate indices, cycles or missing dependencies never reach the scheduler
+            validator = PlanValidator(_get_observations(messages))
+            tasks: Iterator[Task] = validator.wrap(_trace_plan(planner.stream(messages)))
+            # Begin executing the planner immediately
+            try:
+                tasks = itertools.chain([next(tasks)], tasks)
+            except StopIteration:
+                # Handle the case where tasks is empty.
+                tasks = iter([])
+            executed_tasks = _schedule_tasks.invoke({"messages": messages, "tasks": tasks})
+        return {"messages": executed_tasks + validator.messages()}
+
+    async def aplan_and_execute(state):
+        messages = state["messages"]
+        _log_messages("aplan_and_execute", messages)
 
-        tasks: Iterator[Task] = planner.stream(messages)
-        # Begin executing the planner immediately
-        try:
-            tasks = itertools.chain([next(tasks)], tasks)
-        except StopIteration:
-            # Handle the case where tasks is empty.
-            tasks = iter([])
-        executed_tasks = _schedule_tasks.invoke({"messages": messages, "tasks": tasks})
-        return {"messages": executed_tasks}
-
-    return plan_and_execute
+        with TraceManager.span("plan_and_execute"):
+            # Tasks are scheduled as soon as the planner streams them and they pass validation
+            validator = PlanValidator(_get_observations(messages))
+            tasks: AsyncIterator[Task] = validator.awrap(_atrace_plan(planner.astream(messages)))
+            executed_tasks = await _schedule_tasks.ainvoke(
+                {"messages": messages, "tasks": tasks, "max_concurrency": max_concurrency})
+        return {"messages": executed_tasks + validator.messages()}
+
+    return RunnableLambda(plan_and_execute, afunc=aplan_and_execute, name="plan_and_execute")
@@ -0,0 +1,13 @@
+################################################################################
+# Tests: shared setup
+################################################################################
+#
+# python -m pytest tests
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The modules import each other from the repo root, as main.py does
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # the prompt manager loads its templates relative to the working directory
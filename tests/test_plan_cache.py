@@ -0,0 +1,162 @@
+################################################################################
+# Tests: plan templates, and storing only plans the joiner accepted
+################################################################################
+
+import pytest
+from langchain_core.messages import AIMessage, FunctionMessage, HumanMessage, SystemMessage
+from langchain_core.tools import StructuredTool
+import conductor
+from benchmarks.fakes import ScriptedChatModel
+from managers.prompt_manager import PromptManager
+from players import plan_cache
+from players.output_parser import LLMCompilerPlanParser
+from players.plan_cache import PlanCache, extract_entities
+from players.planner import remember_plan
+
+
+def search(query: str) -> str:
+    """Search the web."""
+    return query
+
+
+def add(a: float, b: float) -> float:
+    """Add two numbers."""
+    return a + b
+
+
+TOOLS = {tool.name: tool for tool in map(StructuredTool.from_function, [search, add])}
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    plan_cache._DATA.clear()
+    yield
+    plan_cache._DATA.clear()
+
+
+def _plan(text: str) -> list:
+    return LLMCompilerPlanParser(tools=TOOLS).parse(text)
+
+
+def _summary(tasks: list) -> list:
+    return [(t["idx"], t["tool"] if isinstance(t["tool"], str) else t["tool"].name, t["args"], t["dependencies"])
+            for t in tasks]
+
+
+def test_extract_entities_numbers():
+    assert extract_entities("what is 3 plus -4.5?") == ("what is \x000\x00 plus \x001\x00?", ["3", "-4.5"])
+
+
+def test_extract_entities_multi_word_names():
+    shape, entities = extract_entities("How far is New York from San Francisco?")
+    assert entities == ["New York", "San Francisco"]
+    # The capitalized first word of the sentence is part of the shape, not an entity
+    assert shape == "how far is \x000\x00 from \x001\x00?"
+    assert extract_entities("How far is Seoul from Busan?")[0] == shape
+
+
+def test_extract_entities_quoted_strings():
+    assert extract_entities("search for 'deep learning' papers")[1] == ["deep learning"]
+
+
+def test_numeric_slots_are_instantiated_as_numbers():
+    assert PlanCache.store("what is 3 plus 4?", _plan('1. add(3, 4)\n2. join()'))
+    tasks = PlanCache.lookup("what is 10 plus 2.5?", TOOLS)
+    assert _summary(tasks) == [(1, "add", {"a": 10, "b": 2.5}, []), (2, "join", {}, [1])]
+
+
+def test_multi_word_names_are_substituted():
+    plan = '1. search("weather in New York")\n2. search("weather in San Francisco")\n3. join()'
+    assert PlanCache.store("Compare the weather in New York and San Francisco", _plan(plan))
+    tasks = PlanCache.lookup("Compare the weather in Los Angeles and Seoul", TOOLS)
+    assert [t["args"]["query"] for t in tasks[:2]] == ["weather in Los Angeles", "weather in Seoul"]
+
+
+def test_longer_entities_win_over_their_prefixes():
+    plan = '1. search("Seoul Tower")\n2. search("Seoul")\n3. join()'
+    assert PlanCache.store("How tall is Seoul Tower, and how big is Seoul?", _plan(plan))
+    tasks = PlanCache.lookup("How tall is Tokyo Tower, and how big is Tokyo?", TOOLS)
+    assert [t["args"]["query"] for t in tasks[:2]] == ["Tokyo Tower", "Tokyo"]
+
+
+def test_references_survive_instantiation():
+    plan = '1. search("age of Obama")\n2. add("$1", 2)\n3. join()'
+    assert PlanCache.store("What is the age of Obama plus 2?", _plan(plan))
+    tasks = PlanCache.lookup("What is the age of Biden plus 7?", TOOLS)
+    assert _summary(tasks) == [
+        (1, "search", {"query": "age of Biden"}, []), (2, "add", {"a": "$1", "b": 7}, [1]), (3, "join", {}, [1, 2])]
+
+
+def test_duplicate_entities_are_rejected():
+    assert not PlanCache.store("what is 3 plus 3?", _plan('1. add(3, 3)\n2. join()'))
+    assert PlanCache.lookup("what is 5 plus 6?", TOOLS) is None
+
+
+def test_entities_missing_from_the_plan_are_rejected():
+    assert not PlanCache.store("what is 3 plus 4?", _plan('1. add(3, 5)\n2. join()'))
+
+
+def test_plans_without_a_join_or_with_forward_references_are_rejected():
+    assert not PlanCache.store("what is 3 plus 4?", _plan('1. add(3, 4)'))
+    assert not PlanCache.store("what is 3 plus 4?", _plan('1. add(3, "$2")\n2. add(4, 1)\n3. join()'))
+
+
+def test_templates_need_every_tool():
+    assert PlanCache.store("what is 3 plus 4?", _plan('1. add(3, 4)\n2. join()'))
+    assert PlanCache.lookup("what is 1 plus 2?", {"search": TOOLS["search"]}) is None
+
+
+def _executed(query: str, *extra) -> list:
+    return [
+        HumanMessage(content=query),
+        FunctionMessage(name="add", content="7", additional_kwargs={"idx": 1, "args": {"a": 3, "b": 4}}),
+        FunctionMessage(name="join", content="join", additional_kwargs={"idx": 2, "args": {}}),
+        *extra,
+    ]
+
+
+FINAL = [AIMessage(content="Thought: done."), AIMessage(content="7")]
+
+
+def test_remember_plan_stores_an_accepted_plan():
+    assert remember_plan(_executed("what is 3 plus 4?", *FINAL))
+    assert _summary(PlanCache.lookup("what is 5 plus 6?", TOOLS))[0] == (1, "add", {"a": 5, "b": 6}, [])
+
+
+def test_remember_plan_skips_a_replan_request():
+    replan = [AIMessage(content="Thought: no."), SystemMessage(content="Context from last attempt: try again")]
+    assert not remember_plan(_executed("what is 3 plus 4?", *replan))
+    assert PlanCache.lookup("what is 5 plus 6?", TOOLS) is None
+
+
+def test_remember_plan_skips_a_query_that_needed_a_replan():
+    messages = _executed("what is 3 plus 4?", SystemMessage(content="Context from last attempt: try again"))
+    messages += [FunctionMessage(name="add", content="7", additional_kwargs={"idx": 3, "args": {"a": 3, "b": 4}})]
+    assert not remember_plan(messages + FINAL)
+
+
+def test_remember_plan_skips_failed_tool_calls():
+    messages = _executed("what is 3 plus 4?", *FINAL)
+    messages[1] = FunctionMessage(name="add", content="ERROR (Failed to call add)",
+                                  additional_kwargs={"idx": 1, "args": {"a": 3, "b": 4}})
+    assert not remember_plan(messages)
+
+
+def _conductor(model):
+    return conductor.build(model, TOOLS, PromptManager.get('default'), use_plan_cache=True)
+
+
+def test_conductor_reuses_an_accepted_plan():
+    model = ScriptedChatModel(plans=['Thought: add.\n1. add(3, 4)\n2. join()<END_OF_PLAN>'])
+    graph_app = _conductor(model)
+    graph_app.invoke({"messages": [HumanMessage(content="what is 3 plus 4?")]})
+    graph_app.invoke({"messages": [HumanMessage(content="what is 5 plus 6?")]})
+    assert model._plan_calls == 1
+
+
+def test_conductor_does_not_keep_a_plan_the_joiner_rejected():
+    model = ScriptedChatModel(plans=['Thought: add.\n1. add(3, 4)\n2. join()<END_OF_PLAN>',
+                                     'Thought: again.\n3. add(3, 4)\n4. join()<END_OF_PLAN>'], replans=1)
+    _conductor(model).invoke({"messages": [HumanMessage(content="what is 3 plus 4?")]})
+    assert model._plan_calls == 2
+    assert PlanCache.lookup("what is 5 plus 6?", TOOLS) is None
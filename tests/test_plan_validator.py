@@ -0,0 +1,136 @@
+################################################################################
+# Tests: plan validation and the replan cutoff
+################################################################################
+
+import asyncio
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.tools import StructuredTool
+import conductor
+from benchmarks.fakes import ScriptedChatModel
+from managers.prompt_manager import PromptManager
+from players.output_parser import LLMCompilerJsonPlanParser, LLMCompilerPlanParser
+from players.plan_validator import PlanValidator, is_plan_error
+
+
+def _echo(x: str) -> str:
+    return x
+
+
+TOOLS = {"echo": StructuredTool.from_function(_echo, name="echo", description="echo(x: str) -> str")}
+
+
+def _validate(plan: str, observed=()) -> tuple[list[int], list[str]]:
+    """Indices passed to the scheduler, in order, and the errors reported."""
+    validator = PlanValidator(observed)
+    tasks = validator.wrap(LLMCompilerPlanParser(tools=TOOLS).stream(plan))
+    return [task["idx"] for task in tasks], validator.errors
+
+
+def test_valid_plan_passes_through():
+    assert _validate('1. echo("a")\n2. echo("$1")\n3. join()<END_OF_PLAN>') == ([1, 2, 3], [])
+
+
+def test_forward_references_are_held_until_resolved():
+    assert _validate('1. echo("$2")\n2. echo("a")\n3. join()') == ([2, 1, 3], [])
+
+
+def test_duplicate_index():
+    released, errors = _validate('1. echo("a")\n1. echo("b")\n2. join()')
+    assert released == [1, 2]
+    assert errors == ['Task 1 is a duplicate of an earlier task with the same index.']
+
+
+def test_duplicate_of_an_observed_task():
+    released, errors = _validate('1. echo("a")\n2. join()', observed=[1])
+    assert released == [2]
+    assert errors == ['Task 1 is a duplicate of an earlier task with the same index.']
+
+
+def test_self_reference():
+    released, errors = _validate('1. echo("$1")\n2. echo("$1")\n3. echo("b")\n4. join()')
+    assert released == [3]
+    assert errors == ['Task 1 depends on its own output.', 'Task 2 depends on tasks that could not run.',
+                      'Task 4 depends on tasks that could not run.']
+
+
+def test_cycle():
+    released, errors = _validate('1. echo("$2")\n2. echo("$1")\n3. echo("c")\n4. join()')
+    assert released == [3]
+    assert errors == ['Task 1 is part of a dependency cycle.', 'Task 2 is part of a dependency cycle.',
+                      'Task 4 depends on tasks that could not run.']
+
+
+def test_missing_reference():
+    released, errors = _validate('1. echo("a")\n2. echo("$7")\n3. join()')
+    assert released == [1]
+    assert errors == ['Task 2 depends on [7], which no task produces.', 'Task 3 depends on tasks that could not run.']
+
+
+def test_unknown_tool_keeps_the_rest_of_the_plan():
+    released, errors = _validate('1. echo("a")\n2. search("b")\n3. echo("$2")\n4. echo("c")\n5. join()')
+    assert released == [1, 4]
+    assert errors == ['Task 2 calls "search", which is not an available tool.',
+                      'Task 3 depends on tasks that could not run.',
+                      'Task 5 depends on tasks that could not run.']
+
+
+def test_unknown_tool_in_a_json_plan():
+    validator = PlanValidator()
+    plan = '{"idx": 1, "tool": "search", "args": {}}\n{"idx": 2, "tool": "echo", "args": {"x": "a"}}\n'
+    tasks = list(validator.wrap(LLMCompilerJsonPlanParser(tools=TOOLS).stream(plan)))
+    assert [task["idx"] for task in tasks] == [2]
+    assert validator.errors == ['Task 1 calls "search", which is not an available tool.']
+
+
+def test_empty_plan():
+    assert _validate('Thought: nothing to do.') == ([], ['The plan has no actions in the expected format.'])
+
+
+def test_async_wrap_matches_sync():
+    plan = '1. echo("$2")\n2. echo("a")\n3. nope()\n4. echo("$4")\n5. join()'
+
+    async def main():
+        validator = PlanValidator()
+        tasks = [task["idx"] async for task in validator.awrap(LLMCompilerPlanParser(tools=TOOLS).astream(plan))]
+        return tasks, validator.errors
+
+    assert asyncio.run(main()) == _validate(plan)
+
+
+def test_errors_become_a_replan_message():
+    validator = PlanValidator()
+    list(validator.wrap(LLMCompilerPlanParser(tools=TOOLS).stream('1. nope()\n2. join()')))
+    [message] = validator.messages()
+    assert is_plan_error(message)
+    assert ' - Task 1 calls "nope", which is not an available tool.' in message.content
+
+
+BAD_PLAN = 'Thought: Scripted plan.\n1. nope("a")\n2. join()<END_OF_PLAN>'
+# The join of the rejected plan still ran, so the replan continues from 3
+GOOD_REPLAN = 'Thought: Scripted plan.\n3. echo("a")\n4. join()<END_OF_PLAN>'
+
+
+def _run_conductor(plans: list[str], max_plan_retries: int) -> tuple[ScriptedChatModel, list]:
+    model = ScriptedChatModel(plans=plans)
+    graph_app = conductor.build(model, TOOLS, PromptManager.get('default'), use_plan_cache=False,
+                                max_plan_retries=max_plan_retries)
+    state = graph_app.invoke({"messages": [HumanMessage(content="question")]})
+    return model, state["messages"]
+
+
+@pytest.mark.parametrize("max_plan_retries", [0, 2])
+def test_invalid_plans_are_replanned_up_to_max_plan_retries(max_plan_retries):
+    model, messages = _run_conductor([BAD_PLAN], max_plan_retries)
+    # The first plan and every retry fail, then the joiner answers with the errors in context
+    assert model._plan_calls == max_plan_retries + 1
+    assert model._join_calls == 1
+    assert sum(is_plan_error(m) for m in messages) == max_plan_retries + 1
+    assert isinstance(messages[-1], AIMessage)
+
+
+def test_a_valid_replan_goes_to_the_joiner():
+    model, messages = _run_conductor([BAD_PLAN, GOOD_REPLAN], max_plan_retries=2)
+    assert model._plan_calls == 2
+    assert model._join_calls == 1
+    assert sum(is_plan_error(m) for m in messages) == 1
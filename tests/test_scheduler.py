@@ -0,0 +1,201 @@
+################################################################################
+# Tests: dependency tracking in the thread and async schedulers
+################################################################################
+
+import time
+import asyncio
+import threading
+import pytest
+from langchain_core.tools import StructuredTool
+from managers.trace_manager import TraceManager
+from managers.worker_manager import WorkerManager
+from players.scheduler import _resolve_task_args, _schedule_tasks
+
+
+def _tool(name: str, fn=None, coroutine=None) -> StructuredTool:
+    return StructuredTool.from_function(func=fn, coroutine=coroutine, name=name, description=name)
+
+
+def _task(idx: int, tool, x: str | None = None, dependencies=()) -> dict:
+    args = {"x": x} if x is not None else {}
+    return {"idx": idx, "tool": tool, "args": args, "dependencies": list(dependencies), "thought": None}
+
+
+class Recorder:
+    """Sync and async echo tools that log when each call starts and ends."""
+
+    def __init__(self, delays: dict[str, float] | None = None):
+        self.delays = delays or {}
+        self.log = []
+        self.lock = threading.Lock()
+
+    def _record(self, event: str, x: str):
+        with self.lock:
+            self.log.append((event, x))
+
+    def sync(self, name: str) -> StructuredTool:
+        def fn(x: str) -> str:
+            self._record("start", x)
+            time.sleep(self.delays.get(x, 0))
+            self._record("end", x)
+            return f"{name}({x})"
+        return _tool(name, fn=fn)
+
+    def coroutine(self, name: str) -> StructuredTool:
+        # Awaited by the async scheduler; the thread scheduler calls the sync function
+        async def afn(x: str) -> str:
+            self._record("start", x)
+            await asyncio.sleep(self.delays.get(x, 0))
+            self._record("end", x)
+            return f"{name}({x})"
+        return _tool(name, fn=self.sync(name).func, coroutine=afn)
+
+    def position(self, event: str, x: str) -> int:
+        return self.log.index((event, x))
+
+
+def _run(mode: str, tasks: list[dict]) -> dict[int, str]:
+    if mode == "threads":
+        messages = _schedule_tasks.invoke({"messages": [], "tasks": iter(tasks)})
+    else:
+        async def stream():
+            for task in tasks:
+                yield task
+        messages = asyncio.run(_schedule_tasks.ainvoke({"messages": [], "tasks": stream()}))
+    return {m.additional_kwargs["idx"]: m.content for m in messages}
+
+
+MODES = ["threads", "loop"]
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_dependencies_run_first_and_are_substituted(mode):
+    recorder = Recorder(delays={"a": 0.05})
+    fetch, combine = recorder.sync("fetch"), recorder.coroutine("combine")
+    # 3 is streamed before 2, which it depends on
+    observations = _run(mode, [
+        _task(1, fetch, "a"),
+        _task(3, combine, "$2 and $1", [1, 2]),
+        _task(2, combine, "$1", [1]),
+        _task(4, "join"),
+    ])
+    assert observations == {
+        1: "fetch(a)",
+        2: "combine(fetch(a))",
+        3: "combine(combine(fetch(a)) and fetch(a))",
+        4: "join",
+    }
+    assert recorder.position("end", "a") < recorder.position("start", "fetch(a)")
+    assert recorder.position("end", "fetch(a)") < recorder.position("start", "combine(fetch(a)) and fetch(a)")
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_independent_tasks_run_concurrently(mode):
+    recorder = Recorder(delays={"a": 0.2, "b": 0.2})
+    start = time.perf_counter()
+    observations = _run(mode, [_task(1, recorder.sync("slow"), "a"), _task(2, recorder.coroutine("slow"), "b")])
+    assert observations == {1: "slow(a)", 2: "slow(b)"}
+    assert time.perf_counter() - start < 0.35
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_failing_dependency_becomes_an_error_observation(mode):
+    def fail(x: str) -> str:
+        raise ValueError("boom")
+
+    recorder = Recorder()
+    observations = _run(mode, [
+        _task(1, _tool("fail", fn=fail), "a"),
+        _task(2, recorder.sync("after"), "$1", [1]),
+    ])
+    assert observations[1].startswith("ERROR (Failed to call fail with args {'x': 'a'}.")
+    assert "ValueError('boom')" in observations[1]
+    # The dependent still runs, and sees the error
+    assert observations[2] == f"after({observations[1]})"
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_stuck_tasks_are_released(mode):
+    recorder = Recorder()
+    tool = recorder.sync("echo")
+    observations = _run(mode, [
+        _task(1, tool, "a"),
+        _task(2, tool, "$9", [9]),  # 9 is never planned
+        _task(3, tool, "$2", [2]),  # waits on a stuck task
+        _task(4, tool, "$5", [5]),  # a cycle
+        _task(5, tool, "$4", [4]),
+    ])
+    assert observations[1] == "echo(a)"
+    assert observations[2] == "ERROR (Task 2 was not executed. Its dependencies [9] were never produced.)"
+    assert observations[3] == "ERROR (Task 3 was not executed. Its dependencies [2] were never produced.)"
+    assert observations[4] == "ERROR (Task 4 was not executed. Its dependencies [5] were never produced.)"
+    assert observations[5] == "ERROR (Task 5 was not executed. Its dependencies [4] were never produced.)"
+    assert recorder.log == [("start", "a"), ("end", "a")]
+
+
+def test_thread_and_async_schedules_agree():
+    def plan(recorder: Recorder) -> list[dict]:
+        sync, coroutine = recorder.sync("s"), recorder.coroutine("c")
+        return [
+            _task(1, sync, "x"),
+            _task(2, coroutine, "y"),
+            _task(4, sync, "$2/$3", [2, 3]),
+            _task(3, coroutine, "$1", [1]),
+            _task(5, coroutine, "$8", [8]),
+            _task(6, "join"),
+        ]
+
+    recorder = Recorder(delays={"x": 0.02, "y": 0.01})
+    assert _run("threads", plan(recorder)) == _run("loop", plan(Recorder(delays=recorder.delays)))
+
+
+def test_cancelling_the_async_schedule_cancels_running_tools():
+    cancelled = asyncio.Event()
+    started = asyncio.Event()
+
+    async def hang(x: str) -> str:
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        return x
+
+    tool = _tool("hang", coroutine=hang)
+
+    async def stream():
+        yield _task(1, tool, "a")
+        yield _task(2, tool, "$1", [1])
+
+    async def main():
+        schedule = asyncio.ensure_future(_schedule_tasks.ainvoke({"messages": [], "tasks": stream()}))
+        await asyncio.wait_for(started.wait(), 1)
+        schedule.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await schedule
+        assert cancelled.is_set()
+
+    asyncio.run(main())
+    # The cancelled call gave its slot back
+    assert WorkerManager.stats()["async_in_flight"] == 0
+    assert WorkerManager.stats()["tools"]["hang"]["in_flight"] == 0
+
+
+def test_thread_tools_run_under_their_task_span():
+    spans = []
+
+    def fn(x: str) -> str:
+        current = TraceManager.current()
+        spans.append([current.name] + [span.name for span in current.ancestors()])
+        return x
+
+    with TraceManager.span("plan_and_execute"):
+        _run("threads", [_task(1, _tool("traced", fn=fn), "a")])
+    assert spans and spans[0][:3] == ["task.execute", "task", "plan_and_execute"]
+
+
+def test_list_and_tuple_args_are_resolved():
+    observations = {1: "one", 2: "two"}
+    assert _resolve_task_args(["$1", "${2}", "x"], observations) == ["one", "two", "x"]
+    assert _resolve_task_args(("$1", ["$2"]), observations) == ["one", ["two"]]
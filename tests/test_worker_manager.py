@@ -0,0 +1,133 @@
+################################################################################
+# Tests: per-tool caps, FIFO queueing and process pool recycling
+################################################################################
+
+import os
+import time
+import asyncio
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from managers import worker_manager
+from managers.worker_manager import WorkerManager
+
+
+@pytest.fixture(autouse=True)
+def restore_caps():
+    saved = dict(max_workers=worker_manager._MAX_WORKERS, limits=dict(worker_manager._LIMITS),
+                 max_processes=worker_manager._MAX_PROCESSES, recycle_after=worker_manager._RECYCLE_AFTER,
+                 max_async=worker_manager._MAX_ASYNC)
+    yield
+    WorkerManager.configure(**saved)
+
+
+class Gauge:
+    """Counts calls in flight and remembers the peak."""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc):
+        with self.lock:
+            self.current -= 1
+
+
+def test_per_tool_cap_holds_under_concurrent_submits():
+    WorkerManager.configure(max_workers=16, limits={"capped": 3})
+    gauge, other = Gauge(), Gauge()
+
+    def call(g: Gauge):
+        with g:
+            time.sleep(0.01)
+        return True
+
+    # Submitted from many threads at once, mixed with an uncapped tool
+    with ThreadPoolExecutor(max_workers=8) as submitters:
+        futures = list(submitters.map(
+            lambda i: WorkerManager.submit("capped" if i % 2 else "free", call, gauge if i % 2 else other),
+            range(60)))
+    assert all(f.result(timeout=5) for f in futures)
+    assert gauge.peak == 3
+    assert other.peak > 3
+    stats = WorkerManager.stats()["tools"]["capped"]
+    assert stats["in_flight"] == 0 and stats["queue_depth"] == 0
+
+
+def test_per_tool_cap_counts_threads_and_coroutines_together():
+    WorkerManager.configure(limits={"mixed": 2})
+    gauge = Gauge()
+
+    def call():
+        with gauge:
+            time.sleep(0.02)
+
+    async def acall():
+        with gauge:
+            await asyncio.sleep(0.02)
+
+    async def main():
+        futures = [asyncio.wrap_future(WorkerManager.submit("mixed", call)) for _ in range(5)]
+        await asyncio.gather(*futures, *(WorkerManager.run("mixed", acall) for _ in range(5)))
+
+    asyncio.run(main())
+    assert gauge.peak == 2
+
+
+def test_queued_calls_start_in_fifo_order():
+    WorkerManager.configure(limits={"serial": 1})
+    gate = threading.Event()
+    started = []
+
+    def call(i: int):
+        started.append(i)
+        if i == 0:
+            gate.wait(5)
+
+    first = WorkerManager.submit("serial", call, 0)
+    while not started:
+        time.sleep(0.001)
+    futures = [WorkerManager.submit("serial", call, i) for i in range(1, 8)]
+    assert WorkerManager.stats()["tools"]["serial"]["queue_depth"] == 7
+    gate.set()
+    for future in [first, *futures]:
+        future.result(timeout=5)
+    assert started == list(range(8))
+
+
+def test_freed_slots_go_to_the_longest_waiting_tool():
+    WorkerManager.configure(max_workers=1, limits={})
+    gate = threading.Event()
+    started = []
+
+    def call(name: str):
+        started.append(name)
+        if name == "first":
+            gate.wait(5)
+
+    first = WorkerManager.submit("a", call, "first")
+    while not started:
+        time.sleep(0.001)
+    futures = [WorkerManager.submit(tool, call, f"{tool}{i}") for i, tool in enumerate("babab")]
+    gate.set()
+    for future in [first, *futures]:
+        future.result(timeout=5)
+    assert started == ["first", "b0", "a1", "b2", "a3", "b4"]
+
+
+def test_process_pool_is_recycled():
+    WorkerManager.configure(max_processes=1, recycle_after=3)
+    WorkerManager.shutdown()
+    recycles = WorkerManager.stats()["processes"]["recycles"]
+    pids = [WorkerManager.submit_process(os.getpid).result(timeout=30) for _ in range(7)]
+    # Calls 1-3 on the first pool, 4-6 on the second, 7 on the third
+    assert len(set(pids[:3])) == 1 and len(set(pids[3:6])) == 1
+    assert len({pids[0], pids[3], pids[6]}) == 3
+    assert WorkerManager.stats()["processes"]["recycles"] - recycles == 2
+    WorkerManager.shutdown()